@@ -1,19 +1,126 @@
+import threading
+import time
 import traceback
 
 import streamlit as st
 import os
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
-from boto3.dynamodb.conditions import Attr
 import pytz
 
+from warden.downsample import DOWNSAMPLERS
 from warden.terminal import load_terminals
-from warden.detection import detect_trucks
-from warden.config import get_photo_memory, get_db_memory
-from warden.ocr import Tesseract
+from warden.memory.rollup import choose_granularity
+from warden.regions import submit_regions
+from warden.config import get_photo_memory, get_db_memory, get_timestamp_reader, get_detector
 
 
-tesseract = Tesseract()
+QUERY_TTL = 60  # seconds before cached detections are refreshed
+REFRESH_OVERLAP_MS = 15 * 60 * 1000  # re-read this much before the newest cached row to catch late writes
+COLUMN_TYPES = {'timestamp': 'int64', 'truck_count': 'float64', 'avg_confidence': 'float64'}
+
+
+def to_frame(rows: list) -> pd.DataFrame:
+    """Query rows as a DataFrame with typed columns, timestamps stay UNIX ms"""
+    df = pd.DataFrame.from_records(rows)
+    return df.astype(COLUMN_TYPES) if not df.empty else df
+
+
+def carried_count(df: pd.DataFrame) -> int:
+    """Detections of `df` that reused the previous frame's count, rollup rows count theirs in `carried`"""
+    return int(sum(df[column].fillna(0).astype('int64').sum()
+                   for column in ('carried_forward', 'carried') if column in df))
+
+
+def downsample(df: pd.DataFrame, budget: int, method: str) -> pd.DataFrame:
+    """Keep at most `budget` points of each camera's series, picked by one of `DOWNSAMPLERS`"""
+    df = df.sort_values(['camera_name', 'timestamp'], kind='stable')
+    timestamps = df['timestamp'].to_numpy(dtype=np.float64)
+    counts = df['truck_count'].to_numpy(dtype=np.float64)
+    keep = [positions[DOWNSAMPLERS[method](timestamps[positions], counts[positions], budget)]
+            for positions in df.groupby('camera_name', sort=False).indices.values()]
+    return df.iloc[np.concatenate(keep)] if keep else df
+
+
+@st.cache_resource
+def load_timestamp_reader(name: str):
+    return get_timestamp_reader(name)
+
+
+@st.cache_resource
+def load_photo_memory(storage_type: str):
+    return get_photo_memory(storage_type)
+
+
+@st.cache_resource
+def load_db_memory(db_type: str):
+    return get_db_memory(db_type)
+
+
+@st.cache_resource
+def load_detector():
+    return get_detector()
+
+
+@st.cache_resource
+def load_cached_terminals(terminals_file: str, storage_type: str, mtime: float):
+    """Terminals shared by every session, `mtime` reloads them when the YAML file changes"""
+    return load_terminals(terminals_file, load_photo_memory(storage_type))
+
+
+@st.cache_resource
+def camera_lock(full_name: str) -> threading.Lock:
+    """Cameras are shared by every session, only one of them may process a camera at a time"""
+    return threading.Lock()
+
+
+class DetectionCache:
+    """Detections for one date range, shared across sessions and topped up with only the newest rows"""
+    def __init__(self, start_ts: int, end_ts: int, cameras: tuple):
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.cameras = list(cameras)
+        self.granularity = choose_granularity(start_ts, end_ts)
+        self.df = pd.DataFrame()
+        self.fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, db_mem, force: bool = False) -> pd.DataFrame:
+        with self._lock:
+            if force or time.monotonic() - self.fetched_at > QUERY_TTL:
+                self._refresh(db_mem)
+            return self.df
+
+    def _refresh(self, db_mem) -> None:
+        refresh_from = self.start_ts
+        if not self.df.empty:
+            refresh_from = max(self.start_ts, int(self.df['timestamp'].max()) - REFRESH_OVERLAP_MS)
+        rows = self._query(db_mem, refresh_from)
+        if not self.df.empty:
+            self.df = self.df[self.df['timestamp'] < refresh_from]
+        self.df = pd.concat([self.df, to_frame(rows)], ignore_index=True) if rows else self.df
+        self.fetched_at = time.monotonic()
+
+    def _query(self, db_mem, start_ts: int) -> list:
+        """Read the coarsest rollup that still draws a useful chart for the range, or the raw rows.
+
+        Raw rows are read for the part of the range from before the rollups cover every detection.
+        """
+        covered = db_mem.rollups_start() if self.granularity else None
+        if covered is None:
+            self.granularity = None  # e.g. DynamoDB without a rollup table
+            return list(db_mem.query_range(start_ts, self.end_ts, self.cameras))
+        rollups_start = max(start_ts, covered)
+        rows = []
+        if rollups_start > start_ts:
+            rows = list(db_mem.query_range(start_ts, min(rollups_start - 1, self.end_ts), self.cameras))
+        return rows + list(db_mem.query_rollups(self.granularity, rollups_start, self.end_ts, self.cameras))
+
+
+@st.cache_resource(max_entries=32)
+def detection_cache(db_type: str, start_ts: int, end_ts: int, cameras: tuple) -> DetectionCache:
+    return DetectionCache(start_ts, end_ts, cameras)
 
 
 def main():
@@ -25,15 +132,14 @@ def main():
     storage_type = st.sidebar.selectbox("Storage Type", ["local", "s3"], index=1)
     db_type = st.sidebar.selectbox("Database Type", ["sqlite", "mysql", "postgres", "dynamodb"], index=3)
     detect_trucks_option = st.sidebar.checkbox("Detect Trucks", value=True)
-    ocr_option = st.sidebar.selectbox("OCR Timestamp Reader", ["tesseract", "none"])
+    ocr_option = st.sidebar.selectbox("OCR Timestamp Reader", ["tesseract", "glyph", "none"])
 
-    ocr_option = None if ocr_option == "none" else tesseract
+    ocr_option = load_timestamp_reader(ocr_option)
 
     # Load terminals
     try:
-        photo_mem = get_photo_memory(storage_type)
-        db_mem = get_db_memory(db_type)
-        terminals = load_terminals(terminals_file, photo_mem)
+        db_mem = load_db_memory(db_type)
+        terminals = load_cached_terminals(terminals_file, storage_type, os.path.getmtime(terminals_file))
     except Exception as e:
         st.error(f"Error loading configuration: {str(e)}")
         return
@@ -46,16 +152,25 @@ def main():
 
             if st.button(f"Process {camera.full_name}"):
                 try:
-                    camera.get()
-                    camera.save_last(timestamp_reader=ocr_option)
-                    st.success(f"Processed CAMERA: {camera.full_name}_{camera.last_timestamp}")
-
-                    if detect_trucks_option:
-                        truck_count, avg_confidence = detect_trucks(camera.last_image_name,
-                                                                    os.environ.get('S3_BUCKET_NAME', 'wando-warden'))
-                        st.info(f"Detected {truck_count} trucks with average confidence {avg_confidence:.2f}")
-                        db_mem.save((truck_count, avg_confidence), f"{camera.full_name}|{camera.last_timestamp}|"
-                                                                   f"{camera.last_ts_approx}")
+                    # get and save_last replace the camera's last frame, which the other sessions see too
+                    with camera_lock(camera.full_name):
+                        if camera.get() is None:
+                            st.info(f"Frame unchanged since the last scan ({camera.skipped_frames} skipped)")
+                            continue
+                        # detection works on the frame bytes, so it runs while the frame is being stored
+                        pending = submit_regions(load_detector(), camera.last_frame, camera.detect_regions,
+                                                 camera.detect_max_side) if detect_trucks_option else None
+                        camera.save_last(timestamp_reader=ocr_option)
+                        st.success(f"Processed CAMERA: {camera.full_name}_{camera.last_timestamp}")
+                        preview = camera.last_renditions.get('medium') or camera.last_renditions.get('thumb')
+                        if preview:
+                            st.image(preview, caption=camera.last_image_name)
+
+                        if pending is not None:
+                            truck_count, avg_confidence = pending.result()
+                            st.info(f"Detected {truck_count} trucks with average confidence {avg_confidence:.2f}")
+                            db_mem.save((truck_count, avg_confidence), camera.last_record_name)
+                        camera.commit()
 
                 except Exception as e:
                     error_msg = (f"Error processing camera {camera.full_name}: {str(e)}\n\n"
@@ -70,43 +185,38 @@ def main():
         end_date = st.date_input("End Date", datetime.now().date())
         start_ts, end_ts = date_to_utc_ms(start_date), date_to_utc_ms(end_date)
 
-        results = query_db(db_mem, start_ts, end_ts)
+        cameras = tuple(camera.full_name for terminal in terminals for camera in terminal.cameras)
+        cache = detection_cache(db_type, start_ts, end_ts, cameras)
+        results = cache.get(db_mem, force=st.button("Refresh data"))
 
-        if results:
+        if not results.empty:
             if st.checkbox("view table"):
                 st.subheader("Data Table")
-                st.table(results)
+                st.dataframe(results)
 
             st.subheader("Truck Count per Camera Over Time")
-            df = pd.DataFrame(results)
-            df['truck_count'] = df['truck_count'].apply(lambda x: float(x))
-            df['timestamp'] = df['timestamp'].apply(lambda x: datetime.fromtimestamp(int(x)/1000, tz=pytz.UTC))
-            pivot_df = df.pivot(index='timestamp', columns='camera_name', values='truck_count')
-            st.scatter_chart(pivot_df)
+            budget = st.slider("Points per camera", min_value=100, max_value=5000, value=1000, step=100)
+            method = st.selectbox("Downsampling", list(DOWNSAMPLERS),
+                                  format_func={'lttb': 'Largest triangle (LTTB)', 'minmax': 'Min/max'}.get)
+            chart = downsample(results, budget, method)
+            caption = f"{len(chart)} of {len(results)} points"
+            carried = carried_count(results)
+            if carried:
+                caption += f", {carried} counts carried forward from an unchanged scene"
+            if cache.granularity:
+                caption += f", mean truck count per {cache.granularity}"
+            st.caption(caption)
+            chart = pd.DataFrame({
+                'timestamp': pd.to_datetime(chart['timestamp'], unit='ms', utc=True),
+                'camera_name': chart['camera_name'],
+                'truck_count': chart['truck_count'],
+            })
+            st.scatter_chart(chart, x='timestamp', y='truck_count', color='camera_name')
 
         else:
             st.info("No data available for the selected date range.")
 
 
-def query_db(db_mem, start_ts: int, end_ts: int):
-
-    response = db_mem.table.scan(
-        FilterExpression=Attr('timestamp').between(start_ts, end_ts)
-    )
-
-    items = response['Items']
-
-    # Paginate through the results if there are more
-    while 'LastEvaluatedKey' in response:
-        response = db_mem.table.scan(
-            FilterExpression=Attr('timestamp').between(start_ts, end_ts),
-            ExclusiveStartKey=response['LastEvaluatedKey']
-        )
-        items.extend(response['Items'])
-
-    return items
-
-
 def date_to_utc_ms(date, tz='US/Eastern', time=None):
     if time is None:
         time = (0, 0, 0)  # midnight by default
@@ -0,0 +1,38 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+from warden.memory.sql import DynamoDBMemory, SQLiteMemory
+
+
+@pytest.fixture
+def sqlite_memory(tmp_path):
+    memory = SQLiteMemory(str(tmp_path / 'detections.db'))
+    yield memory
+    memory.close()
+
+
+@pytest.fixture
+def dynamodb_memory(monkeypatch):
+    for name, value in {'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_ACCESS_KEY_ID': 'testing',
+                        'AWS_SECRET_ACCESS_KEY': 'testing'}.items():
+        monkeypatch.setenv(name, value)
+    with mock_aws():
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        for name, hash_key, range_key, range_type in (('detections', 'camera_name', 'timestamp', 'N'),
+                                                      ('rollups', 'series', 'bucket', 'N')):
+            dynamodb.create_table(
+                TableName=name,
+                KeySchema=[{'AttributeName': hash_key, 'KeyType': 'HASH'},
+                           {'AttributeName': range_key, 'KeyType': 'RANGE'}],
+                AttributeDefinitions=[{'AttributeName': hash_key, 'AttributeType': 'S'},
+                                      {'AttributeName': range_key, 'AttributeType': range_type}],
+                BillingMode='PAY_PER_REQUEST')
+        yield DynamoDBMemory('detections', 'us-east-1', 'rollups')
+
+
+
+@pytest.fixture(params=['sqlite', 'dynamodb'])
+def db_memory(request):
+    """Every backend that runs without a database server"""
+    return request.getfixturevalue(f"{request.param}_memory")
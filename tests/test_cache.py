@@ -0,0 +1,23 @@
+from warden.memory.cache import CachedPhotoMemory
+from warden.memory.image import LocalPhotoMemory
+from warden.metrics import REGISTRY
+
+
+def test_cached_bytes_are_a_view_that_outlives_eviction(tmp_path):
+    inner = LocalPhotoMemory(str(tmp_path / 'images'))
+    inner.save_bytes(b'\xff\xd8first', 'a.jpg')
+    inner.save_bytes(b'\xff\xd8second', 'b.jpg')
+    cache = CachedPhotoMemory(inner, str(tmp_path / 'cache'), max_bytes=10)
+
+    assert bytes(cache.load_bytes('a.jpg')) == b'\xff\xd8first'  # miss, read through
+    view = cache.load_bytes('a.jpg')  # hit, mapped
+    assert isinstance(view, memoryview) and view.readonly
+    cache.load_bytes('b.jpg')  # evicts a.jpg
+    assert bytes(view) == b'\xff\xd8first'
+    view.release()
+
+    assert cache.stats()['hits'] == 1 and cache.stats()['evictions'] == 1
+    metrics = REGISTRY.render()
+    for event in ('hit', 'miss', 'eviction'):
+        assert f'warden_photo_cache_total{{event="{event}"}}' in metrics
+    cache.close()
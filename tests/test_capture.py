@@ -0,0 +1,57 @@
+import io
+
+from PIL import Image
+
+from warden.capture import CaptureJob, build_capture_pipeline
+from warden.fetch import FetchResult
+from warden.memory.image import LocalPhotoMemory
+from warden.terminal import Terminal
+
+
+def jpeg(color) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16), color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class StaticClient:
+    """Serves the same frame with an ETag, honouring If-None-Match"""
+    def __init__(self, data: bytes):
+        self.data = data
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append(dict(headers or {}))
+        if (headers or {}).get('If-None-Match') == '"v1"':
+            return FetchResult(304, {}, b'')
+        return FetchResult(200, {'ETag': '"v1"', 'Content-Type': 'image/jpeg'}, self.data)
+
+
+class FlakyMemory(LocalPhotoMemory):
+    def __init__(self, directory, failures: int):
+        super().__init__(directory)
+        self.failures = failures
+
+    def save_bytes(self, data, name, content_type='image/jpeg'):
+        if self.failures:
+            self.failures -= 1
+            raise OSError('storage unavailable')
+        super().save_bytes(data, name, content_type)
+
+
+def test_frame_is_fetched_again_until_it_is_processed(tmp_path):
+    memory = FlakyMemory(str(tmp_path), failures=1)
+    client = StaticClient(jpeg('red'))
+    camera = Terminal('Port', memory, client).add_camera('Gate', 'http://camera', (0, 0, 8, 8))
+    pipeline = build_capture_pipeline(None, None)
+
+    pipeline.run([CaptureJob(camera)])  # storing fails
+    assert pipeline.failed == 1 and list(memory.list_names()) == []
+
+    pipeline.run([CaptureJob(camera)])  # the same frame is not skipped as unchanged
+    assert 'If-None-Match' not in client.requests[1]
+    assert len(list(memory.list_names())) == 1
+
+    pipeline.run([CaptureJob(camera)])  # now it is
+    assert client.requests[2]['If-None-Match'] == '"v1"'
+    assert camera.skipped_frames == 1 and len(list(memory.list_names())) == 1
@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+
+from warden.memory.compaction import compact
+from warden.memory.rollup import GRANULARITIES
+from warden.memory.spool import Spool, SpooledDatabaseMemory
+from warden.memory.sql import DynamoDBMemory, SQLiteMemory
+
+
+def raw(memory, camera='cam'):
+    return [(row['timestamp'], row['truck_count']) for row in memory.query_range(0, 10 ** 9, [camera])]
+
+
+def rollups(memory, camera='cam'):
+    return {granularity: [(row['timestamp'], row['samples'], row['truck_count'], row['min_truck_count'],
+                           row['max_truck_count']) for row in memory.query_rollups(granularity, 0, 10 ** 9, [camera])]
+            for granularity in GRANULARITIES}
+
+
+def test_saving_a_key_twice_counts_it_once(db_memory):
+    db_memory.save((3, 0.9), 'cam|1000|False')
+    db_memory.save((3, 0.9), 'cam|1000|False')
+    db_memory.save_many([((5, 0.8), 'cam|2000|False'), ((5, 0.8), 'cam|2000|False')])
+
+    assert raw(db_memory) == [(1000, 3), (2000, 5)]
+    for rows in rollups(db_memory).values():
+        assert rows == [(0, 2, 4.0, 3, 5)]
+
+
+def test_carried_forward_detections_are_told_apart(db_memory):
+    db_memory.save_many([((3, 0.9), 'cam|1000|False'), ((3, 0.9, True), 'cam|2000|False')])
+
+    assert [row['carried_forward'] for row in db_memory.query_range(0, 10 ** 9, ['cam'])] == [False, True]
+    for granularity in GRANULARITIES:
+        assert [row['carried'] for row in db_memory.query_rollups(granularity, 0, 10 ** 9, ['cam'])] == [1]
+
+    # reprocessing the carried frame detects it again
+    db_memory.replace_many([(('cam', 2000), ('cam', 2000, 4, 0.9, False, False))])
+    for granularity in GRANULARITIES:
+        assert [row['carried'] for row in db_memory.query_rollups(granularity, 0, 10 ** 9, ['cam'])] == [0]
+
+
+def test_unique_key_drops_duplicates_of_older_tables(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute('''
+            CREATE TABLE truck_detections (id INTEGER PRIMARY KEY AUTOINCREMENT, camera_name TEXT,
+                                           timestamp INTEGER, truck_count INTEGER, avg_confidence REAL,
+                                           ts_approx BOOLEAN)
+        ''')
+        conn.executemany('INSERT INTO truck_detections (camera_name, timestamp, truck_count, avg_confidence, '
+                         'ts_approx) VALUES (?, ?, ?, ?, ?)',
+                         [('cam', 1000, 3, 0.9, 0), ('cam', 1000, 9, 0.9, 0), ('cam', 2000, 5, 0.8, 0)])
+    conn.close()
+
+    memory = SQLiteMemory(path)
+    memory.save((3, 0.9), 'cam|1000|False')
+    assert raw(memory) == [(1000, 3), (2000, 5)]
+    assert not any(row['carried_forward'] for row in memory.query_range(0, 10 ** 9, ['cam']))
+    for rows in rollups(memory).values():
+        assert rows == [(0, 2, 4.0, 3, 5)]
+    memory.close()
+
+
+def test_spool_replay_saves_detections_once(db_memory, tmp_path):
+    path = str(tmp_path / 'spool.db')
+    spool = Spool(path, interval=3600)
+    SpooledDatabaseMemory(db_memory, spool).save_many([((3, 0.9), 'cam|1000|False'), ((5, 0.8), 'cam|2000|False')])
+
+    def crash(entries):
+        raise RuntimeError('killed after the write, before the entries were marked done')
+    spool._done = crash
+    with pytest.raises(RuntimeError):
+        spool.flush()
+
+    # the next start replays the entries that were already written
+    replayed = Spool(path, interval=3600)
+    SpooledDatabaseMemory(db_memory, replayed)
+    assert replayed.flush() == 2
+    replayed.close()
+
+    assert raw(db_memory) == [(1000, 3), (2000, 5)]
+    for rows in rollups(db_memory).values():
+        assert rows == [(0, 2, 4.0, 3, 5)]
+
+
+def test_dynamodb_without_rollup_table_serves_raw_rows(dynamodb_memory):
+    from app import DetectionCache
+
+    memory = DynamoDBMemory('detections', 'us-east-1')
+    memory.save((3, 0.9), 'cam|1000|False')
+    assert not memory.has_rollups and memory.rollups_start() is None
+
+    cache = DetectionCache(0, 30 * 86_400_000, ('cam',))
+    assert cache.granularity is not None
+    assert cache.get(memory)['truck_count'].tolist() == [3]
+    assert cache.granularity is None
+    with pytest.raises(ValueError):
+        compact(memory, days=1)
@@ -0,0 +1,9 @@
+from warden.memory.migrate import migrate
+
+
+def test_keys_repeated_across_concurrent_batches_are_written_once(sqlite_memory):
+    records = [{'camera_name': 'cam', 'timestamp': 1000 * (i % 3), 'truck_count': 3, 'avg_confidence': 0.9}
+               for i in range(24)]
+
+    assert migrate(records, sqlite_memory, batch_size=2, workers=4) == (3, 21)
+    assert [row['timestamp'] for row in sqlite_memory.query_range(0, 10 ** 9, ['cam'])] == [0, 1000, 2000]
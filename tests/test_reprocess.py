@@ -0,0 +1,16 @@
+from warden.reprocess import FrameResult, save_results
+
+from tests.test_detections import raw, rollups
+
+
+def test_reprocessing_twice_replaces_the_same_rows(db_memory):
+    db_memory.save_many([((3, 0.9), 'cam|1000|False'), ((5, 0.8), 'cam|2000|False'), ((1, 0.5), 'cam|3000|True')])
+    # OCR reads another timestamp for the first and the last frame, whose names keep the stored one
+    for count in (6, 7):
+        save_results(db_memory, [FrameResult('cam|1000|False.jpg', 'cam|1500|False', (count, 0.5), 1000),
+                                 FrameResult('cam|2000|False.jpg', 'cam|2000|False', (4, 0.7), 2000),
+                                 FrameResult('cam|3000|True.jpg', 'cam|3100|False', None, 3000)])
+
+        assert raw(db_memory) == [(1500, count), (2000, 4), (3100, 1)]
+        for rows in rollups(db_memory).values():
+            assert rows == [(0, 3, (count + 5) / 3, 1, count)]
@@ -1,11 +1,24 @@
 import argparse
 import logging
 import os
+import signal
+from datetime import datetime, timezone
 
-from warden.terminal import load_terminals
-from warden.detection import detect_trucks
-from warden.config import setup_logging, get_photo_memory, get_db_memory
-from warden.ocr import Tesseract
+from typing import List, Optional
+
+from warden.capture import CaptureJob, build_capture_pipeline
+from warden.change import ChangeDetector
+from warden.fetch import FetchClient
+from warden.memory import BufferedMemory, Spool, SpooledDatabaseMemory, SpooledPhotoMemory
+from warden.memory.compaction import Compactor, compact
+from warden.memory.export import EXPORT_FORMATS
+from warden.memory.retention import RETENTION_ACTIONS, apply_retention
+from warden.metrics import REGISTRY, StackSampler, set_sampler
+from warden.pipeline import Pipeline
+from warden.reprocess import Checkpoint, list_frames, reprocess, utc_date_ms
+from warden.scheduler import Scheduler
+from warden.terminal import Camera, load_terminals
+from warden.config import setup_logging, get_photo_memory, get_db_memory, get_timestamp_reader, get_detector
 
 
 def main() -> None:
@@ -14,33 +27,282 @@ def main() -> None:
     parser.add_argument('--storage', choices=['local', 's3'], default='s3', help='Storage type (local or s3)')
     parser.add_argument('--db', choices=['sqlite', 'mysql', 'postgres', 'dynamodb'], default='dynamodb',
                         help='Database type for truck detection results')
+    parser.add_argument('--db-batch-size', type=int, default=1,
+                        help='Buffer detection results and write them in batches of this size')
+    parser.add_argument('--db-flush-interval', type=float, default=5,
+                        help='Max seconds a buffered detection result waits before being written')
+    parser.add_argument('--spool',
+                        help='SQLite file that image and detection writes are spooled to, then written to S3 and '
+                             'the database in the background, surviving restarts')
+    parser.add_argument('--spool-max-attempts', type=int, default=10,
+                        help='Attempts after which a spooled write is moved to the spool_dead table (default: 10)')
+    parser.add_argument('--change-threshold', type=float, default=0,
+                        help='Reuse the last detection while the scene changed less than this (0-1, default: 0, off). '
+                             'Cameras can override it with a `change_threshold` key')
+    parser.add_argument('--max-carry', type=int, default=10,
+                        help='Detect anyway after this many frames in a row reused the last detection')
     parser.add_argument('--log-level', default='INFO', help='Logging level')
     parser.add_argument('--detect-trucks', action='store_true', help='Perform truck detection')
-    parser.add_argument('--ocr', choices=['tesseract', 'none'], default='tesseract',
+    parser.add_argument('--ocr', choices=['tesseract', 'glyph', 'none'], default='tesseract',
                         help='Choose what ocr to extract the timestamp')
+    parser.add_argument('--ocr-processes', type=int, default=0,
+                        help='Run Tesseract in this many long-lived worker processes (default: in-thread)')
+    parser.add_argument('--concurrency', type=int, default=4, help='Default worker threads per pipeline stage')
+    parser.add_argument('--fetch-workers', type=int, help='Worker threads downloading camera images')
+    parser.add_argument('--ocr-workers', type=int, help='Worker threads reading timestamps')
+    parser.add_argument('--store-workers', type=int, help='Worker threads saving images')
+    parser.add_argument('--detect-workers', type=int, help='Worker threads running truck detection')
+    parser.add_argument('--persist-workers', type=int, help='Worker threads saving detection results (default: 1)')
+    parser.add_argument('--fetch-timeout', type=float, default=15, help='Seconds to wait for a camera to respond')
+    parser.add_argument('--fetch-retries', type=int, default=2, help='Retries for failed camera downloads')
+    parser.add_argument('--max-frame-bytes', type=int, default=20 * 1024 * 1024,
+                        help='Largest camera image accepted, in bytes')
+    parser.add_argument('--queue-size', type=int, default=8, help='Max items waiting between two stages')
+    parser.add_argument('--daemon', action='store_true', help='Keep polling cameras instead of exiting after one pass')
+    parser.add_argument('--interval', type=float, default=60,
+                        help='Seconds between polls for cameras without an `interval` key (daemon mode)')
+    parser.add_argument('--jitter', type=float, default=0.1, help='Random extra delay as a fraction of the interval')
+    parser.add_argument('--max-backoff', type=float, default=900, help='Max seconds between polls of a failing camera')
+    parser.add_argument('--compact-days', type=float,
+                        help='In daemon mode, hourly delete detections older than this many days, '
+                             'keeping their 5-minute rollups (see the compact command)')
+    parser.add_argument('--compact-expire-days', type=float,
+                        help='With --compact-days, also delete 5-minute rollups older than this many days')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve per-stage latency metrics in the Prometheus format on localhost:PORT/metrics')
+    parser.add_argument('--metrics-file', help='Write the metrics to this file every 15 seconds and at exit')
+    parser.add_argument('--profile', nargs='+', metavar='STAGE', default=[],
+                        help='Sample the stacks of these pipeline stages (fetch, ocr, prefilter, detect, store, persist)')
+    parser.add_argument('--profile-dir', default='.', help='Where profile-<stage>.txt collapsed stacks are written')
+
+    # without a command the cameras are captured
+    commands = parser.add_subparsers(dest='command', title='commands')
+    retention = commands.add_parser('retention', help='Delete or compress full-size images older than --days',
+                                    description='Delete or compress the full-size frames of the cameras in '
+                                                '--terminals, renditions are kept')
+    retention.add_argument('--days', type=float, required=True, help='Age in days after which originals expire')
+    retention.add_argument('--action', choices=RETENTION_ACTIONS, default='compress',
+                           help='Delete expired originals or re-encode them as WebP (default: compress)')
+    retention.add_argument('--quality', type=int, default=60, help='WebP quality of compressed originals')
+    retention.add_argument('--dry-run', action='store_true', help='Only log what would be done')
+    reprocess_parser = commands.add_parser(
+        'reprocess', help='Run OCR (--ocr) and detection (--detect-trucks) again over stored frames',
+        description='Run OCR and truck detection again over stored frames in a process pool, saving the results '
+                    'to --db in batches. Progress is checkpointed, rerun the same command to resume')
+    reprocess_parser.add_argument('--camera', action='append', dest='cameras', metavar='NAME',
+                                  help='Camera to reprocess, as its full name (e.g. wando_welch_main_gate) or its '
+                                       'name in the YAML file, can be repeated (default: all)')
+    reprocess_parser.add_argument('--start', help='First UTC date to reprocess, YYYY-MM-DD')
+    reprocess_parser.add_argument('--end', help='Last UTC date to reprocess, YYYY-MM-DD')
+    reprocess_parser.add_argument('--processes', type=int, help='Worker processes (default: one per CPU)')
+    reprocess_parser.add_argument('--checkpoint', default='reprocess.checkpoint',
+                                  help='File listing the frames already reprocessed')
+    reprocess_parser.add_argument('--batch-size', type=int, default=500, help='Detection results saved per batch')
+    compact_parser = commands.add_parser(
+        'compact', help='Delete old detections of --db, keeping their 5-minute rollups',
+        description='Delete detections older than --days in small batches. Their 5-minute means, minima and maxima '
+                    'stay in the 5-minute rollups, which the dashboard reads for older ranges')
+    compact_parser.add_argument('--days', type=float, required=True, help='Age in days after which detections are '
+                                                                          'only kept as 5-minute rollups')
+    compact_parser.add_argument('--expire-days', type=float, help='Also delete 5-minute rollups older than this')
+    compact_parser.add_argument('--batch-size', type=int, default=1000, help='Rows deleted per transaction')
+    compact_parser.add_argument('--pause', type=float, default=0.05, help='Seconds to wait between batches')
+    commands.add_parser(
+        'backfill-rollups', help='Build the DynamoDB rollups of the days before DYNAMODB_ROLLUP_TABLE was set',
+        description='Rebuild the rollups of the cameras in --terminals from their raw detections, for the days '
+                    'before rollups were first written. SQL databases do this when they create their rollup tables')
+    export = commands.add_parser(
+        'export', help='Append the detections of --db to Parquet or Arrow files partitioned by camera and date',
+        description='Export the whole UTC days of detections saved since the last export to '
+                    'DIRECTORY/camera_name=<camera>/date=<YYYY-MM-DD>/, needs pyarrow')
+    export.add_argument('directory', help='Directory of the exported dataset, it keeps the export watermark')
+    export.add_argument('--format', choices=EXPORT_FORMATS, default='parquet',
+                        help='Parquet, or Arrow IPC files that can be memory-mapped (default: parquet)')
+    export.add_argument('--end', help='Last UTC date to export, YYYY-MM-DD (default: yesterday)')
     args = parser.parse_args()
+    if args.command == 'reprocess' and args.ocr == 'none' and not args.detect_trucks:
+        parser.error('reprocess needs --detect-trucks or an --ocr reader, otherwise there is nothing to redo')
 
     setup_logging(getattr(logging, args.log_level.upper()))
     logger = logging.getLogger(__name__)
 
     photo_mem = get_photo_memory(args.storage)
+    if args.command == 'retention':
+        cameras = [camera.full_name for terminal in load_terminals(args.terminals, photo_mem)
+                   for camera in terminal.cameras]
+        affected = apply_retention(photo_mem, args.days, args.action, quality=args.quality, dry_run=args.dry_run,
+                                   cameras=cameras)
+        logger.info(f"Retention: {args.action} {affected} images older than {args.days} days")
+        return
+    if args.command == 'reprocess':
+        run_reprocess(args, photo_mem)
+        return
+    if args.command == 'export':
+        run_export(args, photo_mem)
+        return
+    if args.command == 'compact':
+        run_compact(args, photo_mem)
+        return
+    if args.command == 'backfill-rollups':
+        run_backfill_rollups(args, photo_mem)
+        return
+
+    db_mem = get_db_memory(args.db)
+    spool = None
+    if args.spool:
+        # the spool batches detection rows itself, --db-batch-size just sets its batch size
+        spool = Spool(args.spool, batch_size=max(args.db_batch_size, 100), interval=args.db_flush_interval,
+                      max_attempts=args.spool_max_attempts)
+        photo_mem = SpooledPhotoMemory(photo_mem, spool)
+        db_mem = SpooledDatabaseMemory(db_mem, spool)
+    elif args.db_batch_size > 1:
+        db_mem = BufferedMemory(db_mem, max_size=args.db_batch_size, max_delay=args.db_flush_interval)
+    client = FetchClient(timeout=(3.05, args.fetch_timeout), retries=args.fetch_retries,
+                         pool_maxsize=args.fetch_workers or args.concurrency, max_bytes=args.max_frame_bytes)
+    terminals = load_terminals(args.terminals, photo_mem, client)
+    ocr = get_timestamp_reader(args.ocr, args.ocr_processes)
+    detector = get_detector(args.detect_workers or args.concurrency) if args.detect_trucks else None
+
+    cameras = [camera for terminal in terminals for camera in terminal.cameras]
+    use_prefilter = args.change_threshold > 0 or any(camera.change_threshold for camera in cameras)
+    change_detector = ChangeDetector(max_carry=args.max_carry) if use_prefilter else None
+    scheduler = Scheduler(cameras, default_interval=args.interval, jitter=args.jitter,
+                          max_backoff=args.max_backoff) if args.daemon else None
+
+    pipeline = build_capture_pipeline(
+        ocr, db_mem, detector=detector, workers=args.concurrency,
+        fetch_workers=args.fetch_workers, ocr_workers=args.ocr_workers, store_workers=args.store_workers,
+        detect_workers=args.detect_workers, persist_workers=args.persist_workers, queue_size=args.queue_size,
+        change_detector=change_detector, change_threshold=args.change_threshold,
+        on_done=scheduler.done if scheduler else None
+    )
+    if args.metrics_port:
+        REGISTRY.serve(args.metrics_port)
+    metrics_writer = REGISTRY.write_periodically(args.metrics_file) if args.metrics_file else None
+    sampler = StackSampler(args.profile) if args.profile else None
+    set_sampler(sampler)
+    compactor = None
+    if scheduler and args.compact_days and not db_mem.has_rollups:
+        logger.warning(f"not compacting, {args.db} keeps no rollups and compacting would lose the detections")
+    elif scheduler and args.compact_days:
+        compactor = Compactor(db_mem, args.compact_days, args.compact_expire_days,
+                              cameras=[camera.full_name for camera in cameras] if args.db == 'dynamodb' else None)
+
+    logger.info(f"Processing {len(cameras)} cameras across {len(terminals)} terminals")
+    try:
+        if scheduler:
+            run_daemon(scheduler, pipeline, cameras)
+        else:
+            pipeline.run(CaptureJob(camera) for camera in cameras)
+    finally:
+        if compactor:
+            compactor.stop()
+        if spool:
+            spool.close()
+        db_mem.close()
+        client.close()
+        if detector:
+            detector.close()
+        if ocr:
+            ocr.close()
+        if sampler:
+            sampler.stop()
+            sampler.dump(args.profile_dir)
+        if metrics_writer:
+            metrics_writer.set()
+            REGISTRY.write(args.metrics_file)
+
+
+def run_reprocess(args: argparse.Namespace, photo_mem) -> None:
+    logger = logging.getLogger(__name__)
+    cameras = [camera for terminal in load_terminals(args.terminals, photo_mem) for camera in terminal.cameras]
+    if args.cameras:
+        cameras = [camera for camera in cameras if camera.full_name in args.cameras or camera.name in args.cameras]
+    start_ts = utc_date_ms(args.start) if args.start else None
+    end_ts = utc_date_ms(args.end, end_of_day=True) if args.end else None
+
+    db_mem = get_db_memory(args.db)
+    checkpoint = Checkpoint(args.checkpoint)
+    try:
+        processed, failed = reprocess(
+            list_frames(photo_mem, cameras, start_ts, end_ts), db_mem, checkpoint, args.storage,
+            ocr_type=args.ocr, detect=args.detect_trucks, processes=args.processes, batch_size=args.batch_size,
+            tps=float(os.environ.get('REKOGNITION_TPS', 5)))
+    finally:
+        checkpoint.close()
+        db_mem.close()
+    logger.info(f"Reprocessed {processed} frames of {len(cameras)} cameras, {failed} failed")
+
+
+def dynamodb_cameras(args: argparse.Namespace, photo_mem) -> Optional[List[str]]:
+    """The cameras of the YAML file for DynamoDB, which would otherwise be scanned, None for SQL databases"""
+    if args.db != 'dynamodb':
+        return None
+    return [camera.full_name for terminal in load_terminals(args.terminals, photo_mem) for camera in terminal.cameras]
+
+
+def run_compact(args: argparse.Namespace, photo_mem) -> None:
+    db_mem = get_db_memory(args.db)
+    if not db_mem.has_rollups:
+        logging.getLogger(__name__).error("Set DYNAMODB_ROLLUP_TABLE, compacting without rollups would lose the "
+                                          "detections")
+        db_mem.close()
+        return
+    try:
+        compact(db_mem, args.days, args.expire_days, batch_size=args.batch_size, pause=args.pause,
+                cameras=dynamodb_cameras(args, photo_mem))
+    finally:
+        db_mem.close()
+
+
+def run_backfill_rollups(args: argparse.Namespace, photo_mem) -> None:
+    logger = logging.getLogger(__name__)
+    if args.db != 'dynamodb':
+        logger.info("SQL databases build their rollups from the raw rows when they create the rollup tables")
+        return
+    db_mem = get_db_memory(args.db)
+    if not db_mem.has_rollups:
+        logger.error("Set DYNAMODB_ROLLUP_TABLE to the rollup table to backfill")
+        db_mem.close()
+        return
+    try:
+        read = db_mem.backfill_rollups(dynamodb_cameras(args, photo_mem))
+        start = db_mem.rollups_start()
+    finally:
+        db_mem.close()
+    if start:
+        # today's buckets are still being added to, the rest of the day is rebuilt once it is over
+        day = datetime.fromtimestamp(start / 1000, timezone.utc).strftime('%Y-%m-%d')
+        logger.info(f"Backfilled rollups from {read} detections, run again on {day} (UTC) to complete them")
+    else:
+        logger.info(f"Backfilled rollups from {read} detections, they are complete")
+
+
+def run_export(args: argparse.Namespace, photo_mem) -> None:
     db_mem = get_db_memory(args.db)
-    terminals = load_terminals(args.terminals, photo_mem)
-    ocr = None if args.ocr == 'none' else Tesseract()
-
-    for terminal in terminals:
-        logger.info(f"Processing Terminal: {terminal.name}")
-        for camera in terminal.cameras:
-            camera.get()
-            camera.save_last(timestamp_reader=ocr)
-            logger.info(f"Processed CAMERA: {camera.full_name}_{camera.last_timestamp}")
-
-            if args.detect_trucks:
-                truck_count, avg_confidence = detect_trucks(camera.last_image_name,
-                                                            os.environ.get('S3_BUCKET_NAME', 'wando-warden'))
-                logger.info(f"Detected {truck_count} trucks with average confidence {avg_confidence:.2f}")
-                db_mem.save((truck_count, avg_confidence), f"{camera.full_name}|{camera.last_timestamp}|"
-                                                           f"{camera.last_ts_approx}")
+    try:
+        # a DynamoDB scan returns rows in no order, the cameras are queried one at a time instead
+        db_mem.export(args.directory, dynamodb_cameras(args, photo_mem),
+                      utc_date_ms(args.end, end_of_day=True) if args.end else None, fmt=args.format)
+    finally:
+        db_mem.close()
+
+
+def run_daemon(scheduler: Scheduler, pipeline: Pipeline, cameras: List[Camera]) -> None:
+    logger = logging.getLogger(__name__)
+
+    def report_skipped(*_):
+        skipped = {camera.full_name: camera.skipped_frames for camera in cameras}
+        logger.info(f"Skipped {sum(skipped.values())} unchanged frames: {skipped}")
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: scheduler.stop())
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, report_skipped)
+    with pipeline:
+        scheduler.run(pipeline)
+    report_skipped()
+    logger.info("Daemon stopped")
 
 
 if __name__ == "__main__":
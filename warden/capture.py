@@ -0,0 +1,127 @@
+import logging
+import time
+from typing import Optional, Tuple
+
+from warden.change import ChangeDetector
+from warden.detection import Detector
+from warden.memory import Memory
+from warden.metrics import REGISTRY, timed
+from warden.ocr import TimestampReader
+from warden.pipeline import Pipeline, Stage
+from warden.regions import PendingDetection, submit_regions
+from warden.terminal import Camera
+
+logger = logging.getLogger(__name__)
+
+DETECTION_SECONDS = REGISTRY.histogram('warden_detection_seconds',
+                                       'Time from submitting a frame for detection to its result', ('camera',))
+
+
+class CaptureJob:
+    """One pass of a camera through the capture pipeline"""
+    def __init__(self, camera: Camera):
+        self.camera = camera
+        self.detection: Optional[Tuple[int, float]] = None
+        self.pending_detection: Optional[PendingDetection] = None  # running while the frame is stored
+        self.carried_forward = False  # detection reused from the previous frame because the scene barely changed
+        self.signature = None  # change detection signature of the frame
+
+    def __repr__(self) -> str:
+        return f"CaptureJob({self.camera.full_name})"
+
+
+def build_capture_pipeline(ocr: Optional[TimestampReader], db_mem: Memory,
+                           detector: Optional[Detector] = None, workers: int = 4,
+                           fetch_workers: Optional[int] = None, ocr_workers: Optional[int] = None,
+                           store_workers: Optional[int] = None, detect_workers: Optional[int] = None,
+                           persist_workers: Optional[int] = None, queue_size: int = 8,
+                           change_detector: Optional[ChangeDetector] = None, change_threshold: float = 0,
+                           on_done=None) -> Pipeline:
+    """Wire the fetch -> ocr -> [prefilter] -> detect -> store -> persist stages for `CaptureJob`s.
+
+    Detection stages are only added with a `detector`. The detect stage hands the frame bytes to the detector
+    and moves on, so the frame is stored while detection runs and persist waits for the result.
+    The prefilter stage only runs with a `change_detector`, cameras without a `change_threshold` of their own
+    use `change_threshold`, and a threshold of 0 always detects.
+    """
+    def fetch(job: CaptureJob) -> Optional[CaptureJob]:
+        if job.camera.get() is None:
+            logger.info(f"Unchanged frame at {job.camera.full_name}, skipping "
+                        f"({job.camera.skipped_frames} skipped so far)")
+            return None
+        return job
+
+    def read(job: CaptureJob) -> CaptureJob:
+        job.camera.read_timestamp(timestamp_reader=ocr)
+        return job
+
+    def store(job: CaptureJob) -> CaptureJob:
+        camera = job.camera
+        camera.store_last()
+        logger.info(f"Processed CAMERA: {camera.full_name}_{camera.last_timestamp}")
+        return job
+
+    def prefilter(job: CaptureJob) -> CaptureJob:
+        camera = job.camera
+        threshold = camera.change_threshold if camera.change_threshold is not None else change_threshold
+        if threshold <= 0:
+            return job
+        job.signature = change_detector.signature(camera.last_frame, ignore=camera.timestamp_box_coordinates)
+        if camera.last_detection is not None and change_detector.should_carry(camera.full_name, job.signature,
+                                                                               threshold):
+            job.detection = camera.last_detection
+            job.carried_forward = True
+        return job
+
+    def detect_stage(job: CaptureJob) -> CaptureJob:
+        camera = job.camera
+        if job.carried_forward:
+            logger.info(f"Scene at {camera.full_name} barely changed, carrying forward {job.detection[0]} trucks")
+            return job
+        started = time.perf_counter()
+        job.pending_detection = submit_regions(detector, camera.last_frame, camera.detect_regions,
+                                               camera.detect_max_side)
+        job.pending_detection.add_done_callback(
+            lambda: DETECTION_SECONDS.observe(time.perf_counter() - started, camera=camera.full_name))
+        return job
+
+    def persist(job: CaptureJob) -> CaptureJob:
+        camera = job.camera
+        if job.pending_detection is not None:
+            job.detection = job.pending_detection.result()
+            camera.last_detection = job.detection
+            if job.signature is not None:
+                change_detector.update(camera.full_name, job.signature)
+            truck_count, avg_confidence = job.detection
+            logger.info(f"Detected {truck_count} trucks with average confidence {avg_confidence:.2f} "
+                        f"at {camera.full_name}")
+        db_mem.save((*job.detection, job.carried_forward), camera.last_record_name)
+        return job
+
+    stages = [
+        instrumented('fetch', fetch, fetch_workers or workers),
+        instrumented('ocr', read, ocr_workers or workers),
+    ]
+    if detector is not None and change_detector is not None:
+        stages.append(instrumented('prefilter', prefilter, detect_workers or workers))
+    if detector is not None:
+        stages.append(instrumented('detect', detect_stage, detect_workers or workers))
+    stages.append(instrumented('store', store, store_workers or workers))
+    if detector is not None:
+        # boto3 resources and db connections are not shared across threads safely, keep persist narrow
+        stages.append(instrumented('persist', persist, persist_workers or 1))
+
+    def done(job: CaptureJob, error: Optional[BaseException]) -> None:
+        if error is None:
+            job.camera.commit()  # a failed frame is fetched and processed again on the next poll
+        if on_done:
+            on_done(job, error)
+    return Pipeline(stages, queue_size=queue_size, on_done=done)
+
+
+def instrumented(name: str, func, workers: int) -> Stage:
+    """A stage that records its latency and outcome per camera in `warden.metrics`"""
+    def run(job: CaptureJob) -> Optional[CaptureJob]:
+        with timed(name, job.camera.full_name):
+            return func(job)
+    return Stage(name, run, workers)
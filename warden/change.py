@@ -0,0 +1,56 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from warden.frame import Frame
+
+
+class ChangeDetector:
+    """Tells whether a frame differs enough from the last frame detection ran on to be worth detecting again.
+
+    Frames are compared as small grayscale thumbnails with their brightness normalised, so passing clouds
+    matter less than trucks moving, and the timestamp overlay (which changes every frame) is masked out.
+    Comparing against the last *detected* frame rather than the previous one keeps slow drifts from
+    being carried forward indefinitely.
+    """
+    def __init__(self, size: int = 64, max_carry: int = 10):
+        self.size = size
+        self.max_carry = max_carry  # detect anyway after this many carried forward frames in a row
+        self._references: Dict[str, np.ndarray] = {}
+        self._carried: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def signature(self, frame: Frame, ignore: Optional[Tuple[int, int, int, int]] = None) -> np.ndarray:
+        thumb = frame.thumbnail(self.size)
+        signature = np.asarray(thumb, dtype=np.float32) / 255
+        if ignore is not None:
+            scale_x, scale_y = thumb.width / frame.size[0], thumb.height / frame.size[1]
+            left, upper, right, bottom = ignore
+            signature = signature.copy()
+            signature[int(upper * scale_y):int(np.ceil(bottom * scale_y)),
+                      int(left * scale_x):int(np.ceil(right * scale_x))] = 0
+        return signature - signature.mean()
+
+    def difference(self, name: str, signature: np.ndarray) -> Optional[float]:
+        """Mean absolute difference to the reference of camera `name`, None if there is nothing to compare"""
+        with self._lock:
+            reference = self._references.get(name)
+        if reference is None or reference.shape != signature.shape:
+            return None
+        return float(np.abs(signature - reference).mean())
+
+    def should_carry(self, name: str, signature: np.ndarray, threshold: float) -> bool:
+        """Whether the last detection of `name` can be reused for a frame with this `signature`"""
+        difference = self.difference(name, signature)
+        with self._lock:
+            if difference is None or difference >= threshold or self._carried.get(name, 0) >= self.max_carry:
+                return False
+            self._carried[name] = self._carried.get(name, 0) + 1
+            return True
+
+    def update(self, name: str, signature: np.ndarray) -> None:
+        """Make `signature` the reference of `name`, call it after detection ran on the frame"""
+        with self._lock:
+            self._references[name] = signature
+            self._carried[name] = 0
@@ -1,49 +1,84 @@
 import logging
 import os
-from typing import Union
+from typing import Optional, Union
 
-from warden.memory import LocalPhotoMemory, S3PhotoMemory, MySQLMemory, PostgreSQLMemory, DynamoDBMemory, SQLiteMemory
+from warden.detection import Detector, TruckDetector
+from warden.ocr import TimestampReader, Tesseract, GlyphReader, OCRPool
+from warden.memory import (LocalPhotoMemory, S3PhotoMemory, CachedPhotoMemory, MySQLMemory, PostgreSQLMemory,
+                           DynamoDBMemory, SQLiteMemory)
 
 
 def setup_logging(level: int = logging.INFO) -> None:
     logging.basicConfig(level=level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 
-def get_photo_memory(storage_type: str) -> Union[LocalPhotoMemory, S3PhotoMemory]:
+def get_photo_memory(storage_type: str) -> Union[LocalPhotoMemory, S3PhotoMemory, CachedPhotoMemory]:
+    """S3 images are read through a local disk cache when PHOTO_CACHE_DIR is set"""
     if storage_type == 'local':
         return LocalPhotoMemory(os.environ.get('LOCAL_STORAGE_PATH', './images'))
     elif storage_type == 's3':
-        return S3PhotoMemory(
+        memory = S3PhotoMemory(
             bucket_name=os.environ.get('S3_BUCKET_NAME', 'wando-warden'),
             region_name=os.environ.get('AWS_REGION', 'us-east-1')
         )
+        if os.environ.get('PHOTO_CACHE_DIR'):
+            memory = CachedPhotoMemory(memory, os.environ['PHOTO_CACHE_DIR'],
+                                       max_bytes=int(os.environ.get('PHOTO_CACHE_MAX_BYTES', 1024 ** 3)))
+        return memory
     else:
         raise ValueError(f"Unsupported storage type: {storage_type}")
 
 
+def get_timestamp_reader(ocr_type: str, processes: int = 0) -> Optional[TimestampReader]:
+    """`processes` > 0 runs Tesseract in a pool of that many long-lived worker processes"""
+    if ocr_type == 'none':
+        return None
+    tesseract = OCRPool(Tesseract, workers=processes) if processes > 0 else Tesseract()
+    if ocr_type == 'tesseract':
+        return tesseract
+    elif ocr_type == 'glyph':
+        return GlyphReader(fallback=tesseract, template_dir=os.environ.get('GLYPH_TEMPLATE_DIR', './glyphs'))
+    else:
+        raise ValueError(f"Unsupported ocr type: {ocr_type}")
+
+
+def get_detector(workers: int = 4, tps: Optional[float] = None) -> Detector:
+    """Set REKOGNITION_ENDPOINT_URL to point the detector at a local stub of the Rekognition API"""
+    return TruckDetector(
+        region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+        endpoint_url=os.environ.get('REKOGNITION_ENDPOINT_URL') or None,
+        workers=workers,
+        tps=tps if tps is not None else float(os.environ.get('REKOGNITION_TPS', 5))
+    )
+
+
 def get_db_memory(db_type: str) -> Union[SQLiteMemory, MySQLMemory, PostgreSQLMemory, DynamoDBMemory]:
     if db_type == 'sqlite':
         if SQLiteMemory.import_failed:
             raise ImportError('sqlite could not be imported')
-        return SQLiteMemory(os.environ.get('SQLITE_DB_PATH', 'truck_detections.db'))
+        return SQLiteMemory(os.environ.get('SQLITE_DB_PATH', 'truck_detections.db'),
+                            pool_size=int(os.environ.get('DB_POOL_SIZE', 4)))
     elif db_type == 'mysql':
         return MySQLMemory(
             host=os.environ.get('MYSQL_HOST', 'localhost'),
             user=os.environ.get('MYSQL_USER'),
             password=os.environ.get('MYSQL_PASSWORD'),
-            database=os.environ.get('MYSQL_DATABASE', 'warden')
+            database=os.environ.get('MYSQL_DATABASE', 'warden'),
+            pool_size=int(os.environ.get('DB_POOL_SIZE', 4))
         )
     elif db_type == 'postgres':
         return PostgreSQLMemory(
             host=os.environ.get('POSTGRES_HOST', 'localhost'),
             user=os.environ.get('POSTGRES_USER'),
             password=os.environ.get('POSTGRES_PASSWORD'),
-            database=os.environ.get('POSTGRES_DATABASE', 'warden')
+            database=os.environ.get('POSTGRES_DATABASE', 'warden'),
+            pool_size=int(os.environ.get('DB_POOL_SIZE', 4))
         )
     elif db_type == 'dynamodb':
         return DynamoDBMemory(
             table_name=os.environ.get('DYNAMODB_TABLE', 'ww_truck_detections'),
-            region_name=os.environ.get('AWS_REGION', 'us-east-1')
+            region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+            rollup_table_name=os.environ.get('DYNAMODB_ROLLUP_TABLE')
         )
     else:
         raise ValueError(f"Unsupported database type: {db_type}")
@@ -1,27 +1,268 @@
-from typing import Tuple
+import io
+import logging
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from PIL import Image
 
+from warden.metrics import REGISTRY
 
-def detect_trucks(photo: str, bucket: str, max_labels=40) -> Tuple[int, float]:
-    client = boto3.client('rekognition', region_name='us-east-1')
+logger = logging.getLogger(__name__)
+
+# error codes Rekognition answers with when we go over the account's TPS quota or it is overloaded
+THROTTLING_CODES = {'ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException',
+                    'ServiceUnavailableException', 'InternalServerError'}
+REKOGNITION_SECONDS = REGISTRY.histogram('warden_rekognition_seconds', 'Latency of Rekognition DetectLabels calls')
+REKOGNITION_THROTTLES = REGISTRY.counter('warden_rekognition_throttles_total',
+                                         'Rekognition calls retried after throttling', ('code',))
+DETECTION_CACHE = REGISTRY.counter('warden_detection_cache_total', 'Detector cache lookups', ('result',))
+# Rekognition accepts at most 5 MB of JPEG or PNG bytes inline
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+INLINE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n')
+
+
+class Instance(NamedTuple):
+    """One detected truck, as ratios of the image detection ran on or in pixels once mapped to a frame"""
+    left: float
+    top: float
+    width: float
+    height: float
+    confidence: float
+
+
+def truck_instances(response: dict) -> List[Instance]:
+    """The truck instances of a DetectLabels response filtered on trucks"""
+    if len(response['Labels']) == 0:
+        return []
+    instances = []
+    for instance in response['Labels'][0]['Instances']:
+        box = instance.get('BoundingBox', {})
+        instances.append(Instance(box.get('Left', 0.0), box.get('Top', 0.0), box.get('Width', 0.0),
+                                  box.get('Height', 0.0), instance['Confidence']))
+    return instances
+
+
+def summarize(instances: List[Instance]) -> Tuple[int, float]:
+    """Truck count and average confidence"""
+    truck_count = len(instances)
+    avg_confidence = sum(instance.confidence for instance in instances) / truck_count if truck_count > 0 else 0
+    return truck_count, avg_confidence
+
+
+def count_trucks(response: dict) -> Tuple[int, float]:
+    """Truck count and average confidence of a DetectLabels response filtered on trucks"""
+    return summarize(truck_instances(response))
+
+
+def detect_trucks(photo: str, bucket: str, max_labels=40, client=None) -> Tuple[int, float]:
+    if client is None:
+        client = boto3.client('rekognition', region_name='us-east-1')
     response = client.detect_labels(
         Image={'S3Object': {'Bucket': bucket, 'Name': photo}},
         MaxLabels=max_labels,
         Features=["GENERAL_LABELS", "IMAGE_PROPERTIES"],
         Settings={"GeneralLabels": {"LabelInclusionFilters": ["Truck"]}}
     )
+    return count_trucks(response)
 
-    if len(response['Labels']) == 0:
-        return 0, 0
 
-    trucks = response['Labels'][0]
-    truck_count = len(trucks['Instances'])
-    avg_confidence = sum(instance['Confidence'] for instance in trucks['Instances']) / truck_count if truck_count > 0 else 0
+def inline_image(data: bytes, max_bytes: int = MAX_IMAGE_BYTES) -> bytes:
+    """`data` as Rekognition accepts it inline, re-encoded to a JPEG that fits `max_bytes` if it is not one already"""
+    data = bytes(data)  # botocore only sends bytes, a memoryview of a cached image is copied here and not before
+    if len(data) <= max_bytes and data.startswith(INLINE_SIGNATURES):
+        return data
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=90)
+        if buffer.tell() <= max_bytes:
+            return buffer.getvalue()
+        image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.BILINEAR)
 
-    return truck_count, avg_confidence
+
+class Detector(ABC):
+    """Finds trucks in an encoded image, subclass it to plug in another model"""
+    @abstractmethod
+    def detect_instances(self, data: bytes, digest: Optional[str] = None) -> List[Instance]:
+        """Trucks with boxes as ratios of the image, `digest` identifies the content of `data` for caching"""
+        pass
+
+    def submit_instances(self, data: bytes, digest: Optional[str] = None) -> 'Future[List[Instance]]':
+        """Start detecting and return a future, detectors that run in the background override this"""
+        future = Future()
+        try:
+            future.set_result(self.detect_instances(data, digest))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def detect(self, data: bytes, digest: Optional[str] = None) -> Tuple[int, float]:
+        """Truck count and average confidence"""
+        return summarize(self.submit_instances(data, digest).result())
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> 'Detector':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class TokenBucket:
+    """Hands out `rate` tokens per second, allowing bursts of up to `capacity` tokens"""
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available and take it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class TruckDetector(Detector):
+    """Counts trucks with Rekognition through one long-lived client.
+
+    Images are sent inline as bytes, so detection does not wait for the frame to be uploaded anywhere.
+
+    Calls run on a pool of `workers` threads and are held to `tps` requests per second by a token bucket.
+    Throttled calls are retried with jittered exponential backoff, and the bucket rate is halved on every
+    throttle and recovers gradually, so the detector settles just under whatever quota the account has.
+    Results are cached by image content digest, so identical frames are never sent twice.
+    Pass `client` or `endpoint_url` to run against a stub of the Rekognition API.
+    """
+    def __init__(self, client=None, region_name: str = 'us-east-1', endpoint_url: Optional[str] = None,
+                 workers: int = 4, tps: float = 5.0, max_retries: int = 5, max_backoff: float = 20.0,
+                 cache_size: int = 256, max_labels: int = 40):
+        if client is None:
+            # retries are ours, so botocore's own must not multiply them
+            client = boto3.client('rekognition', region_name=region_name, endpoint_url=endpoint_url,
+                                  config=Config(retries={'mode': 'standard', 'max_attempts': 1},
+                                                max_pool_connections=workers))
+        self.client = client
+        self.tps = tps
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.cache_size = cache_size
+        self.max_labels = max_labels
+        self._bucket = TokenBucket(tps)
+        self._cache: 'OrderedDict[str, List[Instance]]' = OrderedDict()
+        self._pending: Dict[str, Future] = {}  # digest -> running detection, so concurrent duplicates share it
+        self._cache_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='detect')
+
+    def _cached(self, digest: Optional[str], count: bool = True) -> Optional[List[Instance]]:
+        if digest is None:
+            return None
+        with self._cache_lock:
+            result = self._cache.get(digest)
+            if result is not None:
+                self._cache.move_to_end(digest)
+        if count:
+            DETECTION_CACHE.inc(result='miss' if result is None else 'hit')
+        return result
+
+    def _remember(self, digest: Optional[str], result: List[Instance]) -> None:
+        if digest is None or self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[digest] = result
+            self._cache.move_to_end(digest)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _throttled(self) -> None:
+        self._bucket.rate = max(self.tps / 16, self._bucket.rate / 2)
+
+    def _succeeded(self) -> None:
+        if self._bucket.rate < self.tps:
+            self._bucket.rate = min(self.tps, self._bucket.rate + self.tps / 10)
+
+    def _detect_labels(self, image: dict) -> dict:
+        for attempt in range(self.max_retries + 1):
+            self._bucket.acquire()
+            try:
+                with REKOGNITION_SECONDS.time():
+                    response = self.client.detect_labels(
+                        Image=image,
+                        MaxLabels=self.max_labels,
+                        Features=["GENERAL_LABELS", "IMAGE_PROPERTIES"],
+                        Settings={"GeneralLabels": {"LabelInclusionFilters": ["Truck"]}}
+                    )
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code not in THROTTLING_CODES or attempt == self.max_retries:
+                    raise
+                REKOGNITION_THROTTLES.inc(code=code)
+                self._throttled()
+                delay = random.uniform(0, min(self.max_backoff, 0.5 * 2 ** attempt))
+                logger.warning(f"Rekognition answered {code}, retrying in {delay:.2f}s "
+                               f"at {self._bucket.rate:.2f} requests/s")
+                time.sleep(delay)
+            else:
+                self._succeeded()
+                return response
+
+    def _run(self, data: bytes, digest: Optional[str]) -> List[Instance]:
+        result = self._cached(digest, count=False)  # a concurrent detection of the same frame may have finished
+        if result is not None:
+            return result
+        result = truck_instances(self._detect_labels({'Bytes': inline_image(data)}))
+        self._remember(digest, result)
+        return result
+
+    def submit_instances(self, data: bytes, digest: Optional[str] = None) -> 'Future[List[Instance]]':
+        result = self._cached(digest)
+        if result is not None:
+            future = Future()
+            future.set_result(result)
+            return future
+        if digest is None:
+            return self._executor.submit(self._run, data, digest)
+        with self._cache_lock:
+            future = self._pending.get(digest)
+            if future is not None:
+                return future
+            future = self._pending[digest] = self._executor.submit(self._run, data, digest)
+        # outside the lock, the callback runs right away if the detection already finished
+        future.add_done_callback(lambda _: self._forget_pending(digest))
+        return future
+
+    def _forget_pending(self, digest: str) -> None:
+        with self._cache_lock:
+            self._pending.pop(digest, None)
+
+    def detect_instances(self, data: bytes, digest: Optional[str] = None) -> List[Instance]:
+        return self.submit_instances(data, digest).result()
+
+    def close(self) -> None:
+        self._executor.shutdown()
 
 
 if __name__ == '__main__':
-    tc, ac = detect_trucks('wando_welch_main_gate_2024-07-09_14:17:10.jpg', 'wando-warden')
+    import sys
+
+    with open(sys.argv[1], 'rb') as f, TruckDetector() as detector:
+        tc, ac = detector.detect(f.read())
     print(f'trucks: {tc} | avg. conf. {ac:.2f}')
@@ -0,0 +1,59 @@
+from typing import Callable, Dict
+
+import numpy as np
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of `threshold` points of a series sorted by `x`, picked with Largest-Triangle-Three-Buckets.
+
+    The first and last points are kept. The points in between are split into `threshold - 2` buckets, and each
+    bucket keeps the point forming the largest triangle with the point kept before it and the mean of the next
+    bucket, which preserves peaks and the overall shape far better than taking every nth point.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)  # bucket i is [edges[i], edges[i + 1])
+    starts, ends = edges[:-1], edges[1:]
+    # bucket means from cumulative sums, so each is computed in O(1)
+    cx = np.concatenate(([0.0], np.cumsum(x)))
+    cy = np.concatenate(([0.0], np.cumsum(y)))
+    mean_x = (cx[ends] - cx[starts]) / (ends - starts)
+    mean_y = (cy[ends] - cy[starts]) / (ends - starts)
+    # the last bucket looks ahead to the last point
+    next_x = np.append(mean_x[1:], x[-1])
+    next_y = np.append(mean_y[1:], y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        xs, ys = x[starts[i]:ends[i]], y[starts[i]:ends[i]]
+        # twice the triangle area, the constant factor does not change the argmax
+        area = np.abs((x[a] - next_x[i]) * (ys - y[a]) - (x[a] - xs) * (next_y[i] - y[a]))
+        a = starts[i] + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def minmax(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indices of at most `threshold` points of a series sorted by `x`: the lowest and highest point of
+    `threshold // 2` equal-count buckets, so no spike or dip is ever dropped"""
+    n = len(y)
+    if threshold >= n or threshold < 2:
+        return np.arange(n)
+    buckets = threshold // 2
+    bucket = np.arange(n) * buckets // n
+    bounds = np.searchsorted(bucket, np.arange(buckets + 1))
+    # sorting by bucket then value keeps each bucket at its own positions, lowest value first
+    order = np.lexsort((np.asarray(y), bucket))
+    return np.unique(np.concatenate((order[bounds[:-1]], order[bounds[1:] - 1])))
+
+
+DOWNSAMPLERS: Dict[str, Callable[[np.ndarray, np.ndarray, int], np.ndarray]] = {
+    'lttb': lttb,
+    'minmax': minmax,
+}
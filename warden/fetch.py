@@ -0,0 +1,50 @@
+from typing import Mapping, NamedTuple, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class FrameTooLarge(ValueError):
+    """The server sent more bytes than the client allows for one frame"""
+
+
+class FetchResult(NamedTuple):
+    status_code: int
+    headers: Mapping[str, str]
+    content: bytes
+
+
+class FetchClient:
+    """HTTP client shared by cameras, keeping a keep-alive connection pool per host"""
+    def __init__(self, timeout: Union[float, Tuple[float, float]] = (3.05, 15), retries: int = 2,
+                 backoff_factor: float = 0.5, pool_maxsize: int = 10, max_bytes: int = 20 * 1024 * 1024,
+                 chunk_size: int = 64 * 1024):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'HEAD']))
+        # pool_maxsize is per host, it should cover every fetch worker hitting the same origin at once
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url: str, headers: Optional[Mapping[str, str]] = None) -> FetchResult:
+        """GET `url`, streaming the body and raising `FrameTooLarge` past `max_bytes`"""
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as resp:
+            resp.raise_for_status()
+            length = resp.headers.get('Content-Length')
+            if length and length.isdigit() and int(length) > self.max_bytes:
+                raise FrameTooLarge(f"{url} is {length} bytes, more than the {self.max_bytes} allowed")
+
+            body = bytearray()
+            for chunk in resp.iter_content(self.chunk_size):
+                body += chunk
+                if len(body) > self.max_bytes:
+                    raise FrameTooLarge(f"{url} sent more than the {self.max_bytes} bytes allowed")
+            return FetchResult(resp.status_code, resp.headers, bytes(body))
+
+    def close(self) -> None:
+        self.session.close()
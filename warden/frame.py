@@ -0,0 +1,71 @@
+import hashlib
+import io
+from typing import Optional, Tuple
+
+from PIL import Image
+
+
+class Frame:
+    """An encoded camera image that is only decoded as far as a caller needs"""
+    def __init__(self, data: bytes, content_type: str = 'image/jpeg'):
+        self.data = data
+        self.content_type = content_type
+        self.digest = hashlib.sha256(data).hexdigest()
+        self._image: Optional[Image.Image] = None
+        self._size: Optional[Tuple[int, int]] = None
+
+    def _open(self) -> Image.Image:
+        return Image.open(io.BytesIO(self.data))
+
+    @property
+    def decoded(self) -> bool:
+        return self._image is not None
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """Width and height, read from the header without decoding any pixels"""
+        if self._size is None:
+            self._size = self._image.size if self._image is not None else self._open().size
+        return self._size
+
+    @property
+    def image(self) -> Image.Image:
+        """The full frame decoded to RGB, cached after the first call"""
+        if self._image is None:
+            image = self._open()
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            self._image = image
+        return self._image
+
+    def region(self, box: Tuple[int, int, int, int], mode: str = 'L') -> Image.Image:
+        """Crop `box` (left, upper, right, bottom) without building a full RGB frame.
+
+        The whole frame is still decoded at full resolution, PIL cannot decode part of a JPEG and a smaller
+        scale would blur the text read from crops. JPEGs are decoded straight to `mode` though, so a grayscale
+        crop skips chroma upsampling and colour conversion of the frame.
+        """
+        if self._image is not None:
+            region = self._image.crop(box)
+            return region.convert(mode) if region.mode != mode else region
+        image = self._open()
+        if image.format == 'JPEG':
+            image.draft(mode, image.size)
+        region = image.crop(box)
+        return region.convert(mode) if region.mode != mode else region
+
+    def thumbnail(self, max_side: int, mode: str = 'L') -> Image.Image:
+        """A frame scaled down to fit `max_side`, using reduced DCT decoding for JPEGs"""
+        if self._image is not None:
+            image = self._image.convert(mode) if self._image.mode != mode else self._image.copy()
+        else:
+            image = self._open()
+            if image.format == 'JPEG':
+                # draft picks the smallest 1/2, 1/4 or 1/8 scale that is still at least the requested size
+                width, height = image.size
+                scale = max_side / max(width, height)
+                image.draft(mode, (max(1, int(width * scale)), max(1, int(height * scale))))
+            if image.mode != mode:
+                image = image.convert(mode)
+        image.thumbnail((max_side, max_side))
+        return image
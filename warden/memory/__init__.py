@@ -1,3 +1,6 @@
-from warden.memory.base import Memory
+from warden.memory.base import Memory, PhotoMemory, DatabaseMemory
 from warden.memory.image import LocalPhotoMemory, S3PhotoMemory
 from warden.memory.sql import MySQLMemory, PostgreSQLMemory, DynamoDBMemory, SQLiteMemory
+from warden.memory.buffer import BufferedMemory
+from warden.memory.cache import CachedPhotoMemory
+from warden.memory.spool import Spool, SpooledPhotoMemory, SpooledDatabaseMemory
@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
-from typing import Generic, TypeVar, Tuple
+from typing import Any, Dict, Generic, Iterable, Iterator, List, Optional, Set, TypeVar, Tuple
 
 T = TypeVar('T')
+# camera_name, timestamp, truck_count, avg_confidence, ts_approx, carried_forward
+DetectionRow = Tuple[str, int, int, float, bool, bool]
+DetectionKey = Tuple[str, int]  # camera_name, timestamp
 
 
 class Memory(ABC, Generic[T]):
@@ -14,17 +17,187 @@ class Memory(ABC, Generic[T]):
     def load(self, name: str) -> T:
         pass
 
+    def close(self) -> None:
+        """Release connections or flush buffers, the memory should not be used afterwards"""
+        pass
+
+
+CONTENT_TYPE_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/webp': '.webp',
+}
+
+
+class PhotoMemory(Memory[T], ABC):
+    """Memory for images, which can also store the encoded bytes exactly as they were received"""
+    @abstractmethod
+    def save_bytes(self, data: bytes, name: str, content_type: str = 'image/jpeg') -> None:
+        pass
+
+    @abstractmethod
+    def load_bytes(self, name: str) -> bytes:
+        pass
+
+    @abstractmethod
+    def list_names(self, prefix: str = '', older_than: Optional[float] = None) -> Iterator[str]:
+        """Stream the names of saved images starting with `prefix`, optionally only those last written
+        before the UNIX time `older_than`"""
+        pass
+
+    @abstractmethod
+    def delete(self, name: str) -> None:
+        pass
+
+    def delete_many(self, names: Iterable[str]) -> None:
+        for name in names:
+            self.delete(name)
+
+    @staticmethod
+    def _with_extension(name: str, content_type: str = 'image/jpeg') -> str:
+        if not name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
+            name += CONTENT_TYPE_EXTENSIONS.get(content_type, '.jpg')
+        return name
+
 
 class DatabaseMemory(Memory[Tuple[int, float]], ABC):
+    """Memory for truck detection results, saved under `camera|timestamp|approx` names"""
     @abstractmethod
     def _create_table(self):
         pass
 
     @abstractmethod
+    def _insert_many(self, rows: List[DetectionRow]) -> None:
+        pass
+
     def save(self, obj: Tuple[int, float], name: str) -> None:
+        self.save_many([(obj, name)])
+
+    def save_many(self, items: Iterable[Tuple[Tuple, str]]) -> None:
+        """Save many `(truck_count, avg_confidence[, carried_forward]), name` pairs in one batch.
+
+        `carried_forward` marks a count reused from the camera's previous frame instead of detected again.
+        """
+        rows = []
+        for detection, name in items:
+            truck_count, avg_confidence, *carried_forward = detection
+            camera_name, timestamp, ts_approx = self._parse_name(name)
+            rows.append((camera_name, timestamp, truck_count, avg_confidence, ts_approx, any(carried_forward)))
+        if rows:
+            self._write(rows)
+
+    def _write(self, rows: List[DetectionRow]) -> None:
+        """Persist parsed rows, wrappers override this to defer or redirect the write"""
+        self._insert_many(rows)
+
+    def replace_many(self, items: Iterable[Tuple[DetectionKey, DetectionRow]]) -> None:
+        """Save rows in place of the rows saved under old `(camera_name, timestamp)` keys, in one batch.
+
+        A row already saved under a new row's own key is replaced as well, so replacing the same rows twice
+        leaves the same result.
+        Replaced rows are taken out of the rollups too, so saving a frame again never counts it twice. A row
+        with a `truck_count` of None keeps the count, confidence and `carried_forward` of the row it replaces, under
+        its own key.
+        """
+        items = list(items)
+        if items:
+            self._replace_many(items)
+
+    @abstractmethod
+    def _replace_many(self, items: List[Tuple[DetectionKey, DetectionRow]]) -> None:
         pass
 
+    @staticmethod
+    def _replaced_keys(items: List[Tuple[DetectionKey, DetectionRow]]) -> List[DetectionKey]:
+        """The old keys of `items` and their new ones, whose rows are replaced. The new key may hold the row of an
+        earlier replacement, e.g. when a frame is reprocessed again after OCR read a different timestamp"""
+        return list(dict.fromkeys(key for old_key, (camera_name, timestamp, *_) in items
+                                  for key in (old_key, (camera_name, timestamp))))
+
+    @staticmethod
+    def _replacements(items: List[Tuple[DetectionKey, DetectionRow]],
+                      replaced: List[DetectionRow]) -> List[DetectionRow]:
+        """The rows to save for `items`, given the `replaced` rows that are saved under their keys"""
+        saved = {(row[0], int(row[1])): row for row in replaced}
+        rows = []
+        for key, (camera_name, timestamp, truck_count, avg_confidence, ts_approx, carried_forward) in items:
+            if truck_count is None:
+                old = saved.get(key) or saved.get((camera_name, timestamp))
+                if old is None:
+                    continue  # nothing to move to the new timestamp
+                truck_count, avg_confidence, carried_forward = old[2], old[3], old[5]
+            rows.append((camera_name, timestamp, truck_count, avg_confidence, ts_approx, carried_forward))
+        return rows
+
     @abstractmethod
     def load(self, name: str) -> Tuple[int, float]:
         pass
 
+    @abstractmethod
+    def query_range(self, start_ts: int, end_ts: int,
+                    cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        """Stream the detections between two UNIX ms timestamps (inclusive), optionally only for some cameras"""
+        pass
+
+    @abstractmethod
+    def query_rollups(self, granularity: str, start_ts: int, end_ts: int,
+                      cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        """Stream the per-camera 'day', 'hour' or '5min' rollups whose buckets start between two UNIX ms timestamps"""
+        pass
+
+    @property
+    def has_rollups(self) -> bool:
+        """Whether `query_rollups` can be used, and raw rows compacted into the rollups"""
+        return True
+
+    def rollups_start(self) -> Optional[int]:
+        """UNIX ms from which `query_rollups` covers every saved detection, earlier ones need `query_range`.
+        None without rollups"""
+        return 0  # SQL backends fill their rollup tables from the raw rows when they create them
+
+    @abstractmethod
+    def _delete_before(self, granularity: Optional[str], cutoff: int, limit: int,
+                       cameras: Optional[Iterable[str]] = None) -> int:
+        """Delete up to `limit` raw rows, or rollups of `granularity`, older than UNIX ms `cutoff`, returns how many.
+
+        Raw rows are only deleted once they are covered by the rollups, see `rollups_start`.
+        """
+        pass
+
+    def existing_keys(self, rows: Iterable[DetectionRow]) -> Set[Tuple[str, int]]:
+        """The `(camera_name, timestamp)` keys of `rows` that are already saved, one range query per camera"""
+        spans: Dict[str, List[int]] = {}
+        for camera_name, timestamp, *_ in rows:
+            span = spans.setdefault(camera_name, [timestamp, timestamp])
+            span[0], span[1] = min(span[0], timestamp), max(span[1], timestamp)
+        existing = set()
+        for camera_name, (start_ts, end_ts) in spans.items():
+            existing.update((row['camera_name'], row['timestamp'])
+                            for row in self.query_range(start_ts, end_ts, [camera_name]))
+        return existing
+
+    def export(self, directory: str, cameras: Optional[Iterable[str]] = None, end_ts: Optional[int] = None,
+               fmt: str = 'parquet') -> Tuple[int, int]:
+        """Append the whole UTC days saved since the last export to Parquet or Arrow files, see `export_detections`"""
+        from warden.memory.export import export_detections  # pyarrow is only imported when exporting
+        return export_detections(self, directory, cameras, end_ts, fmt)
+
+    @staticmethod
+    def _row_dict(camera_name: str, timestamp, truck_count, avg_confidence, ts_approx,
+                  carried_forward) -> Dict[str, Any]:
+        return {
+            'camera_name': camera_name,
+            'timestamp': int(timestamp),
+            'truck_count': int(truck_count),
+            'avg_confidence': float(avg_confidence),
+            'ts_approx': bool(ts_approx),
+            'carried_forward': bool(carried_forward),
+        }
+
+    @staticmethod
+    def _parse_name(name: str) -> Tuple[str, int, bool]:
+        """Split a `camera|timestamp|approx` name, as built by `Camera.last_record_name`, `approx` is optional"""
+        parts = name.split('|')
+        ts_approx = len(parts) > 2 and parts[2].lower() == 'true'
+        return parts[0], int(parts[1]), ts_approx
+
@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from warden.memory.base import DatabaseMemory, DetectionKey, DetectionRow
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedMemory(DatabaseMemory):
+    """Collects detection rows in memory and writes them to `inner` in batches.
+
+    A batch is flushed once it holds `max_size` rows or its oldest row is `max_delay` seconds old.
+    """
+    def __init__(self, inner: DatabaseMemory, max_size: int = 100, max_delay: float = 5.0):
+        self.inner = inner
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._rows: List[DetectionRow] = []
+        self._oldest = 0.0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_periodically, name='db-flusher', daemon=True)
+        self._flusher.start()
+
+    def _create_table(self):
+        pass  # `inner` created its own tables
+
+    def _insert_many(self, rows: List[DetectionRow]) -> None:
+        self.inner._insert_many(rows)
+
+    @property
+    def has_rollups(self) -> bool:
+        return self.inner.has_rollups
+
+    def rollups_start(self) -> Optional[int]:
+        return self.inner.rollups_start()
+
+    def _delete_before(self, granularity: Optional[str], cutoff: int, limit: int,
+                       cameras: Optional[Iterable[str]] = None) -> int:
+        return self.inner._delete_before(granularity, cutoff, limit, cameras)
+
+    def _replace_many(self, items: List[Tuple[DetectionKey, DetectionRow]]) -> None:
+        self.flush()  # the rows being replaced may still be waiting here
+        self.inner._replace_many(items)
+
+    def _write(self, rows: List[DetectionRow]) -> None:
+        with self._cond:
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.extend(rows)
+            if len(self._rows) >= self.max_size:
+                self._cond.notify()
+
+    def flush(self) -> bool:
+        """Write out every buffered row, returns False and keeps the rows if the write failed"""
+        with self._cond:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return True
+        try:
+            self.inner._write(rows)
+        except Exception:
+            logger.exception(f"failed to flush {len(rows)} detection rows, keeping them for the next flush")
+            with self._cond:
+                self._rows[:0] = rows
+                self._oldest = time.monotonic()
+            return False
+        return True
+
+    def _flush_periodically(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed and len(self._rows) < self.max_size and (
+                        not self._rows or time.monotonic() - self._oldest < self.max_delay):
+                    timeout = self.max_delay - (time.monotonic() - self._oldest) if self._rows else None
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+            if not self.flush():
+                with self._cond:  # back off instead of hammering a failing backend
+                    self._cond.wait(self.max_delay)
+
+    def load(self, name: str) -> Tuple[int, float, bool]:
+        self.flush()
+        return self.inner.load(name)
+
+    def query_range(self, start_ts: int, end_ts: int,
+                    cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        self.flush()
+        return self.inner.query_range(start_ts, end_ts, cameras)
+
+    def query_rollups(self, granularity: str, start_ts: int, end_ts: int,
+                      cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        self.flush()
+        return self.inner.query_rollups(granularity, start_ts, end_ts, cameras)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._flusher.join()
+        self.flush()
+        self.inner.close()
@@ -0,0 +1,193 @@
+import hashlib
+import io
+import logging
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, Iterator, Optional
+
+from PIL import Image
+
+from warden.memory.base import Memory, PhotoMemory
+from warden.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PHOTO_CACHE = REGISTRY.counter('warden_photo_cache_total', 'Photo cache hits, misses and evictions', ('event',))
+
+
+class CachedPhotoMemory(PhotoMemory[Image.Image]):
+    """Read-through LRU disk cache in front of another image memory, usually `S3PhotoMemory`.
+
+    Images are stored once per content digest under `directory/objects`, and a SQLite index maps names to
+    digests and keeps their last access time. Once the cache is over `max_bytes`, the least recently read
+    images are evicted. Cached files are memory-mapped, so PIL decodes straight from the page cache.
+    The index survives restarts. `hits`, `misses` and `evictions` count cache activity, and are exported as
+    `warden_photo_cache_total` too.
+    """
+    def __init__(self, inner: Memory[Image.Image], directory: str, max_bytes: int = 1024 ** 3,
+                 cache_writes: bool = False):
+        self.inner = inner
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.cache_writes = cache_writes  # also cache images as they are saved, not only when read
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        # only used under `_lock`, so it can be shared between threads
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, digest TEXT NOT NULL)')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS objects (
+                    digest TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_objects_last_access ON objects (last_access)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_names_digest ON names (digest)')
+        self._size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def _lookup(self, name: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute('SELECT digest FROM names WHERE name = ?', (name,)).fetchone()
+            if row is None or not os.path.exists(self._path(row[0])):
+                self.misses += 1
+                PHOTO_CACHE.inc(event='miss')
+                return None
+            self.hits += 1
+            PHOTO_CACHE.inc(event='hit')
+            with self._conn:
+                self._conn.execute('UPDATE objects SET last_access = ? WHERE digest = ?', (time.time(), row[0]))
+            return row[0]
+
+    def _store(self, name: str, data: bytes) -> None:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so readers never map a half written image
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        with self._lock, self._conn:
+            known = self._conn.execute('SELECT 1 FROM objects WHERE digest = ?', (digest,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO objects (digest, size, last_access) VALUES (?, ?, ?)',
+                               (digest, len(data), time.time()))
+            self._conn.execute('INSERT OR REPLACE INTO names (name, digest) VALUES (?, ?)', (name, digest))
+            if known is None:
+                self._size += len(data)
+            self._evict()
+
+    def _evict(self) -> None:
+        """Drop the least recently read images until the cache fits `max_bytes`, call with `_lock` held"""
+        while self._size > self.max_bytes:
+            row = self._conn.execute('SELECT digest, size FROM objects ORDER BY last_access LIMIT 1').fetchone()
+            if row is None:
+                break
+            digest, size = row
+            self._conn.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+            self._conn.execute('DELETE FROM names WHERE digest = ?', (digest,))
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            self.evictions += 1
+            PHOTO_CACHE.inc(event='eviction')
+
+    def _fetch(self, name: str) -> bytes:
+        if isinstance(self.inner, PhotoMemory):
+            return self.inner.load_bytes(name)
+        buffer = io.BytesIO()
+        self.inner.load(name).save(buffer, 'PNG')  # lossless, so cached reads match the inner memory
+        return buffer.getvalue()
+
+    def _read(self, name: str):
+        """A read-only map of the cached image, or its bytes if it was not cached yet"""
+        digest = self._lookup(name)
+        if digest is not None:
+            try:
+                with open(self._path(digest), 'rb') as file:
+                    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                pass  # evicted by another thread since the lookup
+        data = self._fetch(name)
+        self._store(name, data)
+        return data
+
+    def load(self, name: str) -> Image.Image:
+        cached = self._read(name)
+        if isinstance(cached, bytes):
+            return Image.open(io.BytesIO(cached))
+        try:
+            image = Image.open(cached)
+            image.load()  # decode before the map is closed
+        finally:
+            cached.close()
+        return image
+
+    def load_bytes(self, name: str) -> memoryview:
+        """A read-only view of the image bytes, without copying a cached image out of its memory map.
+
+        The map stays open for as long as the view or a slice of it is referenced, and is closed once they are
+        released or garbage collected. Evicting the image meanwhile only unlinks its file, the view stays valid.
+        Use `bytes(view)` to keep a copy that outlives it.
+        """
+        return memoryview(self._read(name))
+
+    def save(self, obj: Image.Image, name: str) -> None:
+        self.inner.save(obj, name)
+        self._forget(self._with_extension(name))
+
+    def save_bytes(self, data: bytes, name: str, content_type: str = 'image/jpeg') -> None:
+        if not isinstance(self.inner, PhotoMemory):
+            raise TypeError(f"{type(self.inner).__name__} cannot save encoded bytes")
+        self.inner.save_bytes(data, name, content_type)
+        name = self._with_extension(name, content_type)
+        if self.cache_writes:
+            self._store(name, data)
+        else:
+            self._forget(name)
+
+    def _forget(self, name: str) -> None:
+        """Drop a name whose image was overwritten, its content stays until evicted"""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM names WHERE name = ?', (name,))
+
+    def list_names(self, prefix: str = '', older_than: Optional[float] = None) -> Iterator[str]:
+        return self.inner.list_names(prefix, older_than)
+
+    def delete(self, name: str) -> None:
+        self.inner.delete(name)
+        self._forget(name)
+
+    def delete_many(self, names: Iterable[str]) -> None:
+        names = list(names)
+        self.inner.delete_many(names)
+        for name in names:
+            self._forget(name)
+
+    @property
+    def size(self) -> int:
+        """Bytes of images in the cache"""
+        return self._size
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': self._size,
+                'max_bytes': self.max_bytes}
+
+    def close(self) -> None:
+        logger.info(f"photo cache stats: {self.stats()}")
+        with self._lock:
+            self._conn.close()
+        self.inner.close()
@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from warden.memory.base import DatabaseMemory
+
+logger = logging.getLogger(__name__)
+
+# raw rows live on in these rollups once they are compacted, as means, minima and maxima
+COMPACTED_GRANULARITY = '5min'
+DAY_MS = 86_400_000
+
+
+def _delete_all(db_mem: DatabaseMemory, granularity: Optional[str], cutoff: int, batch_size: int, pause: float,
+                cameras: Optional[List[str]], stop: Optional[threading.Event]) -> int:
+    deleted = 0
+    while True:
+        count = db_mem._delete_before(granularity, cutoff, batch_size, cameras)
+        deleted += count
+        if count < batch_size:
+            return deleted
+        # let the capture pipeline's writes in between batches
+        if stop is None:
+            time.sleep(pause)
+        elif stop.wait(pause):
+            return deleted
+
+
+def compact(db_mem: DatabaseMemory, days: float, expire_days: Optional[float] = None, batch_size: int = 1000,
+            pause: float = 0.05, cameras: Optional[Iterable[str]] = None,
+            stop: Optional[threading.Event] = None) -> Tuple[int, int]:
+    """Delete raw detections older than `days`, and 5-minute rollups older than `expire_days`.
+
+    Every saved detection is also added to the 5-minute rollups, so deleting raw rows leaves their means and
+    maxima queryable with `query_rollups('5min', ...)`. Rows are deleted `batch_size` at a time, each batch
+    in its own short transaction, so writers are never locked out for long. Returns (raw rows, rollups) deleted.
+    """
+    cameras = list(cameras) if cameras is not None else None
+    now_ms = int(time.time() * 1000)
+    covered = db_mem.rollups_start()
+    if covered is None:
+        raise ValueError(f"{type(db_mem).__name__} keeps no rollups, compacting would lose the detections")
+    if covered:
+        logger.warning(f"detections before {covered} are not in the rollups yet, they are kept until the rollups "
+                       f"are backfilled")
+    raw = _delete_all(db_mem, None, now_ms - int(days * DAY_MS), batch_size, pause, cameras, stop)
+    rollups = 0
+    if expire_days is not None and not (stop is not None and stop.is_set()):
+        rollups = _delete_all(db_mem, COMPACTED_GRANULARITY, now_ms - int(expire_days * DAY_MS), batch_size, pause,
+                              cameras, stop)
+    logger.info(f"Compacted {raw} detections older than {days} days"
+                + (f", expired {rollups} {COMPACTED_GRANULARITY} rollups" if expire_days is not None else ''))
+    return raw, rollups
+
+
+class Compactor:
+    """Runs `compact` every `interval` seconds in a background thread, until `stop`"""
+    def __init__(self, db_mem: DatabaseMemory, days: float, expire_days: Optional[float] = None,
+                 interval: float = 3600.0, **options):
+        self.db_mem = db_mem
+        self.days = days
+        self.expire_days = expire_days
+        self.interval = interval
+        self.options = options
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='compactor', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                compact(self.db_mem, self.days, self.expire_days, stop=self._stop, **self.options)
+            except Exception:
+                logger.exception("compaction failed, retrying on the next run")
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self) -> None:
+        """Stop after the batch being deleted, if any"""
+        self._stop.set()
+        self._thread.join()
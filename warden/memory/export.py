@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from warden.memory.base import DatabaseMemory
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+WATERMARK_FILE = '_watermark.json'
+DAY_MS = 86_400_000
+
+# camera_name and date are the partition directories, not columns of the files
+SCHEMA = pa.schema([
+    ('timestamp', pa.timestamp('ms', tz='UTC')),
+    ('truck_count', pa.int32()),
+    ('avg_confidence', pa.float64()),
+    ('ts_approx', pa.bool_()),
+    ('carried_forward', pa.bool_()),
+]) if pa is not None else None
+
+
+def read_watermark(directory: str) -> Optional[int]:
+    """UNIX ms of the last detection covered by the exports in `directory`, None before the first export"""
+    try:
+        with open(os.path.join(directory, WATERMARK_FILE)) as file:
+            return json.load(file)['timestamp']
+    except FileNotFoundError:
+        return None
+
+
+def write_watermark(directory: str, timestamp: int) -> None:
+    _write_atomically(os.path.join(directory, WATERMARK_FILE), lambda path: _write_json(path, {'timestamp': timestamp}))
+
+
+def _write_json(path: str, obj: Dict[str, Any]) -> None:
+    with open(path, 'w') as file:
+        json.dump(obj, file)
+
+
+def _write_atomically(path: str, write) -> None:
+    """Write a file through a temporary sibling, so readers never see half of it"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def partition_path(directory: str, camera_name: str, date: str) -> str:
+    return os.path.join(directory, f"camera_name={camera_name}", f"date={date}")
+
+
+def _write_partition(directory: str, camera_name: str, date: str, rows: List[Dict[str, Any]], fmt: str) -> str:
+    table = pa.table({
+        'timestamp': [row['timestamp'] for row in rows],
+        'truck_count': [row['truck_count'] for row in rows],
+        'avg_confidence': [row['avg_confidence'] for row in rows],
+        'ts_approx': [row['ts_approx'] for row in rows],
+        'carried_forward': [row['carried_forward'] for row in rows],
+    }, schema=SCHEMA)
+    # named after the first timestamp, so an export that is run again after a crash replaces its files
+    name = f"part-{rows[0]['timestamp']}{EXPORT_FORMATS[fmt]}"
+    path = os.path.join(partition_path(directory, camera_name, date), name)
+
+    def write(tmp_path: str) -> None:
+        if fmt == 'parquet':
+            pq.write_table(table, tmp_path, compression='zstd')
+        else:
+            with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, SCHEMA) as writer:
+                writer.write_table(table)
+
+    _write_atomically(path, write)
+    return path
+
+
+def export_detections(db_mem: DatabaseMemory, directory: str, cameras: Optional[Iterable[str]] = None,
+                      end_ts: Optional[int] = None, fmt: str = 'parquet', max_rows: int = 1_000_000) -> Tuple[int, int]:
+    """Append the detections saved since the last export to `directory`, returns (rows, files) written.
+
+    Files are laid out as `camera_name=<camera>/date=<YYYY-MM-DD>/part-<first ms>.parquet`, hive partitioning
+    that `pyarrow.dataset` and most query engines read directly, or as Arrow IPC files with `fmt='arrow'`,
+    which can be memory-mapped. Only whole UTC days are exported, by default up to yesterday, and the last one
+    is remembered in `_watermark.json`, so every run adds the days that were completed since the previous one.
+    """
+    if pa is None:
+        raise ImportError('pyarrow is needed to export detections, pip install pyarrow')
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt}, expected one of {', '.join(EXPORT_FORMATS)}")
+    if end_ts is None:
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        end_ts = now_ms - now_ms % DAY_MS - 1
+    else:
+        end_ts = (end_ts + 1) - (end_ts + 1) % DAY_MS - 1  # round down to the end of a whole day
+    watermark = read_watermark(directory)
+    start_ts = 0 if watermark is None else watermark + 1
+    if start_ts > end_ts:
+        logger.info(f"Nothing to export to {directory}, it is up to date")
+        return 0, 0
+
+    rows_written = files_written = 0
+    current: Optional[Tuple[str, str]] = None
+    rows: List[Dict[str, Any]] = []
+
+    def flush() -> None:
+        nonlocal rows_written, files_written
+        if rows:
+            path = _write_partition(directory, current[0], current[1], rows, fmt)
+            logger.debug(f"exported {len(rows)} detections to {path}")
+            rows_written += len(rows)
+            files_written += 1
+            rows.clear()
+
+    # query_range returns each camera in timestamp order, so a partition is complete once the next one starts
+    for row in db_mem.query_range(start_ts, end_ts, cameras):
+        date = datetime.fromtimestamp(row['timestamp'] / 1000, timezone.utc).strftime('%Y-%m-%d')
+        key = (row['camera_name'], date)
+        if key != current or len(rows) >= max_rows:
+            flush()
+            current = key
+        rows.append(row)
+    flush()
+
+    write_watermark(directory, end_ts)
+    logger.info(f"Exported {rows_written} detections in {files_written} files to {directory}")
+    return rows_written, files_written
@@ -1,15 +1,15 @@
 import os
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 from io import BytesIO
 
 from PIL import Image
 import boto3
 from botocore.exceptions import ClientError
 
-from warden.memory.base import Memory
+from warden.memory.base import PhotoMemory
 
 
-class LocalPhotoMemory(Memory[Image.Image]):
+class LocalPhotoMemory(PhotoMemory[Image.Image]):
     """Save and load images to the local filesystem"""
     def __init__(self, directory: str):
         self.directory = directory
@@ -22,6 +22,12 @@ class LocalPhotoMemory(Memory[Image.Image]):
         file_path = os.path.join(self.directory, name)
         obj.save(file_path)
 
+    def save_bytes(self, data: bytes, name: str, content_type: str = 'image/jpeg') -> None:
+        file_path = os.path.join(self.directory, self._with_extension(name, content_type))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)  # renditions are saved in subdirectories
+        with open(file_path, 'wb') as file:
+            file.write(data)
+
     def load(self, name: str) -> Image.Image:
         file_path = os.path.join(self.directory, name)
         if not os.path.exists(file_path):
@@ -29,8 +35,29 @@ class LocalPhotoMemory(Memory[Image.Image]):
 
         return Image.open(file_path)
 
+    def load_bytes(self, name: str) -> bytes:
+        file_path = os.path.join(self.directory, name)
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"No file found at {file_path}")
+
+        with open(file_path, 'rb') as file:
+            return file.read()
 
-class S3PhotoMemory(Memory[Image.Image]):
+    def list_names(self, prefix: str = '', older_than: Optional[float] = None) -> Iterator[str]:
+        for root, _, files in os.walk(self.directory):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                name = os.path.relpath(file_path, self.directory).replace(os.sep, '/')
+                if not name.startswith(prefix):
+                    continue
+                if older_than is None or os.stat(file_path).st_mtime < older_than:
+                    yield name
+
+    def delete(self, name: str) -> None:
+        os.remove(os.path.join(self.directory, name))
+
+
+class S3PhotoMemory(PhotoMemory[Image.Image]):
     """Save and load images to/from Amazon S3"""
     def __init__(self, bucket_name: str, aws_access_key_id: Optional[str] = None,
                  aws_secret_access_key: Optional[str] = None, region_name: Optional[str] = None):
@@ -56,7 +83,18 @@ class S3PhotoMemory(Memory[Image.Image]):
             print(f"An error occurred while uploading to S3: {e}")
             raise
 
+    def save_bytes(self, data: bytes, name: str, content_type: str = 'image/jpeg') -> None:
+        try:
+            self.s3.put_object(Bucket=self.bucket_name, Key=self._with_extension(name, content_type), Body=data,
+                               ContentType=content_type)
+        except ClientError as e:
+            print(f"An error occurred while uploading to S3: {e}")
+            raise
+
     def load(self, name: str) -> Image.Image:
+        return Image.open(BytesIO(self.load_bytes(name)))
+
+    def load_bytes(self, name: str) -> bytes:
         buffer = BytesIO()
         try:
             self.s3.download_fileobj(self.bucket_name, name, buffer)
@@ -67,5 +105,22 @@ class S3PhotoMemory(Memory[Image.Image]):
                 print(f"An error occurred while downloading from S3: {e}")
                 raise
 
-        buffer.seek(0)
-        return Image.open(buffer)
+        return buffer.getvalue()
+
+    def list_names(self, prefix: str = '', older_than: Optional[float] = None) -> Iterator[str]:
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if older_than is None or obj['LastModified'].timestamp() < older_than:
+                    yield obj['Key']
+
+    def delete(self, name: str) -> None:
+        self.s3.delete_object(Bucket=self.bucket_name, Key=name)
+
+    def delete_many(self, names: Iterable[str]) -> None:
+        names = list(names)
+        for start in range(0, len(names), 1000):  # DeleteObjects takes at most 1000 keys
+            response = self.s3.delete_objects(Bucket=self.bucket_name, Delete={
+                'Objects': [{'Key': name} for name in names[start:start + 1000]], 'Quiet': True})
+            for error in response.get('Errors', []):
+                print(f"An error occurred while deleting {error['Key']} from S3: {error['Message']}")
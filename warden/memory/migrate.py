@@ -1,43 +1,178 @@
+"""Import historical truck detections from a JSON export into any detection database.
+
+    python -m warden.memory.migrate truck_detections.txt --db dynamodb
+
+The input is a JSON array (or a stream of JSON objects) of `camera_name`, `timestamp`, `truck_count` and
+`avg_confidence` records. Timestamps are either UTC ms or US/Eastern `2024-07-09_14:17:10[_approx]` strings.
+"""
+import argparse
+import calendar
 import json
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Set, TextIO, Tuple, Union
+
 import pytz
-import boto3
-from decimal import Decimal
-
-
-def convert_est_to_utc_timestamp(est_timestamp_str):
-    est_tz = pytz.timezone('America/New_York')  # EST timezone
-    # Remove '_approx' from the timestamp string if present
-    est_timestamp_str = est_timestamp_str.replace('_approx', '')
-    est_datetime = datetime.strptime(est_timestamp_str, '%Y-%m-%d_%H:%M:%S')
-    est_datetime = est_tz.localize(est_datetime)  # Localize the datetime to EST
-    utc_datetime = est_datetime.astimezone(pytz.UTC)  # Convert to UTC
-    return int(utc_datetime.timestamp() * 1000)  # Convert to milliseconds
-
-
-# Initialize DynamoDB client
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-table = dynamodb.Table('ww_truck_detections')
-
-# Read the JSON data
-with open('truck_detections.txt', 'r') as file:
-    data = json.load(file)
-
-# Insert each item into DynamoDB
-for item in data:
-    timestamp = item['timestamp']
-    ts_approx = '_approx' in timestamp
-    utc_timestamp = convert_est_to_utc_timestamp(timestamp)
-
-    dynamodb_item = {
-        'camera_name': item['camera_name'],
-        'timestamp': utc_timestamp,
-        'truck_count': item['truck_count'],
-        'avg_confidence': Decimal(str(item['avg_confidence'])),
-        'ts_approx': ts_approx
-    }
-
-    table.put_item(Item=dynamodb_item)
-    print(f"Inserted item: {item['camera_name']} at {utc_timestamp}")
-
-print("All items inserted successfully!")
+
+from warden.memory.base import DatabaseMemory, DetectionRow
+
+logger = logging.getLogger(__name__)
+
+EASTERN = pytz.timezone('America/New_York')
+
+
+def iter_json_objects(file: TextIO, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """Yield the objects of a JSON array, or of whitespace separated JSON objects, reading `chunk_size` at a time"""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    while True:
+        # skip the array brackets and separators between objects
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[]':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                return
+            buffer, position = file.read(chunk_size), 0
+            eof = not buffer
+            continue
+        try:
+            obj, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # the object continues in the next chunk
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield obj
+        position = end
+
+
+class EasternTimestamps:
+    """Parses `YYYY-MM-DD_HH:MM:SS[_approx]` US/Eastern strings to UTC ms, much faster than `strptime` per row.
+
+    Fields are sliced out of the fixed-width string, and the UTC offset is looked up once per local hour,
+    since DST only ever changes on the hour.
+    """
+    def __init__(self):
+        self._offsets: Dict[Tuple[int, int, int, int], int] = {}
+
+    def _offset(self, year: int, month: int, day: int, hour: int) -> int:
+        key = (year, month, day, hour)
+        offset = self._offsets.get(key)
+        if offset is None:
+            # is_dst=False like `convert_est_to_utc_timestamp`, ambiguous fall-back hours resolve to standard time
+            local = EASTERN.localize(datetime(year, month, day, hour), is_dst=False)
+            offset = self._offsets[key] = int(local.utcoffset().total_seconds())
+        return offset
+
+    def parse(self, value: Union[str, int, float]) -> Tuple[int, bool]:
+        """UTC ms timestamp and approx flag"""
+        if isinstance(value, (int, float)):
+            return int(value), False
+        year, month, day = int(value[0:4]), int(value[5:7]), int(value[8:10])
+        hour, minute, second = int(value[11:13]), int(value[14:16]), int(value[17:19])
+        seconds = calendar.timegm((year, month, day, hour, minute, second)) - self._offset(year, month, day, hour)
+        return seconds * 1000, value.endswith('_approx')
+
+    def parse_many(self, values: Iterable[Union[str, int, float]]) -> List[Tuple[int, bool]]:
+        return [self.parse(value) for value in values]
+
+
+def to_rows(records: List[dict], timestamps: EasternTimestamps) -> List[DetectionRow]:
+    parsed = timestamps.parse_many(record['timestamp'] for record in records)
+    return [(record['camera_name'], timestamp, int(record['truck_count']), float(record['avg_confidence']), approx,
+             False) for record, (timestamp, approx) in zip(records, parsed)]
+
+
+def migrate(records: Iterable[dict], db_mem: DatabaseMemory, batch_size: int = 500, workers: int = 4,
+            skip_existing: bool = True) -> Tuple[int, int]:
+    """Write detection records to `db_mem` in batches from `workers` threads. Returns (written, skipped).
+
+    With `skip_existing`, rows whose camera and timestamp are already saved, or were already seen in this import,
+    are left out, so rerunning an import neither duplicates rows nor counts them twice in the rollups.
+    """
+    timestamps = EasternTimestamps()
+    written = skipped = 0
+    records = iter(records)
+    # keys claimed by a batch, so a key repeated in two batches written at the same time is written by one of them
+    seen: Set[Tuple[str, int]] = set()
+    seen_lock = threading.Lock()
+
+    def write(rows: List[DetectionRow]) -> Tuple[int, int]:
+        if skip_existing:
+            unique: Dict[Tuple[str, int], DetectionRow] = {}
+            with seen_lock:
+                for row in rows:
+                    if (row[0], row[1]) not in seen:
+                        seen.add((row[0], row[1]))
+                        unique[(row[0], row[1])] = row
+            existing = db_mem.existing_keys(unique.values())
+            new_rows = [row for key, row in unique.items() if key not in existing]
+        else:
+            new_rows = rows
+        if new_rows:
+            db_mem._write(new_rows)
+        return len(new_rows), len(rows) - len(new_rows)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='migrate') as executor:
+        in_flight: Set[Future] = set()
+
+        def collect(done: Iterable[Future]) -> None:
+            nonlocal written, skipped
+            for future in done:
+                in_flight.discard(future)
+                batch_written, batch_skipped = future.result()
+                written += batch_written
+                skipped += batch_skipped
+
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            in_flight.add(executor.submit(write, to_rows(batch, timestamps)))
+            if len(in_flight) >= workers * 2:  # keep every worker busy without reading the whole file ahead
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+                logger.info(f"{written} rows written, {skipped} skipped, "
+                            f"{written / (time.monotonic() - start):.0f} rows/s")
+        collect(list(in_flight))
+    return written, skipped
+
+
+def main() -> None:
+    # imported here so importing this module does not pull in every backend's configuration
+    from warden.config import get_db_memory, setup_logging
+
+    parser = argparse.ArgumentParser(description='Import historical truck detections into a detection database')
+    parser.add_argument('input', help='JSON export of truck detections, e.g. truck_detections.txt')
+    parser.add_argument('--db', choices=['sqlite', 'mysql', 'postgres', 'dynamodb'], default='dynamodb',
+                        help='Database to import into')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows written per batch')
+    parser.add_argument('--workers', type=int, default=4, help='Threads writing batches concurrently')
+    parser.add_argument('--no-skip-existing', dest='skip_existing', action='store_false',
+                        help='Write every row, even if it is already in the database')
+    parser.add_argument('--log-level', default='INFO', help='Logging level')
+    args = parser.parse_args()
+
+    setup_logging(getattr(logging, args.log_level.upper()))
+    db_mem = get_db_memory(args.db)
+    try:
+        with open(args.input) as file:
+            written, skipped = migrate(iter_json_objects(file), db_mem, batch_size=args.batch_size,
+                                       workers=args.workers, skip_existing=args.skip_existing)
+    finally:
+        db_mem.close()
+    logger.info(f"Imported {written} detections, skipped {skipped} duplicates")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import io
+import posixpath
+from typing import Dict, Mapping, NamedTuple, Optional, Sequence, Union
+
+from warden.frame import Frame
+
+
+class Rendition(NamedTuple):
+    """A scaled down copy of a frame, saved next to the original"""
+    max_side: int
+    quality: int = 80
+    format: str = 'WEBP'
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.format.lower()}"
+
+
+RENDITIONS = {
+    'thumb': Rendition(320, quality=70),
+    'medium': Rendition(1280, quality=80),
+}
+
+
+def rendition_name(name: str, key: str) -> str:
+    """`thumb/<name without extension>` for a rendition `key` of the image saved as `name`"""
+    return f"{key}/{posixpath.splitext(name)[0]}"
+
+
+def render(frame: Frame, rendition: Rendition) -> bytes:
+    image = frame.thumbnail(rendition.max_side, mode='RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, rendition.format, quality=rendition.quality)
+    return buffer.getvalue()
+
+
+def parse_renditions(spec: Optional[Union[Sequence[str], Mapping[str, Union[int, Mapping]]]]) -> Dict[str, Rendition]:
+    """Renditions from the `renditions` key of a camera in terminals.yaml, none if it is missing.
+
+    The key is either a list of rendition names, or a mapping of names to a `max_side` or to the
+    `max_side`/`quality` of that rendition, e.g. `{thumb: 240, medium: {max_side: 960, quality: 75}}`.
+    """
+    if spec is None:
+        return {}
+    if not isinstance(spec, Mapping):
+        return {key: RENDITIONS[key] for key in spec}
+    renditions = {}
+    for key, options in spec.items():
+        default = RENDITIONS[key]
+        if isinstance(options, Mapping):
+            renditions[key] = default._replace(**options)
+        else:
+            renditions[key] = default._replace(max_side=int(options))
+    return renditions
@@ -0,0 +1,79 @@
+import io
+import logging
+import posixpath
+import re
+import time
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
+
+from PIL import Image
+
+from warden.memory.base import PhotoMemory
+
+logger = logging.getLogger(__name__)
+
+RETENTION_ACTIONS = ('delete', 'compress')
+# originals saved by a camera, `<camera>|<utc ms>|<approx>.jpg` or the legacy
+# `<camera>_2024-07-09_14:17:10[_approx].jpg`, renditions live under `thumb/` or `medium/` and never match
+FRAME_NAME = re.compile(r'^(?P<camera>[^/]+?)(?:\|\d+\|(?:true|false)|_\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}(?:_approx)?)'
+                        r'\.(?:jpe?g|png|webp)$', re.IGNORECASE)
+
+
+def expired_originals(memory: PhotoMemory, days: float, action: str = 'delete',
+                      cameras: Optional[Iterable[str]] = None) -> Iterator[str]:
+    """Full-size frames last written more than `days` ago, of `cameras` or of any camera.
+
+    Only names following the frame naming scheme are expired, renditions and anything else in the storage are left
+    alone. With `cameras`, only their prefixes are listed instead of the whole storage.
+    """
+    cutoff = time.time() - days * 86_400
+    if cameras is None:
+        listings = [(None, memory.list_names(older_than=cutoff))]
+    else:
+        listings = [(camera, memory.list_names(prefix=camera, older_than=cutoff)) for camera in cameras]
+    for camera, names in listings:
+        for name in names:
+            match = FRAME_NAME.match(name)
+            if match is None or (camera is not None and match.group('camera') != camera):
+                continue  # not a frame, or a frame of another camera sharing the prefix
+            if action == 'compress' and name.lower().endswith('.webp'):
+                continue  # already compressed
+            yield name
+
+
+def compress(memory: PhotoMemory, name: str, quality: int = 60) -> bool:
+    """Replace the image `name` by a WebP encoding of it, returns False if it could not be decoded"""
+    try:
+        image = Image.open(io.BytesIO(memory.load_bytes(name))).convert('RGB')
+    except (OSError, Image.DecompressionBombError) as e:  # OSError covers unidentified and truncated images
+        logger.warning(f"skipping {name}, it could not be decoded: {e}")
+        return False
+    buffer = io.BytesIO()
+    image.save(buffer, 'WEBP', quality=quality)
+    memory.save_bytes(buffer.getvalue(), posixpath.splitext(name)[0], 'image/webp')
+    memory.delete(name)
+    return True
+
+
+def apply_retention(memory: PhotoMemory, days: float, action: str = 'delete', quality: int = 60,
+                    dry_run: bool = False, batch_size: int = 1000, cameras: Optional[Iterable[str]] = None) -> int:
+    """Delete, or re-encode as WebP, the originals older than `days`. Returns how many images were affected"""
+    if action not in RETENTION_ACTIONS:
+        raise ValueError(f"Unsupported retention action: {action}")
+    names = expired_originals(memory, days, action, cameras)
+    affected = 0
+    while True:
+        batch: List[str] = list(islice(names, batch_size))
+        if not batch:
+            break
+        if dry_run:
+            for name in batch:
+                logger.info(f"would {action} {name}")
+            affected += len(batch)
+        elif action == 'delete':
+            memory.delete_many(batch)
+            affected += len(batch)
+        else:
+            affected += sum(compress(memory, name, quality) for name in batch)  # undecodable images are skipped
+        logger.info(f"{action} {'(dry run) ' if dry_run else ''}{affected} images so far")
+    return affected
@@ -0,0 +1,72 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from warden.memory.base import DetectionRow
+
+# bucket width in ms, coarsest first, buckets are aligned to UTC
+GRANULARITIES = {
+    'day': 86_400_000,
+    'hour': 3_600_000,
+    '5min': 300_000,  # what compaction keeps of raw rows once they are deleted
+}
+
+# camera_name, bucket, samples, sum_truck_count, min_truck_count, max_truck_count, sum_confidence, carried
+RollupRow = Tuple[str, int, int, int, int, int, float, int]
+
+
+def bucket_start(timestamp: int, granularity: str) -> int:
+    width = GRANULARITIES[granularity]
+    return timestamp - timestamp % width
+
+
+def aggregate(rows: Iterable[DetectionRow],
+              granularities: Iterable[str] = GRANULARITIES) -> Dict[str, List[RollupRow]]:
+    """Fold detection rows into one partial rollup row per camera and bucket, for each granularity.
+
+    Partials merge associatively (add samples and sums, min the mins, max the maxes), so backends can
+    apply them on top of whatever is already stored.
+    """
+    granularities = list(granularities)
+    partials: Dict[Tuple[str, str, int], List] = {}
+    for camera_name, timestamp, truck_count, avg_confidence, _, carried_forward in rows:
+        for granularity in granularities:
+            key = (granularity, camera_name, bucket_start(timestamp, granularity))
+            partial = partials.get(key)
+            if partial is None:
+                partials[key] = [1, truck_count, truck_count, truck_count, avg_confidence, int(carried_forward)]
+            else:
+                partial[0] += 1
+                partial[1] += truck_count
+                partial[2] = min(partial[2], truck_count)
+                partial[3] = max(partial[3], truck_count)
+                partial[4] += avg_confidence
+                partial[5] += int(carried_forward)
+
+    merged: Dict[str, List[RollupRow]] = {granularity: [] for granularity in granularities}
+    for (granularity, camera_name, bucket), partial in partials.items():
+        merged[granularity].append((camera_name, bucket, *partial))
+    return merged
+
+
+def rollup_dict(camera_name: str, bucket, samples, sum_truck_count, min_truck_count, max_truck_count,
+                sum_confidence, carried) -> dict:
+    """A stored rollup as served by `query_rollups`, with means instead of sums. `carried` of the `samples` are
+    counts carried forward from a previous frame rather than detected"""
+    samples = int(samples)
+    return {
+        'camera_name': camera_name,
+        'timestamp': int(bucket),
+        'samples': samples,
+        'truck_count': float(sum_truck_count) / samples,
+        'min_truck_count': int(min_truck_count),
+        'max_truck_count': int(max_truck_count),
+        'avg_confidence': float(sum_confidence) / samples,
+        'carried': int(carried or 0),
+    }
+
+
+def choose_granularity(start_ts: int, end_ts: int, min_points: int = 48) -> Optional[str]:
+    """The coarsest granularity that still gives a series `min_points` buckets, None means use the raw rows"""
+    for granularity, width in GRANULARITIES.items():
+        if (end_ts - start_ts) / width >= min_points:
+            return granularity
+    return None
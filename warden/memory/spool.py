@@ -0,0 +1,341 @@
+import io
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+from warden.memory.base import DatabaseMemory, DetectionKey, DetectionRow, PhotoMemory
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolEntry(NamedTuple):
+    id: int
+    target: str
+    key: str  # entries with the same target and key are written in order, usually the camera name
+    name: str
+    content_type: str
+    payload: bytes
+
+
+class Sink(NamedTuple):
+    write: Callable
+    batch: bool  # `write` takes a list of entries instead of one entry
+
+
+class Spool:
+    """Durable write-behind queue in a local SQLite file.
+
+    Writes are appended to the spool and return as soon as they are on local disk. A background thread drains
+    them in batches to the sink registered for their target, retrying failures with exponential backoff.
+    Entries with the same target and key are always written in the order they were appended: once one fails,
+    later ones wait for it. Entries still spooled when the process stops are drained after the next start.
+    An entry that failed `max_attempts` times is moved to the `spool_dead` table, so it stops holding up its key.
+    """
+    def __init__(self, path: str, batch_size: int = 100, interval: float = 1.0, max_backoff: float = 300.0,
+                 max_attempts: int = 10):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._sinks: Dict[str, Sink] = {}
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()  # one flush at a time, or entries would be written twice
+        self._cond = threading.Condition()
+        self._closed = False
+        # only used under `_lock`, so it can be shared between threads
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')  # survives the process dying, not the machine
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS spool (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    target TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    content_type TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL DEFAULT 0
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_spool_target_key ON spool (target, key, id)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_spool_name ON spool (target, name)')
+            # entries that kept failing, kept for inspection or to be spooled again by hand
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS spool_dead (
+                    id INTEGER PRIMARY KEY,
+                    target TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    content_type TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    error TEXT NOT NULL,
+                    failed_at REAL NOT NULL
+                )
+            ''')
+        self._flusher = threading.Thread(target=self._flush_periodically, name='spool-flusher', daemon=True)
+
+    def register(self, target: str, write: Callable, batch: bool = False) -> None:
+        """Drain entries of `target` with `write`, which takes a list of entries if `batch`, otherwise one"""
+        self._sinks[target] = Sink(write, batch)
+        if not self._flusher.is_alive() and not self._closed:
+            self._flusher.start()
+
+    def append(self, target: str, key: str, name: str, payload: bytes, content_type: str = '') -> None:
+        self.append_many(target, [(key, name, payload, content_type)])
+
+    def append_many(self, target: str, items: Iterable[Tuple[str, str, bytes, str]]) -> None:
+        """Spool `key, name, payload, content_type` items for `target` in one transaction"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO spool (target, key, name, payload, content_type) VALUES (?, ?, ?, ?, ?)',
+                [(target, key, name, payload, content_type) for key, name, payload, content_type in items])
+        with self._cond:
+            self._cond.notify()
+
+    def pending(self, target: Optional[str] = None) -> int:
+        with self._lock:
+            if target is None:
+                return self._conn.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+            return self._conn.execute('SELECT COUNT(*) FROM spool WHERE target = ?', (target,)).fetchone()[0]
+
+    def dead(self, target: Optional[str] = None) -> int:
+        """How many entries were given up on after `max_attempts`"""
+        with self._lock:
+            if target is None:
+                return self._conn.execute('SELECT COUNT(*) FROM spool_dead').fetchone()[0]
+            return self._conn.execute('SELECT COUNT(*) FROM spool_dead WHERE target = ?', (target,)).fetchone()[0]
+
+    def find(self, target: str, name: str) -> Optional[SpoolEntry]:
+        """The newest entry of `target` saved under `name` that has not been written yet"""
+        with self._lock:
+            row = self._conn.execute('''
+                SELECT id, target, key, name, content_type, payload FROM spool
+                WHERE target = ? AND name = ? ORDER BY id DESC LIMIT 1
+            ''', (target, name)).fetchone()
+        return SpoolEntry(*row) if row else None
+
+    def _ready(self, target: str) -> List[SpoolEntry]:
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute('''
+                SELECT id, target, key, name, content_type, payload FROM spool s
+                WHERE target = ? AND next_attempt <= ? AND NOT EXISTS (
+                    -- an older entry of the same key is waiting out its backoff, keep the order
+                    SELECT 1 FROM spool p WHERE p.target = s.target AND p.key = s.key AND p.id < s.id
+                    AND p.next_attempt > ?
+                )
+                ORDER BY id LIMIT ?
+            ''', (target, now, now, self.batch_size)).fetchall()
+        return [SpoolEntry(*row) for row in rows]
+
+    def _done(self, entries: List[SpoolEntry]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany('DELETE FROM spool WHERE id = ?', [(entry.id,) for entry in entries])
+
+    def _failed(self, entries: List[SpoolEntry], error: str) -> None:
+        """Back off the failed entries and every later entry of their keys, or give up on them after
+        `max_attempts`"""
+        now = time.time()
+        with self._lock, self._conn:
+            for entry in entries:
+                attempts = 1 + self._conn.execute('SELECT attempts FROM spool WHERE id = ?',
+                                                  (entry.id,)).fetchone()[0]
+                if attempts >= self.max_attempts:
+                    self._conn.execute('''
+                        INSERT INTO spool_dead (id, target, key, name, content_type, payload, attempts, error, failed_at)
+                        SELECT id, target, key, name, content_type, payload, ?, ?, ? FROM spool WHERE id = ?
+                    ''', (attempts, error, now, entry.id))
+                    self._conn.execute('DELETE FROM spool WHERE id = ?', (entry.id,))
+                    logger.warning(f"giving up on spooled {entry.target} entry {entry.name} after {attempts} "
+                                   f"attempts, moved it to spool_dead in {self.path}: {error}")
+                    continue
+                delay = min(self.max_backoff, self.interval * 2 ** min(attempts - 1, 16))
+                self._conn.execute('UPDATE spool SET attempts = ?, next_attempt = ? WHERE id = ?',
+                                   (attempts, now + delay, entry.id))
+
+    def _flush_target(self, target: str, sink: Sink) -> int:
+        entries = self._ready(target)
+        if not entries:
+            return 0
+        if sink.batch:
+            try:
+                sink.write(entries)
+            except Exception as e:
+                if len(entries) == 1:
+                    logger.exception(f"failed to write spooled {target} entry {entries[0].name}, retrying later")
+                    self._failed(entries, repr(e))
+                    return 0
+                # write them one at a time instead, so only the entries that fail are retried
+                logger.warning(f"failed to write {len(entries)} spooled {target} entries as a batch: {e!r}")
+                return self._write_each(target, entries, lambda entry: sink.write([entry]))
+            self._done(entries)
+            return len(entries)
+        return self._write_each(target, entries, sink.write)
+
+    def _write_each(self, target: str, entries: List[SpoolEntry], write: Callable[[SpoolEntry], None]) -> int:
+        written, failed_keys = [], set()
+        for entry in entries:
+            if entry.key in failed_keys:
+                continue  # keep the order of this key, retry it after the failed entry
+            try:
+                write(entry)
+            except Exception as e:
+                logger.exception(f"failed to write spooled {target} entry {entry.name}, retrying later")
+                failed_keys.add(entry.key)
+                self._failed([entry], repr(e))
+            else:
+                written.append(entry)
+        self._done(written)
+        return len(written)
+
+    def flush(self, target: Optional[str] = None) -> int:
+        """Write out every ready entry, of `target` or of all targets. Returns how many were written"""
+        written = 0
+        with self._flushing:
+            for name, sink in list(self._sinks.items()):
+                if target is not None and name != target:
+                    continue
+                while True:
+                    count = self._flush_target(name, sink)
+                    written += count
+                    if count < self.batch_size:
+                        break
+        return written
+
+    def _flush_periodically(self) -> None:
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                self._cond.wait(self.interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("spool flush failed")
+
+    def close(self) -> None:
+        """Stop the flusher after a last flush, entries that still fail stay spooled for the next start"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._flusher.is_alive():
+            self._flusher.join()
+        self.flush()
+        left = self.pending()
+        if left:
+            logger.warning(f"{left} writes are still spooled in {self.path}, they are retried on the next start")
+        dead = self.dead()
+        if dead:
+            logger.warning(f"{dead} writes that kept failing are in the spool_dead table of {self.path}")
+        with self._lock:
+            self._conn.close()
+
+
+class SpooledPhotoMemory(PhotoMemory[Image.Image]):
+    """Saves images to a `Spool` and writes them to `inner` in the background, reads see spooled images"""
+    target = 'photo'
+
+    def __init__(self, inner: PhotoMemory, spool: Spool):
+        self.inner = inner
+        self.spool = spool
+        spool.register(self.target, self._write_entry)
+
+    def _write_entry(self, entry: SpoolEntry) -> None:
+        self.inner.save_bytes(entry.payload, entry.name, entry.content_type)
+
+    def save(self, obj: Image.Image, name: str) -> None:
+        buffer = io.BytesIO()
+        obj.save(buffer, format='JPEG')
+        self.save_bytes(buffer.getvalue(), name)
+
+    def save_bytes(self, data: bytes, name: str, content_type: str = 'image/jpeg') -> None:
+        name = self._with_extension(name, content_type)
+        # images of one camera are ordered, renditions are ordered with their own kind
+        self.spool.append(self.target, name.split('|', 1)[0], name, data, content_type)
+
+    def load(self, name: str) -> Image.Image:
+        return Image.open(io.BytesIO(self.load_bytes(name)))
+
+    def load_bytes(self, name: str) -> bytes:
+        entry = self.spool.find(self.target, name)
+        return entry.payload if entry else self.inner.load_bytes(name)
+
+    def list_names(self, prefix: str = '', older_than: Optional[float] = None) -> Iterator[str]:
+        return self.inner.list_names(prefix, older_than)
+
+    def delete(self, name: str) -> None:
+        self.inner.delete(name)
+
+    def delete_many(self, names: Iterable[str]) -> None:
+        self.inner.delete_many(names)
+
+    def close(self) -> None:
+        self.inner.close()
+
+
+class SpooledDatabaseMemory(DatabaseMemory):
+    """Saves detection rows to a `Spool` and writes them to `inner` in batches in the background"""
+    target = 'detections'
+
+    def __init__(self, inner: DatabaseMemory, spool: Spool):
+        self.inner = inner
+        self.spool = spool
+        spool.register(self.target, self._write_entries, batch=True)
+
+    def _create_table(self):
+        pass  # `inner` created its own tables
+
+    def _insert_many(self, rows: List[DetectionRow]) -> None:
+        self.inner._insert_many(rows)
+
+    @property
+    def has_rollups(self) -> bool:
+        return self.inner.has_rollups
+
+    def rollups_start(self) -> Optional[int]:
+        return self.inner.rollups_start()
+
+    def _delete_before(self, granularity: Optional[str], cutoff: int, limit: int,
+                       cameras: Optional[Iterable[str]] = None) -> int:
+        return self.inner._delete_before(granularity, cutoff, limit, cameras)
+
+    def _replace_many(self, items: List[Tuple[DetectionKey, DetectionRow]]) -> None:
+        self.spool.flush(self.target)  # the rows being replaced may still be waiting here
+        self.inner._replace_many(items)
+
+    def _write_entries(self, entries: List[SpoolEntry]) -> None:
+        # entries spooled before `carried_forward` was saved have one field less
+        self.inner._write([tuple(row) + (False,) * (6 - len(row))
+                           for row in (json.loads(entry.payload) for entry in entries)])
+
+    def _write(self, rows: List[DetectionRow]) -> None:
+        self.spool.append_many(self.target, [(row[0], f"{row[0]}|{row[1]}", json.dumps(row).encode(), '')
+                                             for row in rows])
+
+    def load(self, name: str) -> Tuple[int, float]:
+        self.spool.flush(self.target)
+        return self.inner.load(name)
+
+    def query_range(self, start_ts: int, end_ts: int,
+                    cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        self.spool.flush(self.target)
+        return self.inner.query_range(start_ts, end_ts, cameras)
+
+    def query_rollups(self, granularity: str, start_ts: int, end_ts: int,
+                      cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        self.spool.flush(self.target)
+        return self.inner.query_rollups(granularity, start_ts, end_ts, cameras)
+
+    def close(self) -> None:
+        self.inner.close()
@@ -1,107 +1,473 @@
-from typing import Tuple
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from itertools import chain, islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 from decimal import Decimal
 
 import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
 try:
     import sqlite3
 except ImportError:
     sqlite3 = None
 import mysql.connector
+import mysql.connector.pooling
 import psycopg2
+import psycopg2.pool
 
-from warden.memory.base import DatabaseMemory, Memory
+from warden.memory.base import DatabaseMemory, DetectionKey, DetectionRow
+from warden.memory.rollup import GRANULARITIES, aggregate, rollup_dict
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    'idx_truck_detections_ts': '(timestamp)',
+}
+# one detection per camera and timestamp, so a batch written twice (e.g. replayed by the spool) is saved once.
+# camera_name first so per-camera range queries read one contiguous slice of the index
+UNIQUE_KEY = 'uq_truck_detections_camera_ts'
+LEGACY_KEY_INDEX = 'idx_truck_detections_camera_ts'  # the plain index UNIQUE_KEY replaces
+DETECTION_COLUMNS = 'camera_name, timestamp, truck_count, avg_confidence, ts_approx, carried_forward'
+# columns that tables created by older versions lack, added with these definitions
+CARRIED_FORWARD_COLUMN = 'carried_forward BOOLEAN NOT NULL DEFAULT FALSE'
+CARRIED_COLUMN = 'carried INTEGER NOT NULL DEFAULT 0'
+
+
+def _range_query(placeholder: str, cameras: Optional[List[str]]) -> str:
+    query = f'''
+        SELECT {DETECTION_COLUMNS} FROM truck_detections
+        WHERE timestamp BETWEEN {placeholder} AND {placeholder}
+    '''
+    if cameras:
+        query += f"AND camera_name IN ({', '.join([placeholder] * len(cameras))})"
+    return query + ' ORDER BY camera_name, timestamp'
+
+
+ROLLUP_COLUMNS = ('camera_name, bucket, samples, sum_truck_count, min_truck_count, max_truck_count, sum_confidence, '
+                  'carried')
+
+
+def _rollup_table(granularity: str) -> str:
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unsupported rollup granularity: {granularity}")
+    return f"truck_detections_{granularity}"
+
+
+def _rollup_backfill(table: str, bucket_expr: str) -> str:
+    """Build a rollup table from the raw rows, used once when the table is still empty"""
+    return f'''
+        INSERT INTO {table} ({ROLLUP_COLUMNS})
+        SELECT camera_name, {bucket_expr}, COUNT(*), SUM(truck_count), MIN(truck_count), MAX(truck_count),
+               SUM(avg_confidence), SUM(CASE WHEN carried_forward THEN 1 ELSE 0 END)
+        FROM truck_detections GROUP BY camera_name, {bucket_expr}
+    '''
+
+
+def _rollup_upsert(table: str, placeholder: str, least: str, greatest: str) -> str:
+    """Merge a partial rollup into the stored one, for databases with INSERT ... ON CONFLICT"""
+    return f'''
+        INSERT INTO {table} ({ROLLUP_COLUMNS}) VALUES ({', '.join([placeholder] * 8)})
+        ON CONFLICT (camera_name, bucket) DO UPDATE SET
+            samples = {table}.samples + excluded.samples,
+            sum_truck_count = {table}.sum_truck_count + excluded.sum_truck_count,
+            min_truck_count = {least}({table}.min_truck_count, excluded.min_truck_count),
+            max_truck_count = {greatest}({table}.max_truck_count, excluded.max_truck_count),
+            sum_confidence = {table}.sum_confidence + excluded.sum_confidence,
+            carried = {table}.carried + excluded.carried
+    '''
+
+
+def _mysql_rollup_upsert(table: str) -> str:
+    """Merge a partial rollup into the stored one, MySQL has ON DUPLICATE KEY UPDATE instead"""
+    return f'''
+        INSERT INTO {table} ({ROLLUP_COLUMNS}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            samples = samples + VALUES(samples),
+            sum_truck_count = sum_truck_count + VALUES(sum_truck_count),
+            min_truck_count = LEAST(min_truck_count, VALUES(min_truck_count)),
+            max_truck_count = GREATEST(max_truck_count, VALUES(max_truck_count)),
+            sum_confidence = sum_confidence + VALUES(sum_confidence),
+            carried = carried + VALUES(carried)
+    '''
+
+
+def _insert_query(placeholder: str) -> str:
+    """Insert a raw row unless its camera and timestamp are saved already"""
+    return f'''
+        INSERT INTO truck_detections ({DETECTION_COLUMNS}) VALUES ({', '.join([placeholder] * 6)})
+        ON CONFLICT (camera_name, timestamp) DO NOTHING
+    '''
+
+
+MYSQL_INSERT = f"INSERT IGNORE INTO truck_detections ({DETECTION_COLUMNS}) VALUES (%s, %s, %s, %s, %s, %s)"
+
+
+def _insert_rows(cursor, insert: str, rows: List[DetectionRow], upsert: Callable[[str], str]) -> None:
+    """Insert raw rows and add the ones that were new to the rollups, in the caller's transaction.
+
+    Rows are inserted one at a time, as the row count of each statement tells whether the row was new.
+    """
+    inserted = []
+    for row in rows:
+        cursor.execute(insert, row)
+        if cursor.rowcount == 1:
+            inserted.append(row)
+    for granularity, partials in aggregate(inserted).items():
+        cursor.executemany(upsert(_rollup_table(granularity)), partials)
+
+
+def _subtract_rows(cursor, placeholder: str, rows: List[DetectionRow]) -> None:
+    """Take deleted raw rows out of the rollups, in the caller's transaction"""
+    p = placeholder
+    for granularity, partials in aggregate(rows).items():
+        table, width = _rollup_table(granularity), GRANULARITIES[granularity]
+        cursor.executemany(f'''
+            UPDATE {table} SET samples = samples - {p}, sum_truck_count = sum_truck_count - {p},
+                sum_confidence = sum_confidence - {p}, carried = carried - {p}
+            WHERE camera_name = {p} AND bucket = {p}
+        ''', [(samples, total, confidence, carried, camera_name, bucket)
+              for camera_name, bucket, samples, total, _, _, confidence, carried in partials])
+        cursor.executemany(f"DELETE FROM {table} WHERE camera_name = {p} AND bucket = {p} AND samples <= 0",
+                           [(camera_name, bucket) for camera_name, bucket, *_ in partials])
+        # min and max cannot be subtracted, they are recomputed unless some of the bucket's rows were compacted
+        for camera_name, bucket, *_ in partials:
+            cursor.execute(f'''
+                SELECT COUNT(*), MIN(truck_count), MAX(truck_count) FROM truck_detections
+                WHERE camera_name = {p} AND timestamp BETWEEN {p} AND {p}
+            ''', (camera_name, bucket, bucket + width - 1))
+            count, low, high = cursor.fetchall()[0]
+            if count:
+                cursor.execute(f'''
+                    UPDATE {table} SET min_truck_count = {p}, max_truck_count = {p}
+                    WHERE camera_name = {p} AND bucket = {p} AND samples = {p}
+                ''', (low, high, camera_name, bucket, count))
+
+
+def _replace_rows(cursor, placeholder: str, insert: str, items: List[Tuple[DetectionKey, DetectionRow]],
+                  upsert: Callable[[str], str]) -> None:
+    """Delete the rows saved under the old and the new keys of `items` and insert the new rows, moving their
+    share of the rollups along, in the caller's transaction"""
+    p = placeholder
+    keys = DatabaseMemory._replaced_keys(items)
+    replaced: List[DetectionRow] = []
+    for key in keys:
+        cursor.execute(f"SELECT {DETECTION_COLUMNS} FROM truck_detections WHERE camera_name = {p} AND timestamp = {p}",
+                       key)
+        replaced += cursor.fetchall()
+    cursor.executemany(f"DELETE FROM truck_detections WHERE camera_name = {p} AND timestamp = {p}", keys)
+    _insert_rows(cursor, insert, DatabaseMemory._replacements(items, replaced), upsert)
+    _subtract_rows(cursor, p, replaced)
+
+
+def _add_unique_key(cursor, placeholder: str) -> None:
+    """Create UNIQUE_KEY on a table written before it existed, deleting all but the first row of each camera and
+    timestamp and taking them out of the rollups, in the caller's transaction"""
+    cursor.execute(f'''
+        SELECT id, {DETECTION_COLUMNS} FROM truck_detections t WHERE id > (
+            SELECT MIN(id) FROM truck_detections f WHERE f.camera_name = t.camera_name AND f.timestamp = t.timestamp
+        )
+    ''')
+    duplicates = cursor.fetchall()
+    if duplicates:
+        logger.warning(f"deleting {len(duplicates)} duplicate detections before adding the unique key {UNIQUE_KEY}")
+        cursor.executemany(f"DELETE FROM truck_detections WHERE id = {placeholder}",
+                           [(row[0],) for row in duplicates])
+        _subtract_rows(cursor, placeholder, [tuple(row[1:]) for row in duplicates])
+    cursor.execute(f"CREATE UNIQUE INDEX {UNIQUE_KEY} ON truck_detections (camera_name, timestamp)")
+
+
+def _table_columns(cursor, table: str, schema: str) -> Set[str]:
+    """The column names of `table` in the `schema` expression, for MySQL and PostgreSQL"""
+    cursor.execute(f"SELECT column_name FROM information_schema.columns WHERE table_schema = {schema} "
+                   f"AND table_name = '{table}'")
+    return {name for (name,) in cursor.fetchall()}
+
+
+def _add_column(cursor, table: str, column: str, columns: Set[str]) -> None:
+    """Add `column`, one of the definitions above, to a `table` created by an older version without it"""
+    if column.split()[0] not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+
+def _rollup_query(table: str, placeholder: str, cameras: Optional[List[str]]) -> str:
+    query = f'''
+        SELECT {ROLLUP_COLUMNS} FROM {table}
+        WHERE bucket BETWEEN {placeholder} AND {placeholder}
+    '''
+    if cameras:
+        query += f"AND camera_name IN ({', '.join([placeholder] * len(cameras))})"
+    return query + ' ORDER BY camera_name, bucket'
+
+
+def _expired(granularity: Optional[str], placeholder: str, cameras: Optional[List[str]]) -> Tuple[str, str]:
+    """The table of raw rows or of `granularity` rollups, and the condition matching its rows older than a cutoff"""
+    table, column = (_rollup_table(granularity), 'bucket') if granularity else ('truck_detections', 'timestamp')
+    condition = f"{column} < {placeholder}"
+    if cameras:
+        condition += f" AND camera_name IN ({', '.join([placeholder] * len(cameras))})"
+    return table, condition
 
 
 class SQLiteMemory(DatabaseMemory):
+    """SQLite in WAL mode, with a pool of up to `pool_size` connections"""
     import_failed = sqlite3 is None
 
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, pool_size: int = 4):
         self.db_path = db_path
+        # a bounded pool rather than one connection per thread, threads come and go (e.g. Streamlit reruns)
+        self._idle: 'queue.LifoQueue[sqlite3.Connection]' = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._connections: List['sqlite3.Connection'] = []
+        self._lock = threading.Lock()
         self._create_table()
 
+    def _connect(self) -> 'sqlite3.Connection':
+        # a connection is only used by one thread at a time, the check would stop it moving between threads
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')  # readers no longer block the writer
+        conn.execute('PRAGMA synchronous=NORMAL')  # WAL stays consistent, only the last commits are at risk
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        with self._slots:  # waits for a free connection once `pool_size` are checked out
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                with conn:  # commits, or rolls back on error
+                    yield conn
+            finally:
+                self._idle.put(conn)
+
     def _create_table(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
+            cursor.execute(f'''
                 CREATE TABLE IF NOT EXISTS truck_detections (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     camera_name TEXT,
                     timestamp INTEGER,
                     truck_count INTEGER,
                     avg_confidence REAL,
-                    ts_approx BOOLEAN
+                    ts_approx BOOLEAN,
+                    {CARRIED_FORWARD_COLUMN}
                 )
             ''')
+            _add_column(cursor, 'truck_detections', CARRIED_FORWARD_COLUMN, self._columns(cursor, 'truck_detections'))
+            for index, columns in INDEXES.items():
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {index} ON truck_detections {columns}")
+            for granularity, width in GRANULARITIES.items():
+                table = _rollup_table(granularity)
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        camera_name TEXT NOT NULL,
+                        bucket INTEGER NOT NULL,
+                        samples INTEGER,
+                        sum_truck_count INTEGER,
+                        min_truck_count INTEGER,
+                        max_truck_count INTEGER,
+                        sum_confidence REAL,
+                        {CARRIED_COLUMN},
+                        PRIMARY KEY (camera_name, bucket)
+                    )
+                ''')
+                _add_column(cursor, table, CARRIED_COLUMN, self._columns(cursor, table))
+                if cursor.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None:
+                    cursor.execute(_rollup_backfill(table, f"timestamp / {width} * {width}"))
+            if cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                              (UNIQUE_KEY,)).fetchone() is None:
+                _add_unique_key(cursor, '?')
+            cursor.execute(f"DROP INDEX IF EXISTS {LEGACY_KEY_INDEX}")
 
-    def save(self, obj: Tuple[int, float], name: str) -> None:
-        ts_approx = name.endswith('_approx')
-        camera_name, timestamp = name.split('|')
-        truck_count, avg_confidence = obj
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO truck_detections (camera_name, timestamp, truck_count, avg_confidence, ts_approx)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (camera_name, int(timestamp), truck_count, avg_confidence, ts_approx))
+    @staticmethod
+    def _columns(cursor, table: str) -> Set[str]:
+        return {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+
+    @staticmethod
+    def _upsert(table: str) -> str:
+        return _rollup_upsert(table, '?', 'MIN', 'MAX')
+
+    def _insert_many(self, rows: List[DetectionRow]) -> None:
+        with self._connection() as conn:
+            _insert_rows(conn.cursor(), _insert_query('?'), rows, self._upsert)
+
+    def _replace_many(self, items: List[Tuple[DetectionKey, DetectionRow]]) -> None:
+        with self._connection() as conn:
+            _replace_rows(conn.cursor(), '?', _insert_query('?'), items, self._upsert)
+
+    def query_range(self, start_ts: int, end_ts: int,
+                    cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        cameras = list(cameras) if cameras is not None else None
+        with self._connection() as conn:
+            cursor = conn.execute(_range_query('?', cameras), (start_ts, end_ts, *(cameras or [])))
+            for row in cursor:
+                yield self._row_dict(*row)
+
+    def query_rollups(self, granularity: str, start_ts: int, end_ts: int,
+                      cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        cameras = list(cameras) if cameras is not None else None
+        query = _rollup_query(_rollup_table(granularity), '?', cameras)
+        with self._connection() as conn:
+            for row in conn.execute(query, (start_ts, end_ts, *(cameras or []))):
+                yield rollup_dict(*row)
+
+    def _delete_before(self, granularity: Optional[str], cutoff: int, limit: int,
+                       cameras: Optional[Iterable[str]] = None) -> int:
+        cameras = list(cameras) if cameras is not None else None
+        table, condition = _expired(granularity, '?', cameras)
+        with self._connection() as conn:
+            cursor = conn.execute(f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {condition} "
+                                  f"LIMIT ?)", (cutoff, *(cameras or []), limit))
+            return cursor.rowcount
 
     def load(self, name: str) -> Tuple[int, float, bool]:
-        camera_name, timestamp = name.split('|')
-        with sqlite3.connect(self.db_path) as conn:
+        camera_name, timestamp, _ = self._parse_name(name)
+        with self._connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT truck_count, avg_confidence, ts_approx FROM truck_detections
                 WHERE camera_name = ? AND timestamp = ?
-            ''', (camera_name, int(timestamp)))
+            ''', (camera_name, timestamp))
             result = cursor.fetchone()
         if result is None:
             raise KeyError(f"No data found for {name}")
         return result
 
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._idle = queue.LifoQueue()
+
 
 class MySQLMemory(DatabaseMemory):
-    def __init__(self, host: str, user: str, password: str, database: str):
+    def __init__(self, host: str, user: str, password: str, database: str, pool_size: int = 4):
         self.config = {
             'host': host,
             'user': user,
             'password': password,
             'database': database
         }
+        self.pool = mysql.connector.pooling.MySQLConnectionPool(pool_size=pool_size, **self.config)
+        # the pool raises PoolError instead of waiting when every connection is checked out
+        self._slots = threading.BoundedSemaphore(pool_size)
         self._create_table()
 
+    @contextmanager
+    def _connection(self):
+        with self._slots:
+            conn = self.pool.get_connection()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()  # hands the connection back to the pool
+
     def _create_table(self):
-        with mysql.connector.connect(**self.config) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
+            cursor.execute(f'''
                 CREATE TABLE IF NOT EXISTS truck_detections (
                     id INT AUTO_INCREMENT PRIMARY KEY,
                     camera_name VARCHAR(255),
                     timestamp BIGINT,
                     truck_count INT,
                     avg_confidence FLOAT,
-                    ts_approx BOOLEAN
+                    ts_approx BOOLEAN,
+                    {CARRIED_FORWARD_COLUMN}
                 )
             ''')
+            _add_column(cursor, 'truck_detections', CARRIED_FORWARD_COLUMN,
+                        _table_columns(cursor, 'truck_detections', 'DATABASE()'))
+            # MySQL has no CREATE INDEX IF NOT EXISTS
+            cursor.execute('''
+                SELECT DISTINCT index_name FROM information_schema.statistics
+                WHERE table_schema = DATABASE() AND table_name = 'truck_detections'
+            ''')
+            existing = {name for (name,) in cursor.fetchall()}
+            for index, columns in INDEXES.items():
+                if index not in existing:
+                    cursor.execute(f"CREATE INDEX {index} ON truck_detections {columns}")
+            for granularity, width in GRANULARITIES.items():
+                table = _rollup_table(granularity)
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        camera_name VARCHAR(255) NOT NULL,
+                        bucket BIGINT NOT NULL,
+                        samples INT,
+                        sum_truck_count BIGINT,
+                        min_truck_count INT,
+                        max_truck_count INT,
+                        sum_confidence DOUBLE,
+                        {CARRIED_COLUMN},
+                        PRIMARY KEY (camera_name, bucket)
+                    )
+                ''')
+                _add_column(cursor, table, CARRIED_COLUMN, _table_columns(cursor, table, 'DATABASE()'))
+                cursor.execute(f"SELECT 1 FROM {table} LIMIT 1")
+                if cursor.fetchone() is None:
+                    cursor.execute(_rollup_backfill(table, f"timestamp DIV {width} * {width}"))
+            if UNIQUE_KEY not in existing:
+                _add_unique_key(cursor, '%s')
+            if LEGACY_KEY_INDEX in existing:
+                cursor.execute(f"DROP INDEX {LEGACY_KEY_INDEX} ON truck_detections")
 
-    def save(self, obj: Tuple[int, float], name: str) -> None:
-        ts_approx = name.endswith('_approx')
-        camera_name, timestamp = name.split('|')
-        truck_count, avg_confidence = obj
-        with mysql.connector.connect(**self.config) as conn:
+    def _insert_many(self, rows: List[DetectionRow]) -> None:
+        with self._connection() as conn:
+            _insert_rows(conn.cursor(), MYSQL_INSERT, rows, _mysql_rollup_upsert)
+
+    def _replace_many(self, items: List[Tuple[DetectionKey, DetectionRow]]) -> None:
+        with self._connection() as conn:
+            _replace_rows(conn.cursor(), '%s', MYSQL_INSERT, items, _mysql_rollup_upsert)
+
+    def query_range(self, start_ts: int, end_ts: int,
+                    cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        cameras = list(cameras) if cameras is not None else None
+        with self._connection() as conn:
+            cursor = conn.cursor()  # unbuffered, rows are pulled from the server as they are iterated
+            cursor.execute(_range_query('%s', cameras), (start_ts, end_ts, *(cameras or [])))
+            for row in cursor:
+                yield self._row_dict(*row)
+
+    def query_rollups(self, granularity: str, start_ts: int, end_ts: int,
+                      cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        cameras = list(cameras) if cameras is not None else None
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO truck_detections (camera_name, timestamp, truck_count, avg_confidence, ts_approx)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (camera_name, int(timestamp), truck_count, avg_confidence, ts_approx))
-            conn.commit()
+            cursor.execute(_rollup_query(_rollup_table(granularity), '%s', cameras),
+                           (start_ts, end_ts, *(cameras or [])))
+            for row in cursor:
+                yield rollup_dict(*row)
+
+    def _delete_before(self, granularity: Optional[str], cutoff: int, limit: int,
+                       cameras: Optional[Iterable[str]] = None) -> int:
+        cameras = list(cameras) if cameras is not None else None
+        table, condition = _expired(granularity, '%s', cameras)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"DELETE FROM {table} WHERE {condition} LIMIT %s", (cutoff, *(cameras or []), limit))
+            return cursor.rowcount
 
     def load(self, name: str):
-        camera_name, timestamp = name.split('|')
-        with mysql.connector.connect(**self.config) as conn:
+        camera_name, timestamp, _ = self._parse_name(name)
+        with self._connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT truck_count, avg_confidence, ts_approx FROM truck_detections
                 WHERE camera_name = %s AND timestamp = %s
-            ''', (camera_name, int(timestamp)))
+            ''', (camera_name, timestamp))
             result = cursor.fetchone()
         if result is None:
             raise KeyError(f"No data found for {name}")
@@ -109,75 +475,442 @@ class MySQLMemory(DatabaseMemory):
 
 
 class PostgreSQLMemory(DatabaseMemory):
-    def __init__(self, host: str, user: str, password: str, database: str):
+    def __init__(self, host: str, user: str, password: str, database: str, pool_size: int = 4):
         self.config = f"host={host} user={user} password={password} dbname={database}"
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, self.config)
+        # the pool raises PoolError instead of waiting when every connection is checked out
+        self._slots = threading.BoundedSemaphore(pool_size)
         self._create_table()
 
+    @contextmanager
+    def _connection(self):
+        with self._slots:
+            conn = self.pool.getconn()
+            try:
+                with conn:  # commits, or rolls back on error, without closing
+                    yield conn
+            finally:
+                self.pool.putconn(conn)
+
     def _create_table(self):
-        with psycopg2.connect(self.config) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
+            cursor.execute(f'''
                 CREATE TABLE IF NOT EXISTS truck_detections (
                     id SERIAL PRIMARY KEY,
                     camera_name TEXT,
                     timestamp BIGINT,
                     truck_count INTEGER,
                     avg_confidence REAL,
-                    ts_approx BOOLEAN
+                    ts_approx BOOLEAN,
+                    {CARRIED_FORWARD_COLUMN}
                 )
             ''')
+            _add_column(cursor, 'truck_detections', CARRIED_FORWARD_COLUMN,
+                        _table_columns(cursor, 'truck_detections', 'current_schema()'))
+            for index, columns in INDEXES.items():
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {index} ON truck_detections {columns}")
+            for granularity, width in GRANULARITIES.items():
+                table = _rollup_table(granularity)
+                cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        camera_name TEXT NOT NULL,
+                        bucket BIGINT NOT NULL,
+                        samples INTEGER,
+                        sum_truck_count BIGINT,
+                        min_truck_count INTEGER,
+                        max_truck_count INTEGER,
+                        sum_confidence DOUBLE PRECISION,
+                        {CARRIED_COLUMN},
+                        PRIMARY KEY (camera_name, bucket)
+                    )
+                ''')
+                _add_column(cursor, table, CARRIED_COLUMN, _table_columns(cursor, table, 'current_schema()'))
+                cursor.execute(f"SELECT 1 FROM {table} LIMIT 1")
+                if cursor.fetchone() is None:
+                    cursor.execute(_rollup_backfill(table, f"timestamp / {width} * {width}"))
+            cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", (UNIQUE_KEY,))
+            if cursor.fetchone() is None:
+                _add_unique_key(cursor, '%s')
+            cursor.execute(f"DROP INDEX IF EXISTS {LEGACY_KEY_INDEX}")
+
+    @staticmethod
+    def _upsert(table: str) -> str:
+        return _rollup_upsert(table, '%s', 'LEAST', 'GREATEST')
+
+    def _insert_many(self, rows: List[DetectionRow]) -> None:
+        with self._connection() as conn:
+            _insert_rows(conn.cursor(), _insert_query('%s'), rows, self._upsert)
 
-    def save(self, obj: Tuple[int, float], name: str) -> None:
-        ts_approx = name.endswith('_approx')
-        camera_name, timestamp = name.split('|')
-        truck_count, avg_confidence = obj
-        with psycopg2.connect(self.config) as conn:
+    def _replace_many(self, items: List[Tuple[DetectionKey, DetectionRow]]) -> None:
+        with self._connection() as conn:
+            _replace_rows(conn.cursor(), '%s', _insert_query('%s'), items, self._upsert)
+
+    def query_range(self, start_ts: int, end_ts: int,
+                    cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        cameras = list(cameras) if cameras is not None else None
+        with self._connection() as conn:
+            # a named cursor lives on the server, so rows arrive in chunks of itersize instead of all at once
+            cursor = conn.cursor(name='warden_query_range')
+            cursor.itersize = 2000
+            cursor.execute(_range_query('%s', cameras), (start_ts, end_ts, *(cameras or [])))
+            for row in cursor:
+                yield self._row_dict(*row)
+            cursor.close()
+
+    def query_rollups(self, granularity: str, start_ts: int, end_ts: int,
+                      cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        cameras = list(cameras) if cameras is not None else None
+        with self._connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO truck_detections (camera_name, timestamp, truck_count, avg_confidence, ts_approx)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (camera_name, int(timestamp), truck_count, avg_confidence, ts_approx))
+            cursor.execute(_rollup_query(_rollup_table(granularity), '%s', cameras),
+                           (start_ts, end_ts, *(cameras or [])))
+            for row in cursor:
+                yield rollup_dict(*row)
+
+    def _delete_before(self, granularity: Optional[str], cutoff: int, limit: int,
+                       cameras: Optional[Iterable[str]] = None) -> int:
+        cameras = list(cameras) if cameras is not None else None
+        table, condition = _expired(granularity, '%s', cameras)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # Postgres has no DELETE ... LIMIT, pick the rows by their physical location instead
+            cursor.execute(f"DELETE FROM {table} WHERE ctid IN (SELECT ctid FROM {table} WHERE {condition} LIMIT %s)",
+                           (cutoff, *(cameras or []), limit))
+            return cursor.rowcount
 
     def load(self, name: str) -> Tuple[int, float, bool]:
-        camera_name, timestamp = name.split('|')
-        with psycopg2.connect(self.config) as conn:
+        camera_name, timestamp, _ = self._parse_name(name)
+        with self._connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT truck_count, avg_confidence, ts_approx FROM truck_detections
                 WHERE camera_name = %s AND timestamp = %s
-            ''', (camera_name, int(timestamp)))
+            ''', (camera_name, timestamp))
             result = cursor.fetchone()
         if result is None:
             raise KeyError(f"No data found for {name}")
         return result
 
+    def close(self) -> None:
+        self.pool.closeall()
+
+
+@contextmanager
+def _unless_condition_fails():
+    """Ignore a DynamoDB write whose ConditionExpression does not hold, someone else got there first"""
+    try:
+        yield
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def _day_boundary(timestamp: int) -> int:
+    """The first UTC midnight at or after `timestamp`"""
+    day = GRANULARITIES['day']
+    return timestamp if timestamp % day == 0 else timestamp - timestamp % day + day
+
 
-class DynamoDBMemory(Memory[Tuple[int, float]]):
-    def __init__(self, table_name: str, region_name: str):
+class DynamoDBMemory(DatabaseMemory):
+    """Detections keyed on camera_name and timestamp.
+
+    Rollups are kept in a second table, keyed on `series` ('<granularity>#<camera_name>') and `bucket`,
+    only when `rollup_table_name` is given. Unlike the SQL tables it starts out empty: the time rollups were
+    first written is kept in its `_meta` item, and `backfill_rollups` builds the buckets before that from the
+    raw rows.
+    """
+    META_KEY = {'series': '_meta', 'bucket': 0}
+
+    def __init__(self, table_name: str, region_name: str, rollup_table_name: Optional[str] = None):
         self.table_name = table_name
         self.dynamodb = boto3.resource('dynamodb', region_name=region_name)
         self.table = self.dynamodb.Table(table_name)
+        self.rollup_table = self.dynamodb.Table(rollup_table_name) if rollup_table_name else None
+        self._rollups_complete = False
+        if self.rollup_table is not None:
+            self._mark_rollups_since()
 
-    def save(self, obj: Tuple[int, float], name: str) -> None:
-        camera_name, timestamp, approx = name.split('|')
-        ts_approx = approx == 'true'
-        truck_count, avg_confidence = obj
-        self.table.put_item(
-            Item={
-                'camera_name': camera_name,
-                'timestamp': int(timestamp),  # Convert to int
-                'truck_count': truck_count,
-                'avg_confidence': Decimal(f"{avg_confidence:.2f}"),
-                'ts_approx': ts_approx
-            }
-        )
+    def _mark_rollups_since(self) -> None:
+        """Record when rollups started to be written, the first time the rollup table is used"""
+        with _unless_condition_fails():
+            self.rollup_table.put_item(Item={**self.META_KEY, 'rollups_since': int(time.time() * 1000)},
+                                       ConditionExpression='attribute_not_exists(series)')
+
+    def _rollup_meta(self) -> Dict[str, Any]:
+        return self.rollup_table.get_item(Key=self.META_KEY, ConsistentRead=True)['Item']
+
+    @property
+    def has_rollups(self) -> bool:
+        return self.rollup_table is not None
+
+    def _require_rollups(self, reason: str = '') -> None:
+        if self.rollup_table is None:
+            raise ValueError(f"no rollup table configured for {self.table_name}{reason}")
+
+    def rollups_start(self) -> Optional[int]:
+        if self.rollup_table is None:
+            return None
+        if self._rollups_complete:
+            return 0
+        meta = self._rollup_meta()
+        # detections from the first whole day after rollups started were all added to them as they were saved
+        start = _day_boundary(int(meta['rollups_since']))
+        if int(meta.get('backfilled_until', 0)) >= start:
+            self._rollups_complete = True
+            return 0
+        return start
+
+    def backfill_rollups(self, cameras: Iterable[str], window_days: int = 30) -> int:
+        """Rebuild the rollups of the days before `rollups_start` from the raw rows of `cameras`.
+
+        Buckets are overwritten rather than added to, so an interrupted backfill can be run again. Only days
+        before today are rebuilt, today's buckets are still being added to. Returns the raw rows read.
+        """
+        self._require_rollups()
+        day = GRANULARITIES['day']
+        meta = self._rollup_meta()
+        now_ms = int(time.time() * 1000)
+        until = min(_day_boundary(int(meta['rollups_since'])), now_ms - now_ms % day)
+        if until <= int(meta.get('backfilled_until', 0)):
+            return 0
+
+        read = 0
+        for camera_name in cameras:
+            first = self.table.query(KeyConditionExpression=Key('camera_name').eq(camera_name)
+                                     & Key('timestamp').lt(until), Limit=1)['Items']
+            if not first:
+                continue
+            # whole days at a time, so every bucket is rebuilt from all of its rows at once
+            start = int(first[0]['timestamp']) - int(first[0]['timestamp']) % day
+            while start < until:
+                end = min(start + window_days * day, until)
+                rows = [(row['camera_name'], row['timestamp'], row['truck_count'], row['avg_confidence'],
+                         row['ts_approx'], row['carried_forward'])
+                        for row in self.query_range(start, end - 1, [camera_name])]
+                read += len(rows)
+                with self.rollup_table.batch_writer(overwrite_by_pkeys=['series', 'bucket']) as batch:
+                    for granularity, partials in aggregate(rows).items():
+                        for camera, bucket, samples, total, low, high, confidence, carried in partials:
+                            batch.put_item(Item={
+                                'series': f"{granularity}#{camera}", 'bucket': bucket, 'samples': samples,
+                                'sum_truck_count': total, 'min_truck_count': low, 'max_truck_count': high,
+                                'sum_confidence': Decimal(f"{confidence:.2f}"), 'carried': carried,
+                            })
+                start = end
+            logger.info(f"Backfilled the rollups of {camera_name}, {read} detections read so far")
+
+        self.rollup_table.update_item(Key=self.META_KEY, UpdateExpression='SET backfilled_until = :u',
+                                      ExpressionAttributeValues={':u': until})
+        return read
+
+    def _create_table(self):
+        pass  # the table is provisioned outside of warden, keyed on camera_name and timestamp
+
+    @staticmethod
+    def _row_item(row: DetectionRow) -> Dict[str, Any]:
+        camera_name, timestamp, truck_count, avg_confidence, ts_approx, carried_forward = row
+        return {
+            'camera_name': camera_name,
+            'timestamp': timestamp,
+            'truck_count': truck_count,
+            'avg_confidence': Decimal(f"{avg_confidence:.2f}"),
+            'ts_approx': ts_approx,
+            'carried_forward': carried_forward
+        }
+
+    def _insert_many(self, rows: List[DetectionRow]) -> None:
+        # BatchWriteItem cannot be conditional, and an overwritten item must not be added to the rollups again,
+        # so each item is put only if its key is new, and only the new ones are merged into the rollups
+        inserted = []
+        try:
+            for row in rows:
+                if self._put_new(row):
+                    inserted.append(row)
+        finally:
+            if self.rollup_table is not None and inserted:
+                self._merge_rollups(aggregate(inserted))
+
+    def _put_new(self, row: DetectionRow) -> bool:
+        """Put a detection unless its key is already saved, returns whether it was"""
+        try:
+            self.table.put_item(Item=self._row_item(row), ConditionExpression='attribute_not_exists(#t)',
+                                ExpressionAttributeNames={'#t': 'timestamp'})  # 'timestamp' is a reserved word
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        return True
+
+    def _replace_many(self, items: List[Tuple[DetectionKey, DetectionRow]]) -> None:
+        keys = [{'camera_name': camera_name, 'timestamp': timestamp}
+                for camera_name, timestamp in self._replaced_keys(items)]
+        replaced = [(item['camera_name'], int(item['timestamp']), int(item['truck_count']),
+                     float(item['avg_confidence']), bool(item.get('ts_approx', False)),
+                     bool(item.get('carried_forward', False)))
+                    for item in self._get_many(keys)]
+        rows = self._replacements(items, replaced)
+        # a put after a delete of the same key replaces the delete in the batch, it does not fail it
+        with self.table.batch_writer(overwrite_by_pkeys=['camera_name', 'timestamp']) as batch:
+            for key in keys:
+                batch.delete_item(Key=key)
+            for row in rows:
+                batch.put_item(Item=self._row_item(row))
+        if self.rollup_table is not None:
+            self._merge_rollups(aggregate(rows))
+            self._subtract_rollups(aggregate(replaced))
+
+    def _get_many(self, keys: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """The saved items of `keys`, BatchGetItem reads up to 100 keys at a time"""
+        for start in range(0, len(keys), 100):
+            request = {self.table_name: {'Keys': keys[start:start + 100], 'ConsistentRead': True}}
+            while request:
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                yield from response['Responses'].get(self.table_name, [])
+                request = response.get('UnprocessedKeys')
+
+    def _merge_rollups(self, merged) -> None:
+        for granularity, partials in merged.items():
+            for camera_name, bucket, samples, total, low, high, confidence, carried in partials:
+                key = {'series': f"{granularity}#{camera_name}", 'bucket': bucket}
+                item = self.rollup_table.update_item(
+                    Key=key,
+                    UpdateExpression='ADD samples :n, sum_truck_count :s, sum_confidence :c, carried :k '
+                                     'SET min_truck_count = if_not_exists(min_truck_count, :lo), '
+                                     'max_truck_count = if_not_exists(max_truck_count, :hi)',
+                    ExpressionAttributeValues={':n': samples, ':s': total, ':c': Decimal(f"{confidence:.2f}"),
+                                               ':k': carried, ':lo': low, ':hi': high},
+                    ReturnValues='ALL_NEW'
+                )['Attributes']
+                # DynamoDB has no atomic min/max, lower or raise the bound only if nobody beat us to it
+                if low < item['min_truck_count']:
+                    self._set_bound(key, 'min_truck_count', low, '>')
+                if high > item['max_truck_count']:
+                    self._set_bound(key, 'max_truck_count', high, '<')
+
+    def _subtract_rollups(self, merged) -> None:
+        """Take rows out of the rollups, min and max are recomputed from the raw rows left in their buckets"""
+        for granularity, partials in merged.items():
+            width = GRANULARITIES[granularity]
+            for camera_name, bucket, samples, total, _, _, confidence, carried in partials:
+                key = {'series': f"{granularity}#{camera_name}", 'bucket': bucket}
+                item = self.rollup_table.update_item(
+                    Key=key,
+                    UpdateExpression='ADD samples :n, sum_truck_count :s, sum_confidence :c, carried :k',
+                    ExpressionAttributeValues={':n': -samples, ':s': -total, ':c': Decimal(f"{-confidence:.2f}"),
+                                               ':k': -carried},
+                    ReturnValues='ALL_NEW'
+                )['Attributes']
+                if item['samples'] <= 0:
+                    with _unless_condition_fails():
+                        self.rollup_table.delete_item(Key=key, ConditionExpression='samples <= :z',
+                                                      ExpressionAttributeValues={':z': 0})
+                    continue
+                counts = [row['truck_count'] for row in self.query_range(bucket, bucket + width - 1, [camera_name])]
+                # unless some of the bucket's rows were compacted, or were saved in the meantime
+                if len(counts) == item['samples']:
+                    with _unless_condition_fails():
+                        self.rollup_table.update_item(
+                            Key=key,
+                            UpdateExpression='SET min_truck_count = :lo, max_truck_count = :hi',
+                            ConditionExpression='samples = :n',
+                            ExpressionAttributeValues={':lo': min(counts), ':hi': max(counts), ':n': len(counts)}
+                        )
+
+    def _set_bound(self, key: Dict[str, Any], attribute: str, value: int, comparison: str) -> None:
+        with _unless_condition_fails():
+            self.rollup_table.update_item(
+                Key=key,
+                UpdateExpression=f'SET {attribute} = :v',
+                ConditionExpression=f'{attribute} {comparison} :v',
+                ExpressionAttributeValues={':v': value}
+            )
+
+    def query_range(self, start_ts: int, end_ts: int,
+                    cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        if cameras is None:
+            logger.warning(f"query_range without cameras has to scan all of {self.table_name}")
+            pages = self._paginate(self.table.scan, FilterExpression=Attr('timestamp').between(start_ts, end_ts))
+            for item in pages:
+                yield self._item_dict(item)
+            return
+
+        for camera_name in cameras:
+            key = Key('camera_name').eq(camera_name) & Key('timestamp').between(start_ts, end_ts)
+            for item in self._paginate(self.table.query, KeyConditionExpression=key):
+                yield self._item_dict(item)
+
+    def query_rollups(self, granularity: str, start_ts: int, end_ts: int,
+                      cameras: Optional[Iterable[str]] = None) -> Iterator[Dict[str, Any]]:
+        self._require_rollups()
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unsupported rollup granularity: {granularity}")
+
+        if cameras is None:
+            condition = Attr('series').begins_with(f"{granularity}#") & Attr('bucket').between(start_ts, end_ts)
+            pages = [self._paginate(self.rollup_table.scan, FilterExpression=condition)]
+        else:
+            pages = [self._paginate(self.rollup_table.query,
+                                    KeyConditionExpression=Key('series').eq(f"{granularity}#{camera_name}")
+                                    & Key('bucket').between(start_ts, end_ts))
+                     for camera_name in cameras]
+        for items in pages:
+            for item in items:
+                yield rollup_dict(item['series'].split('#', 1)[1], item['bucket'], item['samples'],
+                                  item['sum_truck_count'], item['min_truck_count'], item['max_truck_count'],
+                                  item['sum_confidence'], item.get('carried', 0))
+
+    def _delete_before(self, granularity: Optional[str], cutoff: int, limit: int,
+                       cameras: Optional[Iterable[str]] = None) -> int:
+        self._require_rollups(', compacting would lose the detections')
+        if granularity is None:
+            # raw rows from before `rollups_start` are only in the raw table until they are backfilled
+            table, hash_key, range_key, prefix = self.table, 'camera_name', 'timestamp', ''
+            start = self.rollups_start()
+        else:
+            table, hash_key, range_key, prefix = self.rollup_table, 'series', 'bucket', f"{granularity}#"
+            start = 0
+        if start >= cutoff:
+            return 0
+        # 'timestamp' is a reserved word
+        projection = {'ProjectionExpression': '#h, #r', 'ExpressionAttributeNames': {'#h': hash_key, '#r': range_key}}
+
+        if cameras is None:
+            logger.warning(f"compacting without cameras has to scan all of {table.name}")
+            condition = Attr(range_key).between(start, cutoff - 1)
+            if prefix:
+                condition &= Attr(hash_key).begins_with(prefix)
+            items = self._paginate(table.scan, FilterExpression=condition, **projection)
+        else:
+            items = chain.from_iterable(
+                self._paginate(table.query, KeyConditionExpression=Key(hash_key).eq(f"{prefix}{camera_name}")
+                               & Key(range_key).between(start, cutoff - 1), **projection)
+                for camera_name in cameras)
+        keys = [{hash_key: item[hash_key], range_key: item[range_key]} for item in islice(items, limit)]
+        with table.batch_writer() as batch:
+            for key in keys:
+                batch.delete_item(Key=key)
+        return len(keys)
+
+    @staticmethod
+    def _paginate(operation, **kwargs) -> Iterator[Dict[str, Any]]:
+        while True:
+            response = operation(**kwargs)
+            yield from response['Items']
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _item_dict(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        return self._row_dict(item['camera_name'], item['timestamp'], item['truck_count'], item['avg_confidence'],
+                              item.get('ts_approx', False), item.get('carried_forward', False))
 
     def load(self, name: str) -> Tuple[int, float, bool]:  # Return type updated
-        camera_name, timestamp = name.split('|')
+        camera_name, timestamp, _ = self._parse_name(name)
         response = self.table.get_item(
             Key={
                 'camera_name': camera_name,
-                'timestamp': int(timestamp)  # Convert to int
+                'timestamp': timestamp
             }
         )
         if 'Item' not in response:
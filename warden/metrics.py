@@ -0,0 +1,257 @@
+import bisect
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter as Tally
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a cached S3 read up to a Rekognition call stuck in retries
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: a count per bucket (the last one is +Inf), the sum and the count of observations
+        self._values: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    le_label = f'le="{le}"'
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le_label)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    """The metrics of a process, rendered in the Prometheus text format"""
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+    def write(self, path: str) -> None:
+        """Write the metrics to `path` atomically, e.g. for the node exporter textfile collector"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.prom.tmp')
+        with os.fdopen(fd, 'w') as file:
+            file.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """Serve the metrics on http://host:port/metrics from a background thread"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # scrapes would flood the log
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+    def write_periodically(self, path: str, interval: float = 15.0) -> threading.Event:
+        """Rewrite `path` every `interval` seconds until the returned event is set"""
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    self.write(path)
+                except OSError:
+                    logger.exception(f"failed to write metrics to {path}")
+
+        threading.Thread(target=loop, name='metrics-file', daemon=True).start()
+        return stop
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram('warden_stage_seconds', 'Time spent in a capture pipeline stage',
+                                   ('stage', 'camera'))
+STAGE_TOTAL = REGISTRY.counter('warden_stage_total', 'Items that went through a capture pipeline stage',
+                               ('stage', 'camera', 'outcome'))
+
+
+class StackSampler:
+    """Sampling profiler for the threads currently inside some stages.
+
+    Every `interval` seconds the stack of each thread running a profiled stage is recorded. `dump` writes
+    the samples per stage as collapsed stacks, which flamegraph.pl or speedscope turn into a flame graph.
+    """
+    def __init__(self, stages: Sequence[str], interval: float = 0.01):
+        self.stages = set(stages)
+        self.interval = interval
+        self._active: Dict[int, str] = {}  # thread id -> stage it is running
+        self._samples: Dict[str, Tally] = {stage: Tally() for stage in self.stages}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def profile(self, stage: str) -> Iterator[None]:
+        if stage not in self.stages:
+            yield
+            return
+        ident = threading.get_ident()
+        with self._lock:
+            self._active[ident] = stage
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active.pop(ident, None)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for ident, stage in active.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                if stack:
+                    with self._lock:
+                        self._samples[stage][';'.join(reversed(stack))] += 1
+
+    def dump(self, directory: str) -> None:
+        """Write `profile-<stage>.txt` collapsed stacks to `directory`"""
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            samples = {stage: dict(tally) for stage, tally in self._samples.items()}
+        for stage, stacks in samples.items():
+            with open(os.path.join(directory, f"profile-{stage}.txt"), 'w') as file:
+                for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                    file.write(f"{stack} {count}\n")
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+_sampler: Optional[StackSampler] = None
+
+
+def set_sampler(sampler: Optional[StackSampler]) -> None:
+    """Profile the stages of `sampler` from now on, None turns profiling off"""
+    global _sampler
+    _sampler = sampler
+
+
+@contextmanager
+def timed(stage: str, camera: str) -> Iterator[None]:
+    """Time a stage for a camera, count its outcome, and profile it if a sampler wants that stage"""
+    start = time.perf_counter()
+    outcome = 'error'
+    sampler = _sampler
+    try:
+        if sampler is not None:
+            with sampler.profile(stage):
+                yield
+        else:
+            yield
+        outcome = 'ok'
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage, camera=camera)
+        STAGE_TOTAL.inc(stage=stage, camera=camera, outcome=outcome)
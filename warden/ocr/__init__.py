@@ -1,2 +1,4 @@
 from warden.ocr.base import TimestampReader
 from warden.ocr.tesseract import Tesseract
+from warden.ocr.glyph import GlyphReader
+from warden.ocr.pool import OCRPool
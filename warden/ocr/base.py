@@ -26,6 +26,14 @@ class TimestampReader(ABC):
 
         return pattern
 
+    def for_camera(self, name: str) -> 'TimestampReader':
+        """The reader to use for one camera, readers that learn per-camera state override this"""
+        return self
+
     @abstractmethod
     def read(self, image: Image) -> str:
         pass
+
+    def close(self) -> None:
+        """Stop worker processes or engines, the reader should not be used afterwards"""
+        pass
@@ -0,0 +1,194 @@
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL.Image import Image
+
+from .base import TimestampReader
+
+logger = logging.getLogger(__name__)
+
+SYMBOLS = '0123456789-:'
+CELL_SHAPE = (16, 10)  # rows, columns every glyph is sampled to
+FIELD_WIDTHS = {'%Y': 4}  # every other strftime field in a timestamp is two digits wide
+
+
+class GlyphReader(TimestampReader):
+    """Reads a fixed-font timestamp overlay by matching glyphs against templates learned per camera.
+
+    Templates are bootstrapped from the `fallback` reader: whenever a frame cannot be read confidently
+    the fallback reads it instead, and its answer is used to learn what each glyph looks like.
+    Confidence is the smallest gap between a glyph's best and second best template correlation.
+    """
+    def __init__(self, fallback: Optional[TimestampReader] = None, template_dir: Optional[str] = None,
+                 min_confidence: float = 0.1, max_samples: int = 50, min_ink: int = 3,
+                 name: Optional[str] = None):
+        super().__init__()
+        self.fallback = fallback
+        self.template_dir = template_dir
+        self.min_confidence = min_confidence
+        self.max_samples = max_samples  # stop learning a symbol after this many samples
+        self.min_ink = min_ink  # column runs with fewer ink pixels are noise, not glyphs
+        self.name = name
+        self.hits = 0
+        self.fallbacks = 0
+
+        size = CELL_SHAPE[0] * CELL_SHAPE[1]
+        self._sums = np.zeros((len(SYMBOLS), size), dtype=np.float32)
+        self._counts = np.zeros(len(SYMBOLS), dtype=np.int32)
+        self._templates = np.zeros((len(SYMBOLS), size), dtype=np.float32)
+        self._cameras: Dict[str, 'GlyphReader'] = {}
+        self._lock = threading.Lock()
+        if name and template_dir:
+            self._load()
+
+    def for_camera(self, name: str) -> 'GlyphReader':
+        if self.name == name:
+            return self
+        with self._lock:
+            if name not in self._cameras:
+                self._cameras[name] = GlyphReader(self.fallback, self.template_dir, self.min_confidence,
+                                                  self.max_samples, self.min_ink, name=name)
+            return self._cameras[name]
+
+    @property
+    def layout(self) -> str:
+        """The timestamp as it appears to the segmenter, 'd' for each digit and no spaces"""
+        layout = self.fmt
+        for field in re.findall(r'%[A-Za-z]', self.fmt):
+            layout = layout.replace(field, 'd' * FIELD_WIDTHS.get(field, 2), 1)
+        return layout.replace(' ', '')
+
+    def read(self, image: Image) -> str:
+        """
+        Takes in a cropped timestamp image and outputs the interpreted text.
+        Falls back to the `fallback` reader, and learns from it, when the glyphs are not recognised confidently.
+        """
+        cells = self._segment(image)
+        if cells is not None:
+            text, confidence = self._classify(cells)
+            if text is not None and confidence >= self.min_confidence:
+                self.hits += 1
+                return text
+            logger.debug(f"glyph reader unsure about {self.name} (confidence {confidence:.2f}), falling back")
+
+        if self.fallback is None:
+            raise ValueError(f"Timestamp not recognised by glyph templates for {self.name}")
+        self.fallbacks += 1
+        text = self.fallback.read(image)
+        if cells is not None:
+            self._learn(cells, text)
+        return text
+
+    def close(self) -> None:
+        """Close the `fallback` reader, which the per-camera readers share"""
+        if self.fallback is not None:
+            self.fallback.close()
+
+    def _segment(self, image: Image) -> Optional[np.ndarray]:
+        """Split the image into glyphs, returns one flattened `CELL_SHAPE` ink mask per glyph"""
+        gray = np.asarray(image.convert('L') if image.mode != 'L' else image)
+        ink = gray > _otsu_threshold(gray)
+        if ink.mean() > 0.5:  # text is the minority of pixels, whichever polarity the overlay uses
+            ink = ~ink
+
+        col_ink = ink.sum(axis=0)
+        edges = np.diff(np.concatenate(([0], (col_ink > 0).astype(np.int8), [0])))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        if len(starts) == 0:
+            return None
+        keep = np.add.reduceat(col_ink, starts) >= self.min_ink
+        starts, ends = starts[keep], ends[keep]
+        if len(starts) != len(self.layout):
+            return None
+
+        # one vertical extent for the whole line keeps '-' and ':' apart from each other by position
+        rows = np.flatnonzero(ink[:, starts[0]:ends[-1]].any(axis=1))
+        top, bottom = rows[0], rows[-1]
+        # a fixed-pitch window per glyph, so narrow glyphs like '1' stay narrow instead of being stretched
+        pitch = int((ends - starts).max())
+        pad = pitch
+        padded = np.pad(ink, ((0, 0), (pad, pad)))
+        centers = (starts + ends - 1) / 2
+        offsets = np.linspace(-(pitch - 1) / 2, (pitch - 1) / 2, CELL_SHAPE[1])
+        xs = np.rint(centers[:, None] + offsets[None, :]).astype(np.intp) + pad
+        ys = np.rint(np.linspace(top, bottom, CELL_SHAPE[0])).astype(np.intp)
+        cells = padded[ys[:, None, None], xs[None, :, :]]  # rows, glyphs, columns
+        return cells.transpose(1, 0, 2).reshape(len(starts), -1).astype(np.float32)
+
+    def _classify(self, cells: np.ndarray) -> Tuple[Optional[str], float]:
+        if not self._counts.all():
+            return None, 0.0
+        scores = _normalize(cells) @ self._templates.T
+        best = scores.argmax(axis=1)
+        # confidence is how far the least certain glyph's best match is ahead of its runner-up
+        runner_up, top = np.partition(scores, -2, axis=1)[:, -2:].T
+        confidence = float((top - runner_up).min())
+        chars = ''.join(SYMBOLS[i] for i in best)
+        if re.sub(r'\d', 'd', chars) != self.layout:
+            return None, confidence
+        digits = re.sub(r'\D', '', chars)
+        compact_fmt = ''.join(re.findall(r'%[A-Za-z]', self.fmt))
+        try:
+            return datetime.strptime(digits, compact_fmt).strftime(self.fmt), confidence
+        except ValueError:
+            return None, confidence
+
+    def _learn(self, cells: np.ndarray, text: str) -> None:
+        chars = text.replace(' ', '')
+        if len(chars) != len(cells) or any(c not in SYMBOLS for c in chars):
+            return
+        index = np.array([SYMBOLS.index(c) for c in chars])
+        wanted = self._counts[index] < self.max_samples
+        if not wanted.any():
+            return
+        np.add.at(self._sums, index[wanted], cells[wanted])
+        np.add.at(self._counts, index[wanted], 1)
+        self._update_templates()
+        self._save()
+
+    def _update_templates(self) -> None:
+        trained = self._counts > 0
+        means = self._sums[trained] / self._counts[trained, None]
+        self._templates[trained] = _normalize(means)
+
+    def _path(self) -> str:
+        return os.path.join(self.template_dir, f"{self.name}.npz")
+
+    def _load(self) -> None:
+        if not os.path.exists(self._path()):
+            return
+        with np.load(self._path()) as data:
+            if data['sums'].shape != self._sums.shape:
+                logger.warning(f"ignoring glyph templates at {self._path()}, they use a different cell shape")
+                return
+            self._sums = data['sums'].astype(np.float32)
+            self._counts = data['counts'].astype(np.int32)
+        self._update_templates()
+
+    def _save(self) -> None:
+        if not (self.name and self.template_dir):
+            return
+        os.makedirs(self.template_dir, exist_ok=True)
+        np.savez(self._path(), sums=self._sums, counts=self._counts)
+
+
+def _otsu_threshold(gray: np.ndarray) -> int:
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight = np.cumsum(hist)
+    total = weight[-1]
+    mean = np.cumsum(hist * np.arange(256))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mean[-1] * weight - mean * total) ** 2 / (weight * (total - weight))
+    return int(np.argmax(np.nan_to_num(between)))
+
+
+def _normalize(rows: np.ndarray) -> np.ndarray:
+    """Zero-mean, unit-length rows, so a dot product is a correlation coefficient"""
+    centered = rows - rows.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1, keepdims=True)
+    return centered / np.where(norms == 0, 1, norms)
@@ -0,0 +1,44 @@
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, List, Optional, Type
+
+from PIL.Image import Image
+
+from .base import TimestampReader
+from .tesseract import Tesseract
+
+_reader: Optional[TimestampReader] = None  # the long-lived reader of a pool worker process
+
+
+def _init_worker(reader_cls: Type[TimestampReader], reader_kwargs: dict) -> None:
+    global _reader
+    _reader = reader_cls(**reader_kwargs)
+
+
+def _read(image: Image) -> str:
+    return _reader.read(image)
+
+
+class OCRPool(TimestampReader):
+    """Runs a `TimestampReader` in long-lived worker processes, each keeping its own engine warm.
+
+    `read` keeps the usual blocking interface, `submit` and `submit_many` return futures.
+    """
+    def __init__(self, reader_cls: Type[TimestampReader] = Tesseract, workers: int = 4, **reader_kwargs):
+        super().__init__()
+        self.fmt = reader_cls(**reader_kwargs).fmt
+        # spawn rather than fork, the pool is usually started while pipeline threads hold locks
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_worker, initargs=(reader_cls, reader_kwargs))
+
+    def submit(self, image: Image) -> 'Future[str]':
+        return self._executor.submit(_read, image)
+
+    def submit_many(self, images: Iterable[Image]) -> List['Future[str]']:
+        return [self.submit(image) for image in images]
+
+    def read(self, image: Image) -> str:
+        return self.submit(image).result()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
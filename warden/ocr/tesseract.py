@@ -1,23 +1,43 @@
 import re
+import threading
 
 import pytesseract
 from PIL import Image
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
 from .base import TimestampReader
 
 
 class Tesseract(TimestampReader):
-    def __init__(self):
+    """Tesseract OCR, through a persistent tesserocr engine when it is installed or the tesseract CLI otherwise"""
+    persistent_available = tesserocr is not None
+
+    def __init__(self, persistent: bool = True):
         super().__init__()
+        self.persistent = persistent and self.persistent_available
+        self._local = threading.local()  # tesserocr engines must not be shared between threads
+
+    def _image_to_string(self, image: Image) -> str:
+        if not self.persistent:
+            # Use psm 7 for single line of text
+            custom_config = r'--oem 3 --psm 7'
+            return pytesseract.image_to_string(image, config=custom_config)
+
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = self._local.api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_LINE)
+        api.SetImage(image)
+        return api.GetUTF8Text()
 
     def read(self, image: Image) -> str:
         """
         Takes in a cropped timestamp image and outputs the interpreted text.
         Raises a ValueError if it cannot extract a valid timestamp.
         """
-        # Use psm 7 for single line of text
-        custom_config = r'--oem 3 --psm 7'
-        text = pytesseract.image_to_string(image, config=custom_config)
+        text = self._image_to_string(image)
 
         # Use regex to find timestamp
         match = re.search(self.pattern, text)
@@ -26,4 +46,3 @@ class Tesseract(TimestampReader):
             return match.group()
         else:
             raise ValueError(f"Timestamp not found. Raw text: {text.strip()}")
-
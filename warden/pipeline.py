@@ -0,0 +1,125 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()  # sentinel telling a stage worker to exit
+
+
+class Stage:
+    """A step of the pipeline, run by `workers` threads.
+
+    `func` takes an item and returns the item for the next stage, or None to drop it.
+    """
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: int = 1):
+        if workers < 1:
+            raise ValueError(f"stage {name} needs at least one worker, got {workers}")
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+
+class Pipeline:
+    """Stages joined by bounded queues, so a slow stage applies backpressure instead of buffering everything"""
+    def __init__(self, stages: List[Stage], queue_size: int = 8,
+                 on_done: Optional[Callable[[Any, Optional[BaseException]], None]] = None):
+        if not stages:
+            raise ValueError("a pipeline needs at least one stage")
+        self.stages = stages
+        self.on_done = on_done
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._threads: List[List[threading.Thread]] = []
+        self._pending = 0
+        self._idle = threading.Condition()
+        self.completed = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self) -> 'Pipeline':
+        for i, stage in enumerate(self.stages):
+            threads = []
+            for n in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(i,), name=f"{stage.name}-{n}", daemon=True)
+                thread.start()
+                threads.append(thread)
+            self._threads.append(threads)
+        return self
+
+    def submit(self, item: Any) -> None:
+        """Queue an item at the first stage, blocking while that queue is full"""
+        with self._idle:
+            self._pending += 1
+        self._queues[0].put(item)
+
+    def join(self) -> None:
+        """Wait until every submitted item has left the pipeline"""
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+
+    def stop(self) -> None:
+        """Let in-flight items drain, then shut the workers down stage by stage"""
+        for i, threads in enumerate(self._threads):
+            for _ in threads:
+                self._queues[i].put(_STOP)
+            for thread in threads:
+                thread.join()
+        self._threads = []
+
+    def run(self, items: Iterable[Any]) -> None:
+        """Push `items` through every stage and return once all of them are done"""
+        start = time.monotonic()
+        self.start()
+        try:
+            for item in items:
+                self.submit(item)
+            self.join()
+        finally:
+            self.stop()
+        logger.info(f"pipeline finished in {time.monotonic() - start:.2f}s: {self.completed} completed, "
+                    f"{self.dropped} dropped, {self.failed} failed")
+
+    def __enter__(self) -> 'Pipeline':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        inbox = self._queues[index]
+        last = index == len(self.stages) - 1
+        while True:
+            item = inbox.get()
+            if item is _STOP:
+                return
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                logger.exception(f"stage {stage.name} failed on {item}")
+                self._finish(item, e)
+                continue
+            if result is None:
+                self._finish(item, None, dropped=True)
+            elif last:
+                self._finish(result, None)
+            else:
+                self._queues[index + 1].put(result)
+
+    def _finish(self, item: Any, error: Optional[BaseException], dropped: bool = False) -> None:
+        if self.on_done:
+            try:
+                self.on_done(item, error)
+            except Exception:
+                logger.exception(f"on_done callback failed for {item}")
+        with self._idle:
+            if error is not None:
+                self.failed += 1
+            elif dropped:
+                self.dropped += 1
+            else:
+                self.completed += 1
+            self._pending -= 1
+            self._idle.notify_all()
@@ -0,0 +1,130 @@
+import io
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from PIL import Image, ImageDraw
+
+from warden.detection import Detector, Instance, summarize
+from warden.frame import Frame
+
+Box = Tuple[int, int, int, int]
+
+
+class Region:
+    """A part of the frame detection runs on, a box or a polygon.
+
+    `detect_regions` entries in terminals.yaml are either a box `[left, upper, right, bottom]`, like
+    `timestamp_box`, or a polygon `[[x, y], [x, y], ...]`. Polygons are sent as their bounding box with
+    everything outside the polygon blacked out.
+    """
+    def __init__(self, box: Box, polygon: Optional[List[Tuple[int, int]]] = None):
+        self.box = box
+        self.polygon = polygon
+
+    @classmethod
+    def parse(cls, spec: Sequence) -> 'Region':
+        if len(spec) == 4 and all(isinstance(value, (int, float)) for value in spec):
+            return cls(tuple(int(value) for value in spec))
+        polygon = [(int(x), int(y)) for x, y in spec]
+        if len(polygon) < 3:
+            raise ValueError(f"A detect region polygon needs at least 3 points, got {spec}")
+        xs, ys = [x for x, _ in polygon], [y for _, y in polygon]
+        return cls((min(xs), min(ys), max(xs), max(ys)), polygon)
+
+    def clamp(self, size: Tuple[int, int]) -> Box:
+        left, upper, right, bottom = self.box
+        width, height = size
+        return max(0, left), max(0, upper), min(width, right), min(height, bottom)
+
+    def crop(self, image: Image.Image) -> Image.Image:
+        box = self.clamp(image.size)
+        region = image.crop(box)
+        if self.polygon:
+            mask = Image.new('L', region.size, 0)
+            ImageDraw.Draw(mask).polygon([(x - box[0], y - box[1]) for x, y in self.polygon], fill=255)
+            region = Image.composite(region, Image.new(region.mode, region.size), mask)
+        return region
+
+    def __repr__(self) -> str:
+        return f"Region({self.polygon or self.box})"
+
+
+def encode(image: Image.Image, max_side: Optional[int] = None) -> bytes:
+    if max_side and max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def iou(a: Instance, b: Instance) -> float:
+    width = min(a.left + a.width, b.left + b.width) - max(a.left, b.left)
+    height = min(a.top + a.height, b.top + b.height) - max(a.top, b.top)
+    if width <= 0 or height <= 0:
+        return 0.0
+    overlap = width * height
+    return overlap / (a.width * a.height + b.width * b.height - overlap)
+
+
+def merge(instances: List[Instance], threshold: float = 0.5) -> List[Instance]:
+    """Drop instances that overlap a more confident one by more than `threshold` IoU, e.g. a truck seen by two regions"""
+    kept: List[Instance] = []
+    for instance in sorted(instances, key=lambda instance: instance.confidence, reverse=True):
+        if all(iou(instance, other) <= threshold for other in kept):
+            kept.append(instance)
+    return kept
+
+
+class PendingDetection:
+    """Detections running on the regions of one frame, `result` waits for them like a `Future`"""
+    def __init__(self, parts: List[Tuple['Future[List[Instance]]', Box]]):
+        self.parts = parts
+
+    def add_done_callback(self, callback: Callable[[], None]) -> None:
+        """Call `callback` once every region is done, from the thread that finished the last one"""
+        remaining = [len(self.parts)]
+        lock = threading.Lock()
+
+        def part_done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                callback()
+
+        for future, _ in self.parts:
+            future.add_done_callback(part_done)
+
+    def instances(self) -> List[Instance]:
+        """Every instance in full-frame pixel coordinates, with duplicates from overlapping regions merged"""
+        instances = []
+        for future, (left, upper, right, bottom) in self.parts:
+            width, height = right - left, bottom - upper
+            # Rekognition boxes are ratios of the image sent, so downscaling does not change them
+            instances += [Instance(left + instance.left * width, upper + instance.top * height,
+                                   instance.width * width, instance.height * height, instance.confidence)
+                          for instance in future.result()]
+        return merge(instances) if len(self.parts) > 1 else instances
+
+    def result(self) -> Tuple[int, float]:
+        return summarize(self.instances())
+
+
+def submit_regions(detector: Detector, frame: Frame, regions: Sequence[Region] = (),
+                   max_side: Optional[int] = None) -> PendingDetection:
+    """Start detection on each region of `frame`, or on the whole frame, downscaled to fit `max_side`"""
+    if not regions:
+        full = (0, 0) + frame.size
+        if not max_side or max(frame.size) <= max_side:
+            return PendingDetection([(detector.submit_instances(frame.data, frame.digest), full)])
+        data = encode(frame.thumbnail(max_side, mode='RGB'))
+        return PendingDetection([(detector.submit_instances(data, f"{frame.digest}:{max_side}"), full)])
+
+    parts = []
+    for region in regions:
+        box = region.clamp(frame.size)
+        data = encode(region.crop(frame.image), max_side)
+        parts.append((detector.submit_instances(data, f"{frame.digest}:{region!r}:{max_side}"), box))
+    return PendingDetection(parts)
@@ -0,0 +1,198 @@
+import logging
+import multiprocessing
+import os
+import posixpath
+import re
+from datetime import datetime, timezone
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from pytesseract import TesseractNotFoundError
+
+from warden.frame import Frame
+from warden.memory import DatabaseMemory, PhotoMemory
+from warden.memory.base import CONTENT_TYPE_EXTENSIONS
+from warden.regions import Region, submit_regions
+from warden.terminal import Camera, convert_est_to_utc_timestamp
+
+logger = logging.getLogger(__name__)
+
+# frames saved before names carried the UTC timestamp: `<camera>_2024-07-09_14:17:10[_approx].jpg` in US/Eastern
+LEGACY_NAME = re.compile(r'_(\d{4}-\d{2}-\d{2})_(\d{2}:\d{2}:\d{2})(_approx)?$')
+EXTENSION_CONTENT_TYPES = {extension: content_type for content_type, extension in CONTENT_TYPE_EXTENSIONS.items()}
+
+
+class FrameTask(NamedTuple):
+    """A stored frame to run OCR and detection on again, with the settings of its camera"""
+    name: str
+    camera_name: str
+    timestamp: int
+    ts_approx: bool
+    timestamp_box: Tuple[int, int, int, int]
+    detect_regions: List[Region]
+    detect_max_side: Optional[int]
+
+
+class FrameResult(NamedTuple):
+    name: str
+    record_name: str
+    detection: Optional[Tuple[int, float]]
+    stored_timestamp: int  # the timestamp the frame's result was saved under before
+
+
+def parse_frame_name(name: str, camera_name: str) -> Optional[Tuple[int, bool]]:
+    """UTC ms timestamp and approx flag of a frame of `camera_name` saved as `name`, None if it is not one"""
+    stem = posixpath.splitext(name)[0]
+    parts = stem.split('|')
+    if len(parts) == 3 and parts[0] == camera_name and parts[1].isdigit():
+        return int(parts[1]), parts[2].lower() == 'true'
+    match = LEGACY_NAME.search(stem)
+    if match and stem[:match.start()] == camera_name:
+        return convert_est_to_utc_timestamp(f"{match.group(1)} {match.group(2)}"), match.group(3) is not None
+    return None
+
+
+def list_frames(memory: PhotoMemory, cameras: Iterable[Camera], start_ts: Optional[int] = None,
+                end_ts: Optional[int] = None) -> Iterator[FrameTask]:
+    """Stored frames of `cameras` between two UTC ms timestamps (inclusive), renditions are skipped"""
+    for camera in cameras:
+        for name in memory.list_names(prefix=camera.full_name):
+            parsed = parse_frame_name(name, camera.full_name)
+            if parsed is None:
+                continue
+            timestamp, ts_approx = parsed
+            if (start_ts is not None and timestamp < start_ts) or (end_ts is not None and timestamp > end_ts):
+                continue
+            yield FrameTask(name, camera.full_name, timestamp, ts_approx, camera.timestamp_box_coordinates,
+                            camera.detect_regions, camera.detect_max_side)
+
+
+class Checkpoint:
+    """Names of the frames whose results are saved, appended to a file so a killed run can resume"""
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Set[str] = set()
+        if os.path.exists(path):
+            with open(path) as file:
+                self.done = {line.rstrip('\n') for line in file if line.strip()}
+        self._file = open(path, 'a')
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.done
+
+    def add_many(self, names: Iterable[str]) -> None:
+        names = list(names)
+        self._file.writelines(f"{name}\n" for name in names)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.update(names)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+# the long-lived state of a pool worker process
+_worker: Dict[str, object] = {}
+
+
+def _init_worker(storage_type: str, ocr_type: str, detect: bool, tps: float) -> None:
+    # imported here so the parent process does not build its own readers and clients
+    from warden.config import get_detector, get_photo_memory, get_timestamp_reader
+
+    _worker['memory'] = get_photo_memory(storage_type)
+    _worker['reader'] = get_timestamp_reader(ocr_type)
+    _worker['detector'] = None
+    if detect:
+        _worker['detector'] = get_detector(workers=1, tps=tps)
+
+
+def _process(task: FrameTask) -> FrameResult:
+    data = _worker['memory'].load_bytes(task.name)
+    content_type = EXTENSION_CONTENT_TYPES.get(posixpath.splitext(task.name)[1].lower(), 'image/jpeg')
+    frame = Frame(data, content_type)
+
+    timestamp, ts_approx = task.timestamp, task.ts_approx
+    reader = _worker['reader']
+    if reader is not None:
+        try:
+            text = reader.for_camera(task.camera_name).read(frame.region(task.timestamp_box))
+            timestamp, ts_approx = convert_est_to_utc_timestamp(text), False
+        except (ValueError, TesseractNotFoundError) as e:
+            logger.debug(f"keeping the stored timestamp of {task.name}: {e}")
+
+    detection = None
+    if _worker['detector'] is not None:
+        detection = submit_regions(_worker['detector'], frame, task.detect_regions, task.detect_max_side).result()
+    return FrameResult(task.name, f"{task.camera_name}|{timestamp}|{ts_approx}", detection, task.timestamp)
+
+
+def save_results(db_mem: DatabaseMemory, results: Iterable[FrameResult]) -> None:
+    """Save reprocessed results in place of the ones saved for their frames before, in one batch"""
+    items = []
+    for result in results:
+        camera_name, timestamp, ts_approx = db_mem._parse_name(result.record_name)
+        # without detection the saved count moves to the timestamp read again
+        truck_count, avg_confidence = result.detection if result.detection is not None else (None, None)
+        items.append(((camera_name, result.stored_timestamp),
+                      (camera_name, timestamp, truck_count, avg_confidence, ts_approx, False)))
+    db_mem.replace_many(items)
+
+
+def utc_date_ms(date: str, end_of_day: bool = False) -> int:
+    """UNIX ms at the start (or the last ms) of a `YYYY-MM-DD` UTC date"""
+    start = datetime.strptime(date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return int(start.timestamp() * 1000) + (86_400_000 - 1 if end_of_day else 0)
+
+
+def reprocess(tasks: Iterable[FrameTask], db_mem: DatabaseMemory, checkpoint: Checkpoint, storage_type: str,
+              ocr_type: str = 'tesseract', detect: bool = True, processes: Optional[int] = None,
+              batch_size: int = 500, tps: float = 5.0) -> Tuple[int, int]:
+    """Run OCR and detection over stored frames in a process pool and save the results in batches.
+
+    Each result replaces the one saved under the frame's stored timestamp. Frames already in `checkpoint` are
+    skipped, and a frame only enters the checkpoint once its result is saved, so an interrupted run can be
+    restarted with the same arguments. Returns (processed, failed).
+    """
+    processes = processes or os.cpu_count() or 1
+    window = processes * 4  # enough queued frames to keep every worker busy without listing ahead too far
+    processed = failed = 0
+    results: List[FrameResult] = []
+
+    def save_batch():
+        save_results(db_mem, results)
+        checkpoint.add_many(result.name for result in results)
+        logger.info(f"saved {processed} reprocessed frames, {failed} failed")
+        results.clear()
+
+    # spawn rather than fork, like `OCRPool`, so workers never inherit locks held by other threads,
+    # and the Rekognition quota is split between the worker processes
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(storage_type, ocr_type, detect, tps / processes)) as executor:
+        in_flight: Dict[Future, FrameTask] = {}
+
+        def collect() -> None:
+            nonlocal processed, failed
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                task = in_flight.pop(future)
+                try:
+                    results.append(future.result())
+                    processed += 1
+                except Exception:
+                    logger.exception(f"failed to reprocess {task.name}")
+                    failed += 1
+            if len(results) >= batch_size:
+                save_batch()
+
+        for task in tasks:
+            if task.name in checkpoint:
+                continue
+            in_flight[executor.submit(_process, task)] = task
+            while len(in_flight) >= window:
+                collect()
+        while in_flight:
+            collect()
+    if results:
+        save_batch()
+    return processed, failed
@@ -0,0 +1,82 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from warden.capture import CaptureJob
+from warden.pipeline import Pipeline
+from warden.terminal import Camera
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Polls every camera on its own interval, backing off exponentially while a camera keeps failing.
+
+    A camera is only rescheduled once its previous job has left the pipeline, so a slow camera
+    never piles up jobs or holds up the others.
+    """
+    def __init__(self, cameras: Iterable[Camera], default_interval: float = 60, jitter: float = 0.1,
+                 max_backoff: float = 900):
+        self.cameras = list(cameras)
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.failures = {camera.full_name: 0 for camera in self.cameras}
+        self._heap: List[Tuple[float, int, Camera]] = []
+        self._seq = itertools.count()  # tie-breaker so cameras themselves are never compared
+        self._wakeup = threading.Condition()
+        self._stopped = False
+
+    def interval(self, camera: Camera) -> float:
+        return camera.interval or self.default_interval
+
+    def delay(self, camera: Camera) -> float:
+        """Seconds until the next poll of `camera`, including backoff and jitter"""
+        interval = self.interval(camera)
+        failures = self.failures[camera.full_name]
+        if failures:
+            interval = min(interval * 2 ** min(failures, 16), max(self.max_backoff, interval))
+        return interval + random.uniform(0, self.jitter * interval)
+
+    def schedule(self, camera: Camera, delay: float) -> None:
+        with self._wakeup:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), camera))
+            self._wakeup.notify()
+
+    def done(self, job: CaptureJob, error: Optional[BaseException]) -> None:
+        """Pipeline callback, reschedules the camera of a finished job"""
+        camera = job.camera
+        if error is None:
+            self.failures[camera.full_name] = 0
+        else:
+            self.failures[camera.full_name] += 1
+        delay = self.delay(camera)
+        if error is not None:
+            logger.warning(f"{camera.full_name} failed {self.failures[camera.full_name]} time(s) in a row, "
+                           f"retrying in {delay:.0f}s")
+        self.schedule(camera, delay)
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+
+    def run(self, pipeline: Pipeline) -> None:
+        """Feed due cameras into a started `pipeline` until `stop` is called"""
+        for camera in self.cameras:
+            # spread the first polls over one interval instead of hitting every camera at once
+            self.schedule(camera, random.uniform(0, self.jitter * self.interval(camera)))
+
+        while True:
+            with self._wakeup:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._wakeup.wait(timeout)
+                if self._stopped:
+                    return
+                _, _, camera = heapq.heappop(self._heap)
+            pipeline.submit(CaptureJob(camera))
@@ -1,9 +1,7 @@
-from typing import List, Optional
-import io
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 import logging
 
-import requests
 from PIL import Image
 from yaml import load
 from pytesseract import TesseractNotFoundError
@@ -14,26 +12,52 @@ except ImportError:
     print('warning: could not load c yaml libraries')
     from yaml import Loader, Dumper
 
-from warden.memory import Memory
+from warden.fetch import FetchClient
+from warden.frame import Frame
+from warden.memory import Memory, PhotoMemory
+from warden.memory.base import CONTENT_TYPE_EXTENSIONS
+from warden.memory.rendition import parse_renditions, rendition_name, render
 from warden.ocr import TimestampReader
+from warden.regions import Region
 from warden.utils import to_snake_case
 
 
+# optional per-camera keys of terminals.yaml, passed on to `Camera`
+CAMERA_OPTIONS = ('interval', 'change_threshold', 'detect_regions', 'detect_max_side', 'renditions')
+
+
 class Camera:
     """A camera stationed at a specific Terminal"""
-    def __init__(self, name: str, url: str, terminal: 'Terminal', timestamp_box: tuple[int, int, int, int]):
+    def __init__(self, name: str, url: str, terminal: 'Terminal', timestamp_box: tuple[int, int, int, int],
+                 interval: Optional[float] = None, change_threshold: Optional[float] = None,
+                 detect_regions: Optional[list] = None, detect_max_side: Optional[int] = None,
+                 renditions=None):
         self.name = name
         self.url = url
         self.terminal = terminal
         self.memory = terminal.memory
+        self.interval = interval  # seconds between polls in daemon mode, None uses the default
+        self.change_threshold = change_threshold  # min scene change to detect again, None uses the default
+        # parts of the frame detection runs on (the whole frame if empty), downscaled to fit `detect_max_side`
+        self.detect_regions = [Region.parse(spec) for spec in detect_regions or []]
+        self.detect_max_side = detect_max_side
+        self.renditions = parse_renditions(renditions)  # smaller copies saved next to each frame
 
         # frame
-        self.last_image: Optional[Image.Image] = None
+        self.last_frame: Optional[Frame] = None  # the image exactly as the camera served it, decoded lazily
         self.last_image_name = ''
+        self.last_renditions: Dict[str, bytes] = {}  # encoded renditions of `last_frame` by rendition name
+        self.skipped_frames = 0  # frames not processed because the camera served the same image again
+        # validators and digest of the last frame processed completely, see `commit`
+        self._etag: Optional[str] = None
+        self._last_modified: Optional[str] = None
+        self._digest: Optional[str] = None
+        self._fetched: Optional[Tuple[Optional[str], Optional[str], str]] = None  # the same, of `last_frame`
         self._timestamp_box = timestamp_box  # coordinates are left, upper, right, bottom (PIL crop)
 
         self.last_timestamp: Optional[int] = None  # UNIX ms timestamp
         self.last_ts_approx = False  # Did we use datetime.now() to approximate the timestamp?
+        self.last_detection: Optional[Tuple[int, float]] = None  # truck count and confidence of the last detection
 
     @property
     def full_name(self) -> str:
@@ -41,62 +65,128 @@ class Camera:
         return to_snake_case(self.terminal.name + ' ' + self.name)
 
     @property
-    def timestamp_box(self):
-        """The timestamp on the image, usually in the bottom-left corner"""
-        return self.last_image.crop(self._timestamp_box)
-
-    def get(self) -> Image.Image:
-        """Get the most recent image from the Camera"""
-        resp = requests.get(self.url)
-        resp.raise_for_status()
-        image = Image.open(io.BytesIO(resp.content))
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        self.last_image = image
-        return image
+    def last_record_name(self) -> str:
+        """Name the detection results of the `last_image` are saved under"""
+        return f"{self.full_name}|{self.last_timestamp}|{self.last_ts_approx}"
 
-    def save_last(self, timestamp_reader: TimestampReader = None):
-        """Save the `last_image` to memory"""
-        if not self.last_image:
-            raise AttributeError("missing last image, cannot save")
+    @property
+    def last_image(self) -> Optional[Image.Image]:
+        """The fully decoded `last_frame`, only decoded when a caller needs every pixel"""
+        return self.last_frame.image if self.last_frame else None
+
+    @property
+    def last_bytes(self) -> Optional[bytes]:
+        return self.last_frame.data if self.last_frame else None
+
+    @property
+    def last_digest(self) -> Optional[str]:
+        return self.last_frame.digest if self.last_frame else None
+
+    @property
+    def timestamp_box_coordinates(self) -> Tuple[int, int, int, int]:
+        return tuple(self._timestamp_box)
+
+    @property
+    def timestamp_box(self) -> Image.Image:
+        """The timestamp on the image, usually in the bottom-left corner, cropped from a grayscale decode of the
+        frame, see `Frame.region`"""
+        return self.last_frame.region(self._timestamp_box)
+
+    def get(self) -> Optional[Frame]:
+        """Get the most recent frame from the Camera, returns None if it has not changed since the last frame
+        that was `commit`ted"""
+        self._fetched = None
+        headers = {}
+        if self._digest is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        resp = self.terminal.client.get(self.url, headers=headers)
+        if resp.status_code == 304:
+            self.skipped_frames += 1
+            return None
+
+        frame = Frame(resp.content, resp.headers.get('Content-Type', 'image/jpeg').split(';')[0].strip())
+        if frame.digest == self._digest:
+            self.skipped_frames += 1
+            return None
+        self.last_frame = frame
+        self._fetched = (resp.headers.get('ETag'), resp.headers.get('Last-Modified'), frame.digest)
+        return frame
+
+    def commit(self) -> None:
+        """Mark the `last_frame` as processed, once it is stored and its detection saved. Until then `get`
+        fetches it again, so a frame whose processing failed is not skipped as unchanged"""
+        if self._fetched is not None:
+            self._etag, self._last_modified, self._digest = self._fetched
+            self._fetched = None
+
+    def read_timestamp(self, timestamp_reader: TimestampReader = None) -> int:
+        """Read the timestamp of the `last_image`, falling back to the current time"""
+        if self.last_frame is None:
+            raise AttributeError("missing last image, cannot read timestamp")
 
         self.last_ts_approx = True
         self.last_timestamp = int(datetime.now(pytz.UTC).timestamp() * 1000)
         if timestamp_reader:
             try:
-                self.last_timestamp = convert_est_to_utc_timestamp(timestamp_reader.read(self.timestamp_box))
+                text = timestamp_reader.for_camera(self.full_name).read(self.timestamp_box)
+                self.last_timestamp = convert_est_to_utc_timestamp(text)
                 self.last_ts_approx = False
             except (ValueError, TesseractNotFoundError) as e:
                 err_str = (f"encountered an error when extracting the timestamp, "
                            f"using current timestamp as _approx: {e}")
                 logging.log(logging.WARN, err_str)
-        self.last_image_name = f"{self.full_name}|{self.last_timestamp}|{self.last_ts_approx}.jpg"
-        self.memory.save(self.last_image, self.last_image_name)
+        extension = CONTENT_TYPE_EXTENSIONS.get(self.last_frame.content_type, '.jpg')
+        self.last_image_name = f"{self.full_name}|{self.last_timestamp}|{self.last_ts_approx}{extension}"
+        return self.last_timestamp
+
+    def store_last(self):
+        """Save the `last_image` to memory, as the original bytes and its renditions when the memory supports it"""
+        if isinstance(self.memory, PhotoMemory):
+            self.memory.save_bytes(self.last_frame.data, self.last_image_name, self.last_frame.content_type)
+            self.last_renditions = {}
+            for key, rendition in self.renditions.items():
+                data = self.last_renditions[key] = render(self.last_frame, rendition)
+                self.memory.save_bytes(data, rendition_name(self.last_image_name, key), rendition.content_type)
+        else:
+            self.memory.save(self.last_image, self.last_image_name)
+
+    def save_last(self, timestamp_reader: TimestampReader = None):
+        """Read the timestamp of the `last_image` and save it to memory"""
+        self.read_timestamp(timestamp_reader)
+        self.store_last()
 
 
 class Terminal:
     """A Terminal, like Wando or HLT, which might have multiple cameras"""
-    def __init__(self, name: str, memory: Memory):
+    def __init__(self, name: str, memory: Memory, client: Optional[FetchClient] = None):
         self.name = name
         self.cameras: List[Camera] = []
         self.memory = memory
+        self.client = client or FetchClient()
 
-    def add_camera(self, name: str, url: str, timestamp_box: tuple[int, int, int, int]) -> Camera:
-        camera = Camera(name, url, self, timestamp_box)
+    def add_camera(self, name: str, url: str, timestamp_box: tuple[int, int, int, int],
+                   **options) -> Camera:
+        """`options` are the optional `Camera` settings, e.g. `interval` or `detect_regions`"""
+        camera = Camera(name, url, self, timestamp_box, **options)
         self.cameras.append(camera)
         return camera
 
 
-def load_terminals(yaml_file: str, memory: Memory) -> List[Terminal]:
-    """Load in the terminal configurations from a yaml file"""
+def load_terminals(yaml_file: str, memory: Memory, client: Optional[FetchClient] = None) -> List[Terminal]:
+    """Load in the terminal configurations from a yaml file, every camera shares one `FetchClient`"""
     with open(yaml_file, 'r') as file:
         data = load(file, Loader)
 
+    client = client or FetchClient()
     terminals = []
     for terminal_data in data['terminals']:
-        terminal = Terminal(terminal_data['name'], memory)
+        terminal = Terminal(terminal_data['name'], memory, client)
         for cam in terminal_data['cameras']:
-            terminal.add_camera(cam['name'], cam['url'], cam['timestamp_box'])
+            options = {key: cam[key] for key in CAMERA_OPTIONS if key in cam}
+            terminal.add_camera(cam['name'], cam['url'], cam['timestamp_box'], **options)
         terminals.append(terminal)
 
     return terminals